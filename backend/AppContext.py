@@ -0,0 +1,93 @@
+import os
+from functools import cached_property
+from pathlib import Path
+
+from DirectoryManager import DirectoryManager
+from FileManager import FileManager
+from Logger import Logger
+
+
+# What every backend class used to build for itself: the directories, the file
+# manager, the logger, a database connection and an HTTP session. Each
+# `FileManager` built a `DirectoryManager` that checked and created every
+# directory, each `Logger` set up logging and each `SQLite` opened its own
+# connection, a `Runner` did all of it about ten times.
+#
+# Classes take a `context` and default to the process wide one,
+# `AppContext.get()`. `AppContext.configure(base_dir)` points the whole backend
+# at another directory, for example a temporary one:
+#
+#   AppContext.configure(tmp_dir)
+#   Runner().collect_WEC_data()
+#
+# The database connection and HTTP session are built on first use. A context
+# is pickled as its `base_dir`, a worker process unpickles it to its own
+# process wide context for the same directory, connections and sessions are
+# never shared between processes.
+class AppContext:
+    instance = None
+
+    def __init__(self, base_dir=None):
+        self.pid = os.getpid()
+
+        self.dirs = DirectoryManager(base_dir)
+        self.base_dir = self.dirs.base_dir
+        self.file_manager = FileManager(self.dirs)
+        self.logger = Logger(self.file_manager)
+
+    # Read and write connection shared by the jobs of this process
+    @cached_property
+    def db(self):
+        from SQLite import SQLite
+
+        return SQLite(context=self)
+
+    # requests takes a tenth of a second to import, only the jobs that
+    # download anything import it
+    @cached_property
+    def session(self):
+        import requests
+
+        return requests.Session()
+
+    def close(self):
+        if "db" in self.__dict__:
+            self.__dict__.pop("db").finish()
+        if "session" in self.__dict__:
+            self.__dict__.pop("session").close()
+
+    def __reduce__(self):
+        return (AppContext.get, (self.base_dir,))
+
+    # The process wide context, built on first use. A forked worker process
+    # builds its own for the directory of the inherited one, a `base_dir`
+    # other than the current one configures a new context
+    @classmethod
+    def get(cls, base_dir=None):
+        instance = cls.instance
+        if instance is not None and instance.pid == os.getpid():
+            if base_dir is None or Path(base_dir) == instance.base_dir:
+                return instance
+            return cls.configure(base_dir)
+
+        if base_dir is None and instance is not None:
+            base_dir = instance.base_dir
+
+        cls.instance = cls(base_dir)
+        return cls.instance
+
+    # Replace the process wide context, `base_dir` None is the default
+    # dashboard directory, see `DirectoryManager`
+    @classmethod
+    def configure(cls, base_dir=None):
+        if cls.instance is not None and cls.instance.pid == os.getpid():
+            cls.instance.close()
+
+        cls.instance = cls(base_dir)
+        return cls.instance
+
+
+if __name__ == "__main__":
+    context = AppContext.get()
+    print(context.base_dir)
+    print(context.file_manager.get_db_filepath())
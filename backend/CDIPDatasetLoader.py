@@ -0,0 +1,65 @@
+import xarray as xr
+
+
+# Open CDIP NetCDF files with only the variables the backend uses.
+#
+# CDIP realtime files carry GPS, SST, flag and directional (a1, b1, ...)
+# arrays alongside the spectra. `xr.open_dataset` with default arguments
+# decodes every one of them. Here the file is opened without CF decoding, which
+# only reads metadata and leaves every array as a lazy backend array, the
+# needed variables are selected, and CF decoding (including time decoding) is
+# applied to that subset only. The coordinates that come along are the ones the
+# selected variables are defined on: `waveTime` and `waveFrequency`.
+class CDIPDatasetLoader:
+    def __init__(self):
+        # Variables along `waveTime` used for QOI calculations and archiving
+        self.wave_vars = [
+            "waveEnergyDensity",
+            "waveHs",
+            "waveTp",
+            "waveTa",
+            "waveDp",
+            "wavePeakPSD",
+            "waveTz",
+        ]
+
+        # Meta variables that don't have dimensions
+        self.meta_vars = [
+            "metaStationName",
+            "metaPlatform",
+            "metaInstrumentation",
+            "metaDeployLatitude",
+            "metaDeployLongitude",
+            "metaWaterDepth",
+            "metaDeclination",
+            "metaGridMapping",
+        ]
+
+    def open(self, path, variables=None):
+        """Lazily open `path` with only `variables` (defaults to the wave and
+        meta variables) decoded. Values are read when they are accessed.
+        """
+        if variables is None:
+            variables = self.wave_vars + self.meta_vars
+
+        ds_raw = xr.open_dataset(path, decode_cf=False)
+
+        keep = [var for var in variables if var in ds_raw.variables]
+        ds = xr.decode_cf(ds_raw[keep])
+
+        # Closing the decoded subset closes the underlying file
+        ds.set_close(ds_raw.close)
+
+        return ds
+
+    def load(self, path, variables=None):
+        """Read the selected variables into memory and close the file."""
+        with self.open(path, variables) as ds:
+            return ds.load()
+
+
+if __name__ == "__main__":
+    import sys
+
+    loader = CDIPDatasetLoader()
+    print(loader.open(sys.argv[1]))
@@ -1,27 +1,25 @@
 import os
 
-import pandas as pd
-
-import numpy as np
-import mhkit
-import requests
-import xarray as xr
-
-from Logger import Logger
+from AppContext import AppContext
+from CDIPDatasetLoader import CDIPDatasetLoader
+from SpectraQOICalculator import SpectraQOICalculator
 
 
 # Download and parse CDIP nc file into wave QOI
 class CDIPRealTimeParser:
-    def __init__(self, station_id):
+    def __init__(self, station_id, context=None):
+        context = context or AppContext.get()
+
         self.station_id = station_id
         self.ndbc_thredds_url = f"https://thredds.cdip.ucsd.edu/thredds/fileServer/cdip/realtime/{self.station_id}p1_rt.nc"
-        self.logger = Logger()
+        self.logger = context.logger
+        self.session = context.session
 
     def download_nc_file(self):
         """Download the nc file using requests and save it locally."""
         try:
             local_filename = f"{self.station_id}_realtime.nc"
-            with requests.get(self.ndbc_thredds_url, stream=True) as r:
+            with self.session.get(self.ndbc_thredds_url, stream=True) as r:
                 r.raise_for_status()
                 with open(local_filename, "wb") as f:
                     for chunk in r.iter_content(chunk_size=8192):
@@ -40,27 +38,15 @@ class CDIPRealTimeParser:
             return None, None
 
         try:
-            ds = xr.open_dataset(local_nc_file)
+            # Only the wave and meta variables are read, the file is removed
+            # below so everything that is returned has to be in memory
+            ds = CDIPDatasetLoader().load(local_nc_file)
 
             wave_energy_density = ds.waveEnergyDensity.to_pandas()
             station_depth = float(ds.metaWaterDepth.values)
 
-            df = wave_energy_density
-            df.columns = [float(col) for col in df.columns]
-            df = df.T
-
-            Hm_0 = mhkit.wave.resource.significant_wave_height(df)
-            T_e = mhkit.wave.resource.energy_period(df)
-            J = mhkit.wave.resource.energy_flux(df, station_depth)
-            T_avg = mhkit.wave.resource.average_crest_period(df)
-            T_m = mhkit.wave.resource.average_wave_period(df)
-            T_p = mhkit.wave.resource.peak_period(df)
-            T_z = mhkit.wave.resource.average_zero_crossing_period(df)
-
-            # Join all columns in "other" with Hm_0 using the index
-            result_df = Hm_0.join([T_z, T_avg, T_m, T_p, T_e, J], how="left")
-
-            result_df = result_df.add_prefix("Spectral_")
+            calculator = SpectraQOICalculator()
+            result_df = calculator.calculate(wave_energy_density, station_depth)
 
             result_df["WMI_waveHs"] = ds.waveHs.values
             result_df["WMI_waveTp"] = ds.waveTp.values
@@ -69,15 +55,7 @@ class CDIPRealTimeParser:
             result_df["WMI_wavePeakPSD"] = ds.wavePeakPSD.values
             result_df["WMI_waveTz"] = ds.waveTz.values
 
-            result_df.index = pd.to_datetime(result_df.index, utc=True)
-            result_df.index.name = "time"
-
-            # Unix seconds
-            result_df["Timestamp"] = result_df.index.astype(np.int64) // 10**9
-            result_df["Raw_Timestamp"] = result_df.index.astype(str)
-
-            # This is dumb but everything else is in unix seconds
-            result_df.index = result_df["Timestamp"]
+            result_df = calculator.index_by_unix_seconds(result_df)
 
             return result_df, ds
         except Exception as e:
@@ -3,13 +3,15 @@ import socket
 import pandas as pd
 import requests
 
-from Logger import Logger
+from AppContext import AppContext
 
 
 # Abstracts access to the Oscilla Power Triton-C Canary server
 # Follows Canary 21.1 documentation: https://readapi.canarylabs.com/21.1/
 class CanaryRequester:
-    def __init__(self, ip_address):
+    def __init__(self, ip_address, context=None):
+        context = context or AppContext.get()
+
         self.ip = ip_address
         self.port = "55235"
         self.entry_url = f"http://{self.ip}:{self.port}/api/v2/"
@@ -25,7 +27,8 @@ class CanaryRequester:
         # List of all tags available on the canary server
         self.raw_tags = []
 
-        self.logger = Logger()
+        self.logger = context.logger
+        self.session = context.session
 
         self.all_data_request_bundle = {
             "WIN-SUARIOMU79L.Dataset 1.Pos_Lat": "GPS_Lat",
@@ -134,7 +137,7 @@ class CanaryRequester:
     # }
     def request_endpoint(self, endpoint, params):
         try:
-            result = requests.get(f"{self.entry_url}{endpoint}", params)
+            result = self.session.get(f"{self.entry_url}{endpoint}", params=params)
         except requests.exceptions.RequestException as e:
             self.logger.error(
                 __name__,
@@ -0,0 +1,436 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import queue
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from AppContext import AppContext
+from PowerTimeSeries import PowerTimeSeries
+from SQLite import SQLite
+from StationRegistry import StationRegistry
+
+
+# Time query parameter as unix epoch seconds, either a number of seconds or an
+# ISO 8601 string. Strings without a timezone are UTC. "nan" and "inf" parse
+# as floats but are not times
+def parse_time(value):
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        if np.isfinite(seconds) == False:
+            raise ValueError(f"{value} is not a finite unix epoch seconds time")
+        return seconds
+
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"{value} is not unix epoch seconds or an ISO 8601 time")
+
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+# Values as a JSON list, NaN as None
+def to_json_list(values, decimals):
+    values = np.asarray(values, dtype=np.float64).round(decimals)
+    return [value if np.isfinite(value) else None for value in values.tolist()]
+
+
+# Read only HTTP API over the dashboard data, stdlib asyncio only.
+#
+# Routes, all GET (and HEAD) with JSON responses:
+#   /api/triton_c?start=&end=&resolution=       power rollups, see
+#       `SQLite.select_triton_c_rollup`. `resolution` is a `PowerTimeSeries`
+#       level, the response has the same layout as its JSON files
+#   /api/spectra?start=&end=&station=           spectral QOIs
+#   /api/power_matrix?pto=&window=              the `PowerMatrixJson` file
+# `start` and `end` are unix epoch seconds or ISO 8601 times, `end` defaults
+# to now and `start` to a day before `end`.
+#
+# Queries run on a pool of read only connections in worker threads, the event
+# loop only parses requests and writes responses. Responses are kept in an
+# LRU cache. The cache is cleared when the database or the visualization
+# directory changes, checked at most every `version_check_s` with
+# `PRAGMA data_version`, so viewers of the same range share one query per
+# ingest. Concurrent requests for a response that is not cached yet wait for
+# the same query.
+#
+# Each response has an ETag, the hash of its body, and is answered with 304
+# when the client already has it. Responses are gzipped once, when cached,
+# for clients that accept it.
+class DashboardAPI:
+    # Power matrix windows, see `Runner.power_matrix_windows`
+    power_matrix_windows = ["all", "utc_day", "7_utc_days", "30_utc_days", "month"]
+
+    # Limits of one response
+    max_buckets = 20_000
+    max_spectra_rows = 100_000
+
+    # Bodies smaller than this are not worth compressing
+    min_gzip_bytes = 1024
+
+    max_header_lines = 100
+    request_timeout_s = 30
+
+    version_check_s = 1.0
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8050,
+        pool_size=4,
+        cache_entries=256,
+        context=None,
+    ):
+        context = context or AppContext.get()
+
+        self.host = host
+        self.port = port
+        self.cache_entries = cache_entries
+
+        self.logger = context.logger
+        self.dirs = context.dirs
+        self.file_manager = context.file_manager
+        self.stations = StationRegistry()
+
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(SQLite(read_only=True, context=context))
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+        # Only used from the event loop, to detect commits by other connections
+        self.version_db = SQLite(read_only=True, context=context)
+        self.version = None
+        self.version_checked_s = 0.0
+
+        # (path, sorted query) to response entry, least recently used first
+        self.cache = OrderedDict()
+        self.in_flight = {}
+
+        self.routes = {
+            "/api/triton_c": self.get_triton_c,
+            "/api/spectra": self.get_spectra,
+            "/api/power_matrix": self.get_power_matrix,
+        }
+
+    #  Routes ---------------------------------------------------------------{{{
+    # Each route runs in a worker thread with a pooled connection and returns
+    # the JSON body. ValueError is a bad request, FileNotFoundError not found
+
+    def get_time_range(self, params):
+        end = parse_time(params["end"]) if "end" in params else time.time()
+        start = parse_time(params["start"]) if "start" in params else end - 86400
+        if end <= start:
+            raise ValueError("end must be after start")
+        return (start, end)
+
+    def get_triton_c(self, db, params):
+        resolution = params.get("resolution", "15min")
+        if resolution not in PowerTimeSeries.levels:
+            raise ValueError(
+                f"resolution must be one of {', '.join(PowerTimeSeries.levels)}"
+            )
+
+        width_s = PowerTimeSeries.levels[resolution][0]
+        start, end = self.get_time_range(params)
+        if (end - start) / width_s > self.max_buckets:
+            raise ValueError(
+                f"More than {self.max_buckets} buckets, use a coarser resolution"
+            )
+
+        df = db.select_triton_c_rollup(
+            start * 1_000_000_000, end * 1_000_000_000, width_s * 1_000_000_000
+        )
+
+        return {
+            "version": PowerTimeSeries.version,
+            "level": resolution,
+            "interval_s": width_s,
+            "timestamps": (df["Bucket"] // 1_000_000_000).tolist(),
+            "count": df["Count"].tolist(),
+            "series": {
+                column: {
+                    statistic: to_json_list(
+                        df[f"{column}_{statistic}"], PowerTimeSeries.decimals
+                    )
+                    for statistic in ("mean", "min", "max")
+                }
+                for column in PowerTimeSeries.columns
+            },
+        }
+
+    def get_spectra(self, db, params):
+        station = params.get("station", self.stations.primary_station)
+        start, end = self.get_time_range(params)
+
+        df = db.select_spectra_qoi(station, start, end, self.max_spectra_rows)
+
+        return {
+            "station": station,
+            "timestamps": df["Timestamp"].tolist(),
+            "series": {
+                column: to_json_list(df[column], 4)
+                for column in df.columns
+                if column != "Timestamp"
+            },
+            "is_truncated": len(df) == self.max_spectra_rows,
+        }
+
+    # Already JSON, returned as bytes
+    def get_power_matrix(self, db, params):
+        pto = params.get("pto", "Total_Power_kW")
+        window = params.get("window", "all")
+        if pto not in PowerTimeSeries.columns:
+            raise ValueError(f"pto must be one of {', '.join(PowerTimeSeries.columns)}")
+        if window not in self.power_matrix_windows:
+            raise ValueError(
+                f"window must be one of {', '.join(self.power_matrix_windows)}"
+            )
+
+        return self.file_manager.get_power_matrix_latest_filename(
+            pto, "json", window
+        ).read_bytes()
+
+    #  End Routes -----------------------------------------------------------}}}
+    #  Cache ----------------------------------------------------------------{{{
+
+    # Clear the cache when the database or the visualization files changed.
+    # Only the mtime of `visualization_dir` is checked, not of the files in it.
+    # That works because every file is written with `FileManager.write_atomic`,
+    # a rename into the directory, which changes the directory mtime. A file
+    # rewritten in place would be served from the cache until the next change
+    def check_version(self):
+        now = time.monotonic()
+        if now - self.version_checked_s < self.version_check_s:
+            return
+        self.version_checked_s = now
+
+        version = (
+            self.version_db.select_data_version(),
+            self.dirs.visualization_dir.stat().st_mtime_ns,
+        )
+        if version != self.version:
+            if self.version is not None:
+                self.logger.info(
+                    __name__, f"Data changed, dropping {len(self.cache)} responses"
+                )
+            self.cache.clear()
+            self.version = version
+
+    # Run `route` with a pooled connection, returns the response entry
+    def build_entry(self, route, params):
+        db = self.pool.get()
+        try:
+            body = route(db, params)
+        finally:
+            self.pool.put(db)
+
+        if isinstance(body, bytes) is False:
+            body = json.dumps(body, separators=(",", ":"), allow_nan=False).encode()
+
+        return {
+            "body": body,
+            "gzip_body": (
+                gzip.compress(body, compresslevel=6)
+                if len(body) >= self.min_gzip_bytes
+                else None
+            ),
+            "etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+        }
+
+    async def get_entry(self, key, route, params):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if key in self.in_flight:
+            return await asyncio.shield(self.in_flight[key])
+
+        version = self.version
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.build_entry, route, params
+        )
+        self.in_flight[key] = future
+        try:
+            entry = await future
+        finally:
+            del self.in_flight[key]
+
+        # A response built while the data changed may already be stale
+        if version == self.version:
+            self.cache[key] = entry
+            if len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+
+        return entry
+
+    #  End Cache ------------------------------------------------------------}}}
+    #  HTTP -----------------------------------------------------------------{{{
+
+    # (method, target, headers with lowercase names), None at the end of the
+    # connection
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if len(request_line) == 0:
+            return None
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError(f"Malformed request line {request_line!r}")
+
+        headers = {}
+        for _ in range(self.max_header_lines):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("Too many header lines")
+
+        # GET requests have no body, skip one if a client sends it anyway
+        content_length = int(headers.get("content-length", 0))
+        if content_length > 0:
+            await reader.readexactly(content_length)
+
+        return (parts[0], parts[1], headers)
+
+    def build_response(self, status, headers, body=b"", is_head=False):
+        status = HTTPStatus(status)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+        headers = {
+            "Content-Length": str(len(body)),
+            "Access-Control-Allow-Origin": "*",
+            **headers,
+        }
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        return head if is_head else head + body
+
+    def build_error(self, status, message, is_head=False):
+        body = json.dumps({"error": message}).encode()
+        return self.build_response(
+            status, {"Content-Type": "application/json"}, body, is_head
+        )
+
+    async def respond(self, method, target, headers):
+        is_head = method == "HEAD"
+        if method not in ("GET", "HEAD"):
+            return self.build_error(
+                HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not supported"
+            )
+
+        url = urlsplit(target)
+        route = self.routes.get(url.path)
+        if route is None:
+            return self.build_error(
+                HTTPStatus.NOT_FOUND, f"No route {url.path}", is_head
+            )
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        key = (url.path, tuple(sorted(params.items())))
+
+        try:
+            self.check_version()
+            entry = await self.get_entry(key, route, params)
+        except ValueError as e:
+            return self.build_error(HTTPStatus.BAD_REQUEST, str(e), is_head)
+        except FileNotFoundError:
+            return self.build_error(
+                HTTPStatus.NOT_FOUND, f"No data for {target}", is_head
+            )
+        except Exception as e:
+            self.logger.error(__name__, f"{target} failed with {e}")
+            return self.build_error(
+                HTTPStatus.INTERNAL_SERVER_ERROR, "Internal error", is_head
+            )
+
+        response_headers = {
+            "ETag": entry["etag"],
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+
+        if entry["etag"] in headers.get("if-none-match", ""):
+            return self.build_response(
+                HTTPStatus.NOT_MODIFIED, response_headers, is_head=True
+            )
+
+        response_headers["Content-Type"] = "application/json"
+        body = entry["body"]
+        if entry["gzip_body"] is not None and "gzip" in headers.get(
+            "accept-encoding", ""
+        ):
+            body = entry["gzip_body"]
+            response_headers["Content-Encoding"] = "gzip"
+
+        return self.build_response(HTTPStatus.OK, response_headers, body, is_head)
+
+    # Serve requests of one connection, kept alive until the client closes it
+    # or is idle for `request_timeout_s`
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        self.read_request(reader), self.request_timeout_s
+                    )
+                except ValueError as e:
+                    writer.write(self.build_error(HTTPStatus.BAD_REQUEST, str(e)))
+                    await writer.drain()
+                    break
+
+                if request is None:
+                    break
+
+                method, target, headers = request
+                writer.write(await self.respond(method, target, headers))
+                await writer.drain()
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port
+        )
+        self.logger.info(__name__, f"Serving on http://{self.host}:{self.port}")
+
+        async with server:
+            await server.serve_forever()
+
+    def serve(self):
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while self.pool.empty() is False:
+            self.pool.get().finish()
+        self.version_db.finish()
+
+    #  End HTTP -------------------------------------------------------------}}}
+
+
+if __name__ == "__main__":
+    DashboardAPI().serve()
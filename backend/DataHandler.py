@@ -1,11 +1,12 @@
 import pandas as pd
 
-from Logger import Logger
+from AppContext import AppContext
 
 
 class DataHandler:
-    def __init__(self):
-        self.log = Logger()
+    def __init__(self, context=None):
+        self.context = context or AppContext.get()
+        self.log = self.context.logger
 
     # Avoid database row duplication by uniquely insert timestamps into the
     # database. This works by first selecting timestamps in the database that match
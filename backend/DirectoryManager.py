@@ -8,9 +8,14 @@ from sys import platform
 #   1. Co-locates directory names for all other classes
 #   2. Allows the server and developer to use common functions and only hard codes the server directory in one place
 #   3. Creates directories that don't exist
+#
+# `base_dir` overrides the dashboard directory, for example with a temporary
+# one, see `AppContext.configure`
 class DirectoryManager:
-    def __init__(self):
-        if platform == "linux" or platform == "linux2":
+    def __init__(self, base_dir=None):
+        if base_dir is not None:
+            self.base_dir = Path(base_dir)
+        elif platform == "linux" or platform == "linux2":
             self.base_dir = Path("/home/nrel@oscillapower.local/dashboard")
         else:
             # We should be in the "backend" directory
@@ -28,7 +33,15 @@ class DirectoryManager:
         # Path can safely handle slashes in the filename
         self.triton_c = self.build_path(f"{self.data_dir}/triton_c")
         self.spectra_cdip_nc = self.build_path(f"{self.data_dir}/cdip_nc")
+        self.spectra_cdip_zarr = self.build_path(f"{self.data_dir}/cdip_zarr")
         self.spectra_calc = self.build_path(f"{self.data_dir}/spectra_calc_df")
+        self.spectral_density = self.build_path(f"{self.data_dir}/spectral_density")
+        self.power_matrix_accumulators = self.build_path(
+            f"{self.data_dir}/power_matrix_accumulators"
+        )
+        self.power_matrix_cache = self.build_path(f"{self.data_dir}/power_matrix_cache")
+        self.power_series = self.build_path(f"{self.data_dir}/power_series")
+        self.gps_track = self.build_path(f"{self.data_dir}/gps_track")
 
         # These are old directories that are used to populate data
         self.power_performance = self.build_path(f"{self.data_dir}/power_performance")
@@ -41,6 +54,10 @@ class DirectoryManager:
         self.visualization_archive_dir = self.build_path(
             f"{self.frontend_dir}/public/img/viz_archive"
         )
+        self.power_series_dir = self.build_path(
+            f"{self.frontend_dir}/public/power_series"
+        )
+        self.gps_track_dir = self.build_path(f"{self.frontend_dir}/public/gps_track")
 
     def build_base_path(self, dir_string):
         this_path = self.base_dir.joinpath(dir_string)
@@ -52,7 +69,7 @@ class DirectoryManager:
 
     def create_dir(self, path):
         if path.exists() is False:
-            path.mkdir()
+            path.mkdir(parents=True)
         return path
 
 
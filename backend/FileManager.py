@@ -1,5 +1,4 @@
-import shutil
-
+import os
 from datetime import datetime
 from pathlib import Path
 
@@ -8,8 +7,9 @@ from DataFrameArchiver import DataFrameArchiver
 
 
 class FileManager:
-    def __init__(self):
-        self.dirs = DirectoryManager()
+    # `dirs` is the `DirectoryManager` of the `AppContext`
+    def __init__(self, dirs=None):
+        self.dirs = dirs or DirectoryManager()
 
     def get_date_string(self):
         now = datetime.now()
@@ -57,14 +57,35 @@ class FileManager:
         path = self.dirs.spectra_cdip_nc
         return Path(path, filename)
 
-    def update_cdip_realtime_nc(self, new_ds, station):
-        filename = f"concat_{station}p1_rt.nc"
-        temp_filename = f"temp_{filename}"
-        path = self.dirs.spectra_cdip_nc
+    def get_cdip_realtime_zarr_path(self, station):
+        return Path(self.dirs.spectra_cdip_zarr, f"{station}p1_rt.zarr")
+
+    def get_spectral_density_dir(self, station):
+        path = Path(self.dirs.spectral_density, station)
+        path.mkdir(exist_ok=True)
+        return path
+
+    def get_power_matrix_accumulator_path(self, pto_name):
+        return Path(self.dirs.power_matrix_accumulators, f"{pto_name}.npz")
+
+    def get_power_matrix_cube_path(self, pto_name):
+        return Path(self.dirs.power_matrix_accumulators, f"{pto_name}_cube.f8")
+
+    def get_power_matrix_cache_path(self):
+        return Path(self.dirs.power_matrix_cache, "power_matrix_cache.json")
 
-        new_ds.to_netcdf(Path(path, temp_filename))
+    def get_power_series_state_path(self):
+        return Path(self.dirs.power_series, "power_series.npz")
 
-        shutil.move(Path(path, temp_filename), Path(path, filename))
+    # `level` is a `PowerTimeSeries.levels` name
+    def get_power_series_path(self, level):
+        return Path(self.dirs.power_series_dir, f"power_series_{level}.json")
+
+    def get_gps_track_state_path(self):
+        return Path(self.dirs.gps_track, "gps_track.npz")
+
+    def get_gps_track_path(self):
+        return Path(self.dirs.gps_track_dir, "gps_track.geojson")
 
     def save_spectra_calc(self, df, station, first_timestamp, last_timestamp):
         path = self.dirs.spectra_calc
@@ -72,15 +93,22 @@ class FileManager:
             "spectra_calc", path, df, station, first_timestamp, last_timestamp
         )
 
-    def get_power_matrix_latest_filename(self, pto_name, image_format):
+    # `window` is a `PowerMatrixAccumulator.get_window` window, the all time
+    # matrix keeps the original filename
+    def get_power_matrix_latest_filename(self, pto_name, image_format, window="all"):
+        if window != "all":
+            pto_name = f"{pto_name}_{window}"
+
         return Path(
             self.dirs.visualization_dir,
             f"{pto_name}_power_matrix_latest.{image_format}",
         )
 
-    def archive_last_power_matrix(self, pto_name, image_format, start, end):
+    def archive_last_power_matrix(
+        self, pto_name, image_format, start, end, window="all"
+    ):
         existing_power_matrix = self.get_power_matrix_latest_filename(
-            pto_name, image_format
+            pto_name, image_format, window
         ).name
         archive_dir = self.dirs.visualization_archive_dir
 
@@ -89,9 +117,27 @@ class FileManager:
             existing_power_matrix.replace("latest", f"archive_{start}-{end}"),
         )
 
+    # Call `write` with a temporary path next to `path`, then rename it to
+    # `path`. The frontend serves the visualization directory, this way it
+    # never serves a partially written file
+    def write_atomic(self, path, write):
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    # Total size in bytes of the existing files of `paths`
+    def get_total_size(self, paths):
+        return sum(Path(path).stat().st_size for path in paths if Path(path).exists())
+
     def get_log_filepath(self):
         return self.get_filepath_that_may_not_exist(
-            self.dirs.log_dir, "Triton_C_Backend_Processes.log"
+            self.dirs.log_dir, "Triton_C_Backend_Processes.jsonl"
         )
 
     def get_db_filepath(self):
@@ -0,0 +1,441 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from AppContext import AppContext
+
+EARTH_RADIUS_M = 6_371_000
+
+
+# East and north offsets in meters of positions from a reference position. An
+# equirectangular projection, accurate to well under a meter over the few km
+# a moored WEC or a tow covers
+def to_meters(lat, lng, ref_lat, ref_lng):
+    x = np.radians(np.asarray(lng) - ref_lng) * np.cos(np.radians(ref_lat))
+    y = np.radians(np.asarray(lat) - ref_lat)
+    return (x * EARTH_RADIUS_M, y * EARTH_RADIUS_M)
+
+
+# Douglas-Peucker simplification of the polyline (x, y). Returns a mask of the
+# vertices to keep, the first and last are always kept. Iterative, so long
+# tracks don't hit the recursion limit
+def douglas_peucker(x, y, tolerance):
+    num_points = len(x)
+    keep = np.zeros(num_points, dtype=bool)
+    if num_points == 0:
+        return keep
+
+    keep[0] = keep[-1] = True
+    stack = [(0, num_points - 1)]
+    while len(stack) > 0:
+        start, end = stack.pop()
+        if end <= start + 1:
+            continue
+
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        px = x[start + 1 : end] - x[start]
+        py = y[start + 1 : end] - y[start]
+
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return keep
+
+
+# Simplified WEC GPS track for the dashboard's `WECLocationMap`.
+#
+# Every triton_c row carries a GPS position, mostly jitter around the mooring.
+# Positions are compressed in two stages:
+#   1. Dwell: consecutive positions within `dwell_radius_m` of the first
+#      position of a dwell are one vertex, at their mean position and the time
+#      of the first. A moored WEC swinging in its watch circle is a few
+#      vertices per day
+#   2. Douglas-Peucker: dwell vertices that are within `tolerance_m` of the
+#      line through their neighbours are dropped
+#
+# Both stages run incrementally. New positions after `watermark_ns` extend
+# the open dwell or close it. Closed dwell vertices collect in a tail. Each
+# block of `max_tail_vertices` tail vertices is simplified and appended to the
+# finalized track, so a run simplifies at most a block instead of the full
+# history. Positions stored with a Timestamp before the watermark are not
+# folded, `rebuild` folds every position again, see
+# `Runner.rebuild_power_series`.
+#
+# The track and the latest position are written as a GeoJSON
+# FeatureCollection to `DirectoryManager.gps_track_dir`, a LineString with
+# the unix epoch seconds of each vertex in its "timestamps" property and a
+# Point with the "timestamp" of the latest position.
+class GPSTrack:
+    version = 1
+
+    # The mooring watch circle, see `WECLocationMap`. Well above the GPS
+    # jitter, so noise alone never closes a dwell
+    dwell_radius_m = 30.0
+    tolerance_m = 10.0
+    max_tail_vertices = 1000
+
+    # Rows read from the database at once, bounds memory on the first run
+    chunk_rows = 500_000
+
+    # Positions compared to a dwell's first position at once
+    dwell_batch = 4096
+
+    # 6 decimals of a degree are about 0.1 m
+    decimals = 6
+
+    def __init__(self, context=None):
+        context = context or AppContext.get()
+
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.path = self.file_manager.get_gps_track_state_path()
+
+        self.reset()
+
+    def reset(self):
+        # Finalized and tail vertices as dicts of "ns", "lat" and "lng" arrays
+        self.track = self.get_empty_vertices()
+        self.tail = self.get_empty_vertices()
+
+        # Open dwell, None before the first position
+        self.dwell = None
+
+        # (Timestamp, lat, lng) of the last folded position
+        self.latest = None
+
+        self.watermark_ns = None
+
+    def get_empty_vertices(self):
+        return {
+            "ns": np.array([], dtype=np.int64),
+            "lat": np.array([]),
+            "lng": np.array([]),
+        }
+
+    def concat_vertices(self, *vertices_list):
+        return {
+            key: np.concatenate([vertices[key] for vertices in vertices_list])
+            for key in ("ns", "lat", "lng")
+        }
+
+    def slice_vertices(self, vertices, index):
+        return {key: values[index] for key, values in vertices.items()}
+
+    def load(self):
+        if self.path.exists() is False:
+            return False
+
+        with np.load(self.path) as state:
+            for name in ("track", "tail"):
+                setattr(
+                    self,
+                    name,
+                    {key: state[f"{name}_{key}"] for key in ("ns", "lat", "lng")},
+                )
+
+            first_ns, last_ns, count = state["dwell_ns"].tolist()
+            if count > 0:
+                sum_lat, sum_lng, anchor_lat, anchor_lng = state[
+                    "dwell_position"
+                ].tolist()
+                self.dwell = {
+                    "first_ns": first_ns,
+                    "last_ns": last_ns,
+                    "count": count,
+                    "sum_lat": sum_lat,
+                    "sum_lng": sum_lng,
+                    "anchor_lat": anchor_lat,
+                    "anchor_lng": anchor_lng,
+                }
+
+            latest_ns = int(state["latest_ns"])
+            if latest_ns >= 0:
+                lat, lng = state["latest_position"].tolist()
+                self.latest = (latest_ns, lat, lng)
+
+            watermark_ns = int(state["watermark_ns"])
+            self.watermark_ns = None if watermark_ns < 0 else watermark_ns
+
+        return True
+
+    # Write to a temporary file then rename, so a crash never leaves a
+    # partially written state behind. npz can't hold None, -1 stands in for
+    # "not set"
+    def save(self):
+        arrays = {}
+        for name in ("track", "tail"):
+            for key, values in getattr(self, name).items():
+                arrays[f"{name}_{key}"] = values
+
+        dwell = self.dwell
+        if dwell is None:
+            arrays["dwell_ns"] = np.array([-1, -1, 0], dtype=np.int64)
+            arrays["dwell_position"] = np.full(4, np.nan)
+        else:
+            arrays["dwell_ns"] = np.array(
+                [dwell["first_ns"], dwell["last_ns"], dwell["count"]], dtype=np.int64
+            )
+            arrays["dwell_position"] = np.array(
+                [
+                    dwell["sum_lat"],
+                    dwell["sum_lng"],
+                    dwell["anchor_lat"],
+                    dwell["anchor_lng"],
+                ]
+            )
+
+        if self.latest is None:
+            arrays["latest_ns"] = np.int64(-1)
+            arrays["latest_position"] = np.full(2, np.nan)
+        else:
+            arrays["latest_ns"] = np.int64(self.latest[0])
+            arrays["latest_position"] = np.array(self.latest[1:])
+
+        arrays["watermark_ns"] = np.int64(
+            -1 if self.watermark_ns is None else self.watermark_ns
+        )
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+
+        self.file_manager.write_atomic(self.path, write)
+
+    # The vertex of a dwell, its mean position at the time of its first position
+    def get_dwell_vertex(self, dwell):
+        return {
+            "ns": np.array([dwell["first_ns"]], dtype=np.int64),
+            "lat": np.array([dwell["sum_lat"] / dwell["count"]]),
+            "lng": np.array([dwell["sum_lng"] / dwell["count"]]),
+        }
+
+    # Add sorted positions newer than the watermark
+    def fold(self, timestamps_ns, lat, lng):
+        num_points = len(timestamps_ns)
+        if num_points == 0:
+            return
+
+        closed = []
+        i = 0
+        while i < num_points:
+            if self.dwell is None:
+                self.dwell = {
+                    "first_ns": int(timestamps_ns[i]),
+                    "last_ns": int(timestamps_ns[i]),
+                    "count": 1,
+                    "sum_lat": float(lat[i]),
+                    "sum_lng": float(lng[i]),
+                    "anchor_lat": float(lat[i]),
+                    "anchor_lng": float(lng[i]),
+                }
+                i += 1
+                continue
+
+            # Positions up to the first one outside the dwell belong to it
+            end = min(i + self.dwell_batch, num_points)
+            x, y = to_meters(
+                lat[i:end],
+                lng[i:end],
+                self.dwell["anchor_lat"],
+                self.dwell["anchor_lng"],
+            )
+            outside = np.flatnonzero(np.hypot(x, y) > self.dwell_radius_m)
+            j = i + int(outside[0]) if len(outside) > 0 else end
+
+            if j > i:
+                self.dwell["count"] += j - i
+                self.dwell["sum_lat"] += float(np.sum(lat[i:j]))
+                self.dwell["sum_lng"] += float(np.sum(lng[i:j]))
+                self.dwell["last_ns"] = int(timestamps_ns[j - 1])
+
+            # Position j left the dwell, it starts the next one
+            if j < end:
+                closed.append(self.get_dwell_vertex(self.dwell))
+                self.dwell = None
+
+            i = j
+
+        if len(closed) > 0:
+            self.tail = self.concat_vertices(self.tail, *closed)
+            while len(self.tail["ns"]) >= self.max_tail_vertices:
+                self.finalize_tail()
+
+        self.latest = (int(timestamps_ns[-1]), float(lat[-1]), float(lng[-1]))
+        self.watermark_ns = int(timestamps_ns[-1])
+
+    # Douglas-Peucker mask of `vertices`
+    def simplify(self, vertices):
+        if len(vertices["ns"]) == 0:
+            return np.zeros(0, dtype=bool)
+
+        x, y = to_meters(
+            vertices["lat"], vertices["lng"], vertices["lat"][0], vertices["lng"][0]
+        )
+        return douglas_peucker(x, y, self.tolerance_m)
+
+    # Simplify `vertices` continuing from the last finalized vertex. Returns
+    # the mask of `vertices` to keep
+    def simplify_after_track(self, vertices):
+        anchor = self.slice_vertices(self.track, slice(-1, None))
+        return self.simplify(self.concat_vertices(anchor, vertices))[
+            len(anchor["ns"]) :
+        ]
+
+    # Simplify the first `max_tail_vertices` of the tail and move them, all
+    # but the last, to the track. Blocks only depend on the order of the
+    # vertices, so the track is the same however the positions were batched
+    def finalize_tail(self):
+        block_end = self.max_tail_vertices - 1
+        block = self.slice_vertices(self.tail, slice(None, block_end + 1))
+        kept = np.flatnonzero(self.simplify_after_track(block))
+
+        self.track = self.concat_vertices(
+            self.track, self.slice_vertices(block, kept[:-1])
+        )
+        self.tail = self.slice_vertices(self.tail, slice(block_end, None))
+
+    # The simplified track including the open dwell
+    def get_vertices(self):
+        rest = self.tail
+        if self.dwell is not None:
+            rest = self.concat_vertices(rest, self.get_dwell_vertex(self.dwell))
+
+        return self.concat_vertices(
+            self.track, self.slice_vertices(rest, self.simplify_after_track(rest))
+        )
+
+    def to_timestamp(self, timestamp_ns):
+        return pd.Timestamp(timestamp_ns, unit="ns", tz="UTC").strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+
+    def to_geojson(self):
+        features = []
+
+        vertices = self.get_vertices()
+        if len(vertices["ns"]) >= 2:
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "LineString",
+                        "coordinates": np.column_stack(
+                            [vertices["lng"], vertices["lat"]]
+                        )
+                        .round(self.decimals)
+                        .tolist(),
+                    },
+                    "properties": {
+                        "name": "track",
+                        "timestamps": (vertices["ns"] // 1_000_000_000).tolist(),
+                    },
+                }
+            )
+
+        if self.latest is not None:
+            timestamp_ns, lat, lng = self.latest
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [
+                            round(lng, self.decimals),
+                            round(lat, self.decimals),
+                        ],
+                    },
+                    "properties": {
+                        "name": "latest",
+                        "timestamp": self.to_timestamp(timestamp_ns),
+                    },
+                }
+            )
+
+        return {
+            "type": "FeatureCollection",
+            "version": self.version,
+            "features": features,
+        }
+
+    # Write the GeoJSON atomically, returns its path
+    def write(self):
+        path = self.file_manager.get_gps_track_path()
+        content = json.dumps(self.to_geojson(), separators=(",", ":"), allow_nan=False)
+        self.file_manager.write_atomic(
+            path, lambda tmp_path: tmp_path.write_text(content)
+        )
+        return path
+
+    # Fold every position after the watermark, a page of `chunk_rows` at a
+    # time. Returns the number of folded positions
+    def update_from_db(self, db):
+        num_rows = 0
+        while True:
+            df = db.select_triton_c_gps_after(
+                -1 if self.watermark_ns is None else self.watermark_ns,
+                self.chunk_rows,
+            )
+            if df.empty:
+                break
+
+            self.fold(
+                df["Timestamp"].to_numpy(dtype=np.int64),
+                df["GPS_Lat"].to_numpy(dtype=np.float64),
+                df["GPS_Lng"].to_numpy(dtype=np.float64),
+            )
+            num_rows += len(df)
+
+            if len(df) < self.chunk_rows:
+                break
+
+        return num_rows
+
+    # Fold the new positions of the `triton_c` table of `db` and rewrite the
+    # GeoJSON. Nothing is written when there are no new positions. Returns the
+    # number of folded positions
+    def update(self, db):
+        if self.load() is False:
+            self.reset()
+
+        num_rows = self.update_from_db(db)
+        if num_rows == 0:
+            self.logger.info(__name__, "No new GPS positions, GPS track unchanged")
+            return num_rows
+
+        self.save()
+        path = self.write()
+        self.logger.info(
+            __name__,
+            f"Folded {num_rows} GPS positions into the track",
+            rows=num_rows,
+            bytes=self.file_manager.get_total_size([path]),
+        )
+        return num_rows
+
+    # Fold every stored position again, picks up rows stored with a Timestamp
+    # before the watermark. Returns the number of folded positions
+    def rebuild(self, db):
+        self.reset()
+        num_rows = self.update_from_db(db)
+        self.save()
+        self.write()
+        return num_rows
+
+
+if __name__ == "__main__":
+    track = GPSTrack()
+    track.update(AppContext.get().db)
+    print(len(track.get_vertices()["ns"]), track.latest)
@@ -1,25 +1,241 @@
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import util
+from sys import platform
 
 from FileManager import FileManager
 
+# POSIX only. On Windows, a development setup, rollovers are not locked across
+# processes, see `SharedRotatingFileHandler`
+if platform == "win32":
+    fcntl = None
+else:
+    import fcntl
+
+
+# One JSON object per line. Records of `Logger` have the module that logged
+# them and their structured fields, records of other libraries the logger name
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "module": getattr(record, "source", record.name),
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+
+        return json.dumps(entry, default=str)
+
+
+# A `RotatingFileHandler` that several processes can share. The cron jobs and
+# the dashboard API all log to the same file, with a plain
+# `RotatingFileHandler` each of them renames it when it sees it full, so one
+# rollover turns into several and backups are overwritten.
+#
+# Here a rollover holds an exclusive lock on `<log>.lock`, and a process first
+# checks whether the log file is still the one it has open. If another process
+# already rotated it, the new file is reopened instead of rotated again.
+# Records written to the old file in between end up in the first backup.
+# Without fcntl the check is still made, but two processes can race.
+class SharedRotatingFileHandler(RotatingFileHandler):
+    def is_rotated(self):
+        try:
+            current = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.stream.fileno())
+        return (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        if self.stream is not None and self.is_rotated():
+            self.reopen()
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if fcntl is None:
+            self.rotate_once()
+            return
 
+        with open(self.baseFilename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.rotate_once()
+
+    # Rotate the log file, unless another process already did
+    def rotate_once(self):
+        if self.stream is not None and self.is_rotated():
+            self.reopen()
+        else:
+            super().doRollover()
+
+
+# Built once per process by `AppContext`, which sets up logging to the log file
+# of its directory.
+#
+# Logging calls only put the record on a queue, a `QueueListener` thread
+# formats and writes it, so a job never waits on the log file. The file is JSON
+# lines, rotated by size:
+#
+#   {"time": "2024-05-01T10:00:00.123+00:00", "level": "INFO",
+#    "module": "Runner", "message": "Finished update_power_series!",
+#    "stage": "update_power_series", "duration_s": 0.012, "rows": 1200}
+#
+# `stage`, `duration_s`, `rows` and `bytes` are the fields of `timed`, any
+# keyword argument of `info`, `warning` and `error` is written as a field.
+#
+# Pool workers don't open the log file, their records go to the listener of
+# the process that started the pool, see `get_worker_queue`. Processes started
+# on their own share the file through `SharedRotatingFileHandler`.
 class Logger:
-    def __init__(self):
-        self.file_manager = FileManager()
-
-        logging.basicConfig(
-            filename=self.file_manager.get_log_filepath(),
-            filemode="a",
-            format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
-            datefmt="%Y_%m_%d-%H:%M:%S",
-            level=logging.INFO,
+    max_bytes = 10 * 1024 * 1024
+    backup_count = 5
+
+    # The listeners writing the records of this process and of its pool
+    # workers, and the process that started them
+    listeners = []
+    listeners_pid = None
+
+    # The queue pool workers of this process send their records to
+    worker_queue = None
+
+    # In a pool worker, the queue of the process that started the pool
+    parent_queue = None
+
+    def __init__(self, file_manager=None):
+        self.file_manager = file_manager or FileManager()
+
+        # An `AppContext` built in a pool worker
+        if Logger.parent_queue is not None:
+            Logger.send_to(Logger.parent_queue)
+            return
+
+        handler = SharedRotatingFileHandler(
+            self.file_manager.get_log_filepath(),
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            encoding="utf-8",
         )
+        handler.setFormatter(JsonLinesFormatter())
+
+        # Replaces the handlers of an earlier `Logger`
+        Logger.stop_listeners()
+        records = queue.SimpleQueue()
+        Logger.send_to(records)
+
+        Logger.listeners = [QueueListener(records, handler)]
+        Logger.listeners_pid = os.getpid()
+        Logger.listeners[0].start()
+
+        # Flush the queues at exit, multiprocessing finalizers also run when a
+        # worker process exits, atexit handlers don't
+        util.Finalize(None, Logger.stop_listeners, exitpriority=0)
+
+    # Log every record of this process to `records`, the root logger also gets
+    # the records of libraries
+    @staticmethod
+    def send_to(records):
+        queue_handler = QueueHandler(records)
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        logging.basicConfig(handlers=[queue_handler], level=logging.INFO, force=True)
+
+    # The queue for the records of pool workers, written by the log file
+    # handler of this process. Pass it to `init_worker` as the pool initializer:
+    #
+    #   ProcessPoolExecutor(
+    #       initializer=Logger.init_worker,
+    #       initargs=(self.logger.get_worker_queue(),),
+    #   )
+    def get_worker_queue(self):
+        if Logger.parent_queue is not None:
+            return Logger.parent_queue
+
+        if Logger.worker_queue is None:
+            Logger.worker_queue = multiprocessing.Queue()
+            listener = QueueListener(Logger.worker_queue, *Logger.listeners[0].handlers)
+            listener.start()
+            Logger.listeners.append(listener)
+
+        return Logger.worker_queue
 
-    def info(self, module, message):
-        logging.info(f"{module}: {message}")
+    # Runs first in every pool worker, sends its records to `records`. The
+    # log file handler of a `Logger` built before, by unpickling an
+    # `AppContext`, is closed before it writes anything
+    @classmethod
+    def init_worker(cls, records):
+        cls.stop_listeners()
+        cls.parent_queue = records
+        cls.send_to(records)
 
-    def warning(self, module, message):
-        logging.warning(f"{module}: {message}")
+    # Write the queued records and close the log file
+    @classmethod
+    def stop_listeners(cls):
+        listeners = cls.listeners
+        cls.listeners = []
+        cls.worker_queue = None
 
-    def error(self, module, message):
-        logging.error(f"{module}: {message}")
+        # Copies of the listeners of the parent in a forked process, their
+        # threads don't run here and the worker queue is still the parent's
+        if cls.listeners_pid != os.getpid():
+            return
+
+        for listener in listeners:
+            listener.stop()
+        for handler in {h for listener in listeners for h in listener.handlers}:
+            handler.close()
+
+    def log(self, level, module, message, fields):
+        logging.log(level, str(message), extra={"source": module, "fields": fields})
+
+    def info(self, module, message, **fields):
+        self.log(logging.INFO, module, message, fields)
+
+    def warning(self, module, message, **fields):
+        self.log(logging.WARNING, module, message, fields)
+
+    def error(self, module, message, **fields):
+        self.log(logging.ERROR, module, message, fields)
+
+    # Log the start and end of `stage`, the end with its duration and the
+    # fields set on the yielded dict:
+    #
+    #   with self.logger.timed(__name__, "update_power_series") as fields:
+    #       fields["rows"] = PowerTimeSeries().update(db)
+    #
+    # An exception is logged with the duration and raised again
+    @contextmanager
+    def timed(self, module, stage, **fields):
+        self.info(module, f"Starting {stage}...", stage=stage)
+        start = time.perf_counter()
+        try:
+            yield fields
+        except Exception as e:
+            self.error(
+                module,
+                f"{stage} failed with {e!r}",
+                stage=stage,
+                duration_s=round(time.perf_counter() - start, 3),
+                **fields,
+            )
+            raise
+
+        self.info(
+            module,
+            f"Finished {stage}!",
+            stage=stage,
+            duration_s=round(time.perf_counter() - start, 3),
+            **fields,
+        )
@@ -1,22 +1,48 @@
+import re
+
+import numpy as np
 import pandas as pd
 import requests
 
-from Logger import Logger
+from AppContext import AppContext
+from SpectraQOICalculator import SpectraQOICalculator
 
 
 # Download and parse NDBC real time raw spectral wave data into pandas
 # DataFrame
+#
+# Example data_spec file:
+# #YY  MM DD hh mm Sep_Freq  < spec_1 (freq_1) spec_2 (freq_2) spec_3 (freq_3) ... >
+# 2024 09 19 20 00 9.999 0.000 (0.020) 0.000 (0.025) 0.000 (0.030) ...
+# 2024 09 19 19 30 9.999 0.000 (0.020) 0.000 (0.025) 0.000 (0.030) ...
+#
+# Every row of a file shares the same frequency grid, so the frequencies are
+# parsed once from the first row. The brackets are then blanked out of the
+# whole file and every number is parsed in a single pass into a
+# (time x (metadata + 2 * freq)) array, where the spectra are every other
+# column after the metadata
 class NDBCRealTimeRawSpectralParser:
-    def __init__(self, station_id):
+    def __init__(self, station_id, context=None):
+        context = context or AppContext.get()
+
         self.station_id = station_id
         self.realtime_raw_spectral_wave_data_url = (
             f"https://www.ndbc.noaa.gov/data/realtime2/{station_id}.data_spec"
         )
-        self.logger = Logger()
+        self.logger = context.logger
+        self.session = context.session
+
+        # YY MM DD hh mm Sep_Freq
+        self.num_metadata_columns = 6
+
+        self.comment_regex = re.compile(r"^#[^\n]*\n?", re.MULTILINE)
+        self.frequency_regex = re.compile(r"\(([^)]*)\)")
+        self.missing_value_regex = re.compile(r"\bMM\b")
+        self.bracket_table = str.maketrans("()", "  ")
 
     def request_latest(self):
         try:
-            result = requests.get(self.realtime_raw_spectral_wave_data_url)
+            result = self.session.get(self.realtime_raw_spectral_wave_data_url)
         except requests.RequestException as e:
             result = None
             self.logger.error(
@@ -27,40 +53,84 @@ class NDBCRealTimeRawSpectralParser:
         if result != None:
             return result.text
 
-    def parse_latest_spec_file(self):
-        raw_spec_file = self.request_latest()
-        rows = []
-        raw_timestamps = []
-        columns = []
-
-        if raw_spec_file is not None:
-            spec = raw_spec_file.split("\n")
-
-            for i in range(1, len(spec)):
-                this_spec = spec[i].split(" ")
-
-                if len(this_spec) > 1:
-                    metadata = this_spec[0:6]
-                    spectra = [float(x) for x in this_spec[6:-2:2]]
-                    spectra_freq = this_spec[7::2]
-                    spectra_freq = [
-                        x.replace("(", "").replace(")", "") for x in spectra_freq
-                    ]
-                    spectra_freq = [float(x) for x in spectra_freq]
-                    this_raw_timestamp = f"{metadata[0]}-{metadata[1]}-{metadata[2]}-{metadata[3]}:{metadata[4]}:00"
-                    raw_timestamps.append(this_raw_timestamp)
-                    columns = spectra_freq
-                    rows.append(spectra)
+    # Returns a DataFrame of spectral energy density (m^2/Hz) with one row per
+    # timestamp and one column per frequency (Hz) and a list of raw timestamp
+    # strings. The index is unix epoch ns integers named "Timestamp"
+    def parse_spec_text(self, raw_spec_file):
+        body = self.comment_regex.sub("", raw_spec_file).strip()
+
+        if len(body) == 0:
+            return (self.empty_spectra_df(), [])
+
+        first_row = body[: body.find("\n")] if "\n" in body else body
+        frequencies = np.array(self.frequency_regex.findall(first_row), dtype=float)
+
+        num_columns = self.num_metadata_columns + 2 * len(frequencies)
+        num_rows = body.count("\n") + 1
+
+        body = body.translate(self.bracket_table)
+        if "MM" in body:
+            body = self.missing_value_regex.sub("nan", body)
+
+        values = np.fromstring(body, dtype=float, sep=" ")
+
+        if values.size != num_rows * num_columns:
+            self.logger.error(
+                __name__,
+                f"{self.realtime_raw_spectral_wave_data_url} rows do not share one frequency grid, expected {num_rows * num_columns} values and parsed {values.size}",
+            )
+            return (self.empty_spectra_df(), [])
+
+        values = values.reshape(num_rows, num_columns)
+
+        # YY MM DD hh mm to datetime64 without going through strings
+        time_parts = values[:, :5].astype(np.int64)
+        months = (time_parts[:, 0] - 1970) * 12 + time_parts[:, 1] - 1
+        timestamps = (
+            months.astype("datetime64[M]").astype("datetime64[D]")
+            + (time_parts[:, 2] - 1).astype("timedelta64[D]")
+            + time_parts[:, 3].astype("timedelta64[h]")
+            + time_parts[:, 4].astype("timedelta64[m]")
+        ).astype("datetime64[ns]")
 
         df = pd.DataFrame(
-            data=rows,
-            columns=columns,
+            data=values[:, self.num_metadata_columns :: 2],
+            columns=frequencies,
         )
-        df.index = pd.to_numeric(pd.to_datetime(raw_timestamps))
-        df.index.name = "Timestamp"
+        df.index = pd.Index(timestamps.astype(np.int64), name="Timestamp")
+
+        raw_timestamps = np.char.add(
+            np.char.replace(np.datetime_as_string(timestamps, unit="m"), "T", "-"),
+            ":00",
+        ).tolist()
 
         return (df, raw_timestamps)
 
+    def parse_latest_spec_file(self):
+        raw_spec_file = self.request_latest()
+
+        if raw_spec_file is None:
+            return (self.empty_spectra_df(), [])
+
+        return self.parse_spec_text(raw_spec_file)
+
+    # Calculate the same QOI columns that CDIPRealTimeParser produces from a
+    # DataFrame returned by `parse_spec_text`. NDBC files don't carry the water
+    # depth, so it comes from the station registry
+    def calculate_qoi(self, spectra_df, depth):
+        df = spectra_df.sort_index()
+        df.index = pd.to_datetime(df.index, unit="ns", utc=True)
+
+        calculator = SpectraQOICalculator()
+        result_df = calculator.calculate(df, depth)
+
+        return calculator.index_by_unix_seconds(result_df)
+
+    def empty_spectra_df(self):
+        df = pd.DataFrame()
+        df.index.name = "Timestamp"
+        return df
+
 
 if __name__ == "__main__":
     parser = NDBCRealTimeRawSpectralParser("51210")
@@ -0,0 +1,299 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from AppContext import AppContext
+from PowerMatrixBins import PowerMatrixBins
+from PowerMatrixCube import PowerMatrixCube
+
+
+# Mergeable power matrix statistics for one PTO, persisted between runs.
+#
+# Each half-hour interval matched to a spectrum adds its power (P), capture
+# length (L) and energy flux (J) to a fixed Hm0/Te grid as a count, a sum and a
+# sum of squares per bin. Folding new intervals is O(new intervals) and the
+# mean power matrix is O(bins), so updates cost the same at any deployment
+# length. Two accumulators over disjoint intervals merge by adding their arrays.
+#
+# The fixed grid covers Hm0 <= 10 m and Te <= 30 s, values outside it fall in
+# the outer bins. Matrices are trimmed to the grid `PowerMatrixBins.from_data`
+# would build from the folded intervals, so they match a batch recompute.
+#
+# `watermark_ns` is the start of the first interval that may still change:
+# every interval before it has been folded or given up on. Intervals at or
+# after it that have already been folded are kept in `folded_ns`, so a later
+# run only folds intervals it hasn't seen.
+#
+# The same statistics are also kept per UTC day in a `PowerMatrixCube`, so
+# matrices of time windows (the last 1, 7 or 30 UTC days or a month) need no
+# recompute.
+class PowerMatrixAccumulator:
+    quantities = ("P", "L", "J")
+
+    def __init__(self, pto_name, context=None):
+        context = context or AppContext.get()
+
+        self.pto_name = pto_name
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.bins = PowerMatrixBins.fixed()
+        self.path = self.file_manager.get_power_matrix_accumulator_path(pto_name)
+        self.cube = PowerMatrixCube(pto_name, self.bins, self.quantities, context)
+
+        self.reset()
+
+    def reset(self):
+        self.count = np.zeros(self.bins.size, dtype=np.int64)
+        self.sums = {q: np.zeros(self.bins.size) for q in self.quantities}
+        self.sumsqs = {q: np.zeros(self.bins.size) for q in self.quantities}
+
+        # Largest folded Hm0 and Te, used to trim the fixed grid
+        self.max_Hm0 = np.nan
+        self.max_Te = np.nan
+
+        # Unix epoch ns starts of the first and last folded intervals
+        self.first_ns = None
+        self.last_ns = None
+
+        self.watermark_ns = None
+        self.folded_ns = np.array([], dtype=np.int64)
+
+        self.cube.reset()
+
+    def is_empty(self):
+        return self.count.sum() == 0
+
+    def load(self):
+        if self.path.exists() is False:
+            return False
+
+        with np.load(self.path) as state:
+            if state["bins_shape"].tolist() != list(self.bins.shape):
+                self.logger.warning(
+                    __name__,
+                    f"{self.path} uses a different bin grid, ignoring it. Rebuild the accumulators",
+                )
+                return False
+
+            self.count = state["count"]
+            for q in self.quantities:
+                self.sums[q] = state[f"sum_{q}"]
+                self.sumsqs[q] = state[f"sumsq_{q}"]
+
+            self.max_Hm0 = float(state["max_Hm0"])
+            self.max_Te = float(state["max_Te"])
+            self.first_ns = self.get_optional_ns(state["first_ns"])
+            self.last_ns = self.get_optional_ns(state["last_ns"])
+            self.watermark_ns = self.get_optional_ns(state["watermark_ns"])
+            self.folded_ns = state["folded_ns"]
+
+            if "cube_first_day" in state:
+                cube_first_day = self.get_optional_ns(state["cube_first_day"])
+                cube_num_days = int(state["cube_num_days"])
+
+                # The cube is written after this file, replay its rows if a
+                # crash came in between
+                if "cube_rows" in state and self.cube.replay(
+                    cube_first_day,
+                    cube_num_days,
+                    int(state["cube_start_row"]),
+                    state["cube_rows"],
+                ):
+                    self.logger.warning(
+                        __name__,
+                        f"{self.pto_name} power matrix cube was behind the accumulator, replayed its last save",
+                    )
+
+                self.cube.load(cube_first_day, cube_num_days)
+
+        if self.cube.get_last_row()[0].sum() != self.count.sum():
+            self.logger.warning(
+                __name__,
+                f"{self.pto_name} power matrix cube does not match the accumulator, window matrices are wrong until the accumulators are rebuilt",
+            )
+
+        return True
+
+    # Write to a temporary file then rename, so a crash never leaves a
+    # partially written state behind. The new cube rows go in the same file
+    # and are written to the cube after it, `load` replays them if that write
+    # didn't happen
+    def save(self):
+        cube_rows = self.cube.prepare()
+        if cube_rows is None:
+            cube_first_day, cube_num_days = self.cube.first_day, self.cube.num_days
+        else:
+            cube_first_day, cube_num_days = cube_rows[:2]
+
+        arrays = {
+            "bins_shape": np.array(self.bins.shape),
+            "count": self.count,
+            "max_Hm0": np.float64(self.max_Hm0),
+            "max_Te": np.float64(self.max_Te),
+            "first_ns": self.set_optional_ns(self.first_ns),
+            "last_ns": self.set_optional_ns(self.last_ns),
+            "watermark_ns": self.set_optional_ns(self.watermark_ns),
+            "folded_ns": self.folded_ns,
+            "cube_first_day": self.set_optional_ns(cube_first_day),
+            "cube_num_days": np.int64(cube_num_days),
+        }
+        if cube_rows is not None:
+            arrays["cube_start_row"] = np.int64(cube_rows[2])
+            arrays["cube_rows"] = cube_rows[3]
+        for q in self.quantities:
+            arrays[f"sum_{q}"] = self.sums[q]
+            arrays[f"sumsq_{q}"] = self.sumsqs[q]
+
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+        if cube_rows is not None:
+            self.cube.apply(*cube_rows)
+
+    # npz can't hold None, -1 stands in for "not set". Also used for days
+    def get_optional_ns(self, value):
+        value = int(value)
+        return None if value < 0 else value
+
+    def set_optional_ns(self, value):
+        return np.int64(-1 if value is None else value)
+
+    # Intervals in `interval_ns` that have not been folded yet
+    def get_unfolded(self, interval_ns):
+        is_unfolded = ~np.isin(interval_ns, self.folded_ns)
+        if self.watermark_ns is not None:
+            is_unfolded &= interval_ns >= self.watermark_ns
+        return is_unfolded
+
+    # Add matched intervals. All arrays have one value per interval
+    def fold(self, interval_ns, Hm0, Te, P, L, J):
+        if len(interval_ns) == 0:
+            return
+
+        bin_indices = self.bins.get_bin_indices(Hm0, Te)
+
+        self.count += np.bincount(bin_indices, minlength=self.bins.size)
+        for q, values in zip(self.quantities, (P, L, J)):
+            self.sums[q] += np.bincount(
+                bin_indices, weights=values, minlength=self.bins.size
+            )
+            self.sumsqs[q] += np.bincount(
+                bin_indices, weights=values * values, minlength=self.bins.size
+            )
+
+        self.max_Hm0 = np.nanmax([self.max_Hm0, np.max(Hm0)])
+        self.max_Te = np.nanmax([self.max_Te, np.max(Te)])
+
+        first_ns = int(np.min(interval_ns))
+        last_ns = int(np.max(interval_ns))
+        self.first_ns = (
+            first_ns if self.first_ns is None else min(self.first_ns, first_ns)
+        )
+        self.last_ns = last_ns if self.last_ns is None else max(self.last_ns, last_ns)
+
+        self.folded_ns = np.union1d(self.folded_ns, interval_ns)
+
+        self.cube.fold(interval_ns, bin_indices, (P, L, J))
+
+    # Intervals before `watermark_ns` will not be folded anymore
+    def advance_watermark(self, watermark_ns):
+        if self.watermark_ns is not None and watermark_ns <= self.watermark_ns:
+            return
+
+        self.watermark_ns = int(watermark_ns)
+        self.folded_ns = self.folded_ns[self.folded_ns >= self.watermark_ns]
+
+    # Mean per bin of flat `sums` on the full fixed grid, NaN for empty bins
+    def get_mean(self, count, sums):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = np.where(count > 0, sums / count, np.nan)
+        return means.reshape(self.bins.shape)
+
+    # Trim a full grid matrix to the grid of the folded data
+    def trim(self, matrix):
+        return self.bins.trim(self.bins.to_frame(matrix), self.max_Hm0, self.max_Te)
+
+    # Mean power matrix like `PowerMatrixDataHandler.calculate_power_matrix_mean`,
+    # the mean capture length times the mean energy flux of each bin
+    def get_power_matrix(self, count, sum_L, sum_J):
+        return self.trim(self.get_mean(count, sum_L) * self.get_mean(count, sum_J))
+
+    def to_power_matrix(self):
+        if self.is_empty():
+            return None
+
+        return self.get_power_matrix(self.count, self.sums["L"], self.sums["J"])
+
+    # Labelled matrices of one set of sums: the mean power matrix ("mean"), the
+    # number of intervals ("count") and the std of their power ("std") per bin
+    def get_statistics(self, count, sums, sumsqs):
+        std = self.bins.get_std_from_sums(count, sums["P"], sumsqs["P"])
+
+        return {
+            "mean": self.get_power_matrix(count, sums["L"], sums["J"]),
+            "count": self.trim(count.reshape(self.bins.shape)),
+            "std": self.trim(std.reshape(self.bins.shape)),
+        }
+
+    # First and last UTC day of `window`, see `PowerMatrixCube.get_window_days`
+    def get_window_days(self, window):
+        return self.cube.get_window_days(
+            window, self.cube.get_day(self.first_ns), self.cube.get_day(self.last_ns)
+        )
+
+    # (PM_mean, UTC timestamps of the first and last day of the window) for a
+    # window of `get_window_days`, None if the window has no folded intervals.
+    # Matrices share the grid of the all time matrix
+    def get_window(self, window):
+        window_statistics = self.get_window_statistics(window)
+        if window_statistics is None:
+            return None
+
+        statistics, timestamps = window_statistics
+        return (statistics["mean"], timestamps)
+
+    # Like `get_window`, with every matrix of `get_statistics`
+    def get_window_statistics(self, window):
+        if self.is_empty():
+            return None
+
+        if window == "all":
+            return (
+                self.get_statistics(self.count, self.sums, self.sumsqs),
+                self.get_timestamps(),
+            )
+
+        start_day, end_day = self.get_window_days(window)
+        totals = self.cube.get_totals(start_day, end_day)
+
+        if totals is None or totals["count"].sum() == 0:
+            return None
+
+        statistics = self.get_statistics(
+            totals["count"],
+            {q: totals[f"sum_{q}"] for q in self.quantities},
+            {q: totals[f"sumsq_{q}"] for q in self.quantities},
+        )
+
+        start_ns = max(start_day * self.cube.ns_per_day, self.first_ns)
+        end_ns = min((end_day + 1) * self.cube.ns_per_day - 1, self.last_ns)
+        timestamps = pd.Series(pd.to_datetime([start_ns, end_ns], unit="ns", utc=True))
+
+        return (statistics, timestamps)
+
+    # UTC timestamps of the first and last folded intervals
+    def get_timestamps(self):
+        return pd.Series(
+            pd.to_datetime([self.first_ns, self.last_ns], unit="ns", utc=True)
+        )
+
+
+if __name__ == "__main__":
+    accumulator = PowerMatrixAccumulator("Total_Power_kW")
+    if accumulator.load():
+        for window in ["all", "utc_day", "7_utc_days", "30_utc_days", "month"]:
+            print(window, accumulator.get_window(window))
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+
+# Hm0/Te bins for power matrices.
+#
+# Bin centers are multiples of the bin width starting at 0, the same centers
+# as `np.arange(0, max + width, width)` passed to mhkit 1.x's
+# `capture_width_matrix`. Like mhkit, the bin edges are the midpoints between
+# centers, so the bin of a value is round(value / width). That is computed for
+# all values at once, and every statistic then reuses the same flat bin
+# indices.
+#
+# mhkit 1.x starts the first bin at 0 and drops values past the last edge,
+# here they are clipped into the outer bins. The grid of `from_data` covers all of its data, so that only differs
+# for `fixed` and Hm0 over 10 m or Te over 30 s.
+class PowerMatrixBins:
+    def __init__(self, Hm0_max, Te_max, Hm0_width=0.5, Te_width=1.0):
+        self.Hm0_width = Hm0_width
+        self.Te_width = Te_width
+
+        self.Hm0_centers = np.arange(0, Hm0_max + Hm0_width, Hm0_width)
+        self.Te_centers = np.arange(0, Te_max + Te_width, Te_width)
+
+        self.shape = (len(self.Hm0_centers), len(self.Te_centers))
+        self.size = self.shape[0] * self.shape[1]
+
+    # The grid of the persisted power matrix accumulators and the stored
+    # `spectra` bins. Hm0 up to 10 m and Te up to 30 s
+    @classmethod
+    def fixed(cls):
+        return cls(Hm0_max=10.0, Te_max=30.0)
+
+    @classmethod
+    def from_data(cls, Hm0, Te, Hm0_width=0.5, Te_width=1.0):
+        return cls(np.nanmax(Hm0), np.nanmax(Te), Hm0_width, Te_width)
+
+    def get_axis_indices(self, values, width, num_bins):
+        indices = np.floor(np.asarray(values, dtype=np.float64) / width + 0.5)
+        return np.clip(indices, 0, num_bins - 1).astype(np.int64)
+
+    # Flat (row major Hm0 x Te) bin index for every (Hm0, Te) pair
+    def get_bin_indices(self, Hm0, Te):
+        Hm0_indices = self.get_axis_indices(Hm0, self.Hm0_width, self.shape[0])
+        Te_indices = self.get_axis_indices(Te, self.Te_width, self.shape[1])
+        return Hm0_indices * self.shape[1] + Te_indices
+
+    # Count, mean, std, min, max and frequency of occurrence per bin of every
+    # array in `values`, a dict of name to one value per bin index. Returns a
+    # dict of name to a dict of statistic to (Hm0 x Te) matrix, empty bins are
+    # NaN (count and frequency are 0). The std is mhkit 1.x's: ddof=0, so 0
+    # for a bin with one value.
+    #
+    # All arrays are stacked and sorted by bin once, then each statistic is a
+    # single np.ufunc.reduceat over the contiguous runs of each bin
+    def binned_statistics(self, bin_indices, values):
+        names = list(values)
+        stacked = np.vstack(
+            [np.asarray(values[name], dtype=np.float64) for name in names]
+        )
+        num_values = len(bin_indices)
+
+        count = np.zeros(self.size)
+        means, stds, mins, maxs = (
+            np.full((len(names), self.size), np.nan) for _ in range(4)
+        )
+
+        if num_values > 0:
+            order = np.argsort(bin_indices, kind="stable")
+            sorted_bins = bin_indices[order]
+            sorted_values = stacked[:, order]
+
+            starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+            occupied_bins = sorted_bins[starts]
+            bin_counts = np.diff(np.r_[starts, num_values])
+
+            bin_means = np.add.reduceat(sorted_values, starts, axis=1) / bin_counts
+            deviations = sorted_values - np.repeat(bin_means, bin_counts, axis=1)
+            squared_deviations = np.add.reduceat(deviations**2, starts, axis=1)
+
+            bin_stds = np.sqrt(squared_deviations / bin_counts)
+
+            count[occupied_bins] = bin_counts
+            means[:, occupied_bins] = bin_means
+            stds[:, occupied_bins] = bin_stds
+            mins[:, occupied_bins] = np.minimum.reduceat(sorted_values, starts, axis=1)
+            maxs[:, occupied_bins] = np.maximum.reduceat(sorted_values, starts, axis=1)
+
+        frequency = count / num_values if num_values > 0 else count
+
+        statistics = {}
+        for i, name in enumerate(names):
+            statistics[name] = {
+                "count": count.reshape(self.shape),
+                "mean": means[i].reshape(self.shape),
+                "std": stds[i].reshape(self.shape),
+                "min": mins[i].reshape(self.shape),
+                "max": maxs[i].reshape(self.shape),
+                "frequency": frequency.reshape(self.shape),
+            }
+
+        return statistics
+
+    # Std per bin from running count, sum and sum of squares arrays, the same
+    # as `binned_statistics`: ddof=0, 0 for one value and NaN for empty bins
+    def get_std_from_sums(self, count, sums, sumsqs):
+        count = np.asarray(count, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (sumsqs - sums * sums / count) / count
+            return np.where(count > 0, np.sqrt(np.clip(variance, 0, None)), np.nan)
+
+    # Edges of the bins of `centers`, the midpoints between centers plus the
+    # outer edges half a width past the first and last center. The outer bins
+    # also hold every value beyond these outer edges
+    def get_edges(self, centers, width):
+        centers = np.asarray(centers, dtype=np.float64)
+        return np.append(centers - width / 2, centers[-1] + width / 2)
+
+    # Trim a labelled matrix of these bins to the bins `from_data` would build
+    # for data with these maxima, so it matches a batch recompute
+    def trim(self, frame, Hm0_max, Te_max):
+        trimmed_bins = PowerMatrixBins(Hm0_max, Te_max, self.Hm0_width, self.Te_width)
+        num_Hm0 = min(trimmed_bins.shape[0], self.shape[0])
+        num_Te = min(trimmed_bins.shape[1], self.shape[1])
+
+        return frame.iloc[:num_Hm0, :num_Te]
+
+    # Label a (Hm0 x Te) matrix like mhkit's performance matrices
+    def to_frame(self, matrix):
+        return pd.DataFrame(
+            matrix,
+            index=pd.Index(self.Hm0_centers, name="x_centers"),
+            columns=pd.Index(self.Te_centers, name="y_centers"),
+        )
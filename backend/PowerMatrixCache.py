@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from AppContext import AppContext
+
+
+# Skip-if-unchanged cache of the power matrix JSON and images of
+# `Runner.build_visualizations`.
+#
+# The key is a hash of everything the output depends on: the largest
+# Timestamp and row count of each input table, the source of the backend
+# modules and the bin, window and filter settings. A run with the key of the
+# last saved run would write the same JSON and images, so it is skipped. The
+# entry is a JSON file with the key and the image and JSON paths.
+class PowerMatrixCache:
+    def __init__(self, context=None):
+        context = context or AppContext.get()
+
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.path = self.file_manager.get_power_matrix_cache_path()
+
+    # Every backend module, not only the ones computing the matrices. SQL
+    # queries, output paths and the render pool are spread over modules that
+    # also do other things, and a change to an unrelated module only costs
+    # one rebuild
+    def get_code_hash(self):
+        digest = hashlib.sha256()
+        for path in sorted(Path(__file__).parent.glob("*.py")):
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+        return digest.hexdigest()
+
+    # `tables` is a dict of table name to `SQLite.select_table_summary`,
+    # `config` a dict of JSON serializable settings that change the output
+    def get_key(self, tables, config):
+        key = {"tables": tables, "code": self.get_code_hash(), "config": config}
+        return hashlib.sha256(
+            json.dumps(key, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    # The saved image and JSON paths of `key`, None on a miss. An entry whose
+    # images or JSON were removed is a miss too
+    def load(self, key):
+        entry = None
+        if self.path.exists():
+            with open(self.path) as f:
+                entry = json.load(f)
+
+        if entry is None or entry["key"] != key:
+            self.logger.info(__name__, "Power matrix cache miss, the inputs changed")
+            return None
+
+        missing_images = [path for path in entry["images"] if not Path(path).exists()]
+        if len(missing_images) > 0:
+            self.logger.info(
+                __name__,
+                f"Power matrix cache miss, {len(missing_images)} files are missing",
+            )
+            return None
+
+        self.logger.info(
+            __name__,
+            f"Power matrix cache hit, reusing {len(entry['images'])} images and JSON files",
+        )
+        return entry["images"]
+
+    # Write to a temporary file then rename, so a crash never leaves a
+    # partially written entry behind
+    def save(self, key, images):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "images": [str(path) for path in images]}, f)
+        os.replace(tmp_path, self.path)
+
+    # The next run recomputes everything
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
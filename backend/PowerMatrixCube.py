@@ -0,0 +1,225 @@
+import numpy as np
+
+from AppContext import AppContext
+
+
+# Cumulative per UTC day power matrix statistics for one PTO.
+#
+# Row d of the cube holds, for every Hm0/Te bin, the count, sums and sums of
+# squares of P, L and J of all intervals up to and including day
+# `first_day + d`. The totals of any window of days are then the difference of
+# two rows, O(bins) no matter how much data the window covers.
+#
+# Rows are raw float64 in one file, shaped (days, fields, bins) and memory
+# mapped so a window only reads the two rows it needs. Folded intervals are
+# held in memory as per day deltas until `prepare`, which adds each delta to its
+# day and every later day, and `apply`, which writes those rows. New data is
+# almost always on the last day or two, so a save only touches the last rows.
+#
+# The owner keeps the extent and the rows of the last save with its own state
+# and replays them on load, so a crash between writing its state and the cube
+# can't leave the two apart.
+class PowerMatrixCube:
+    ns_per_day = 24 * 60 * 60 * 1_000_000_000
+
+    # Windows of whole UTC calendar days ending on the last day of the data.
+    # "utc_day" is the day of the last interval, not the last 24 hours
+    window_days = {"utc_day": 1, "7_utc_days": 7, "30_utc_days": 30}
+
+    def __init__(self, pto_name, bins, quantities, context=None):
+        self.bins = bins
+        self.file_manager = (context or AppContext.get()).file_manager
+        self.path = self.file_manager.get_power_matrix_cube_path(pto_name)
+
+        self.fields = ["count"]
+        for q in quantities:
+            self.fields += [f"sum_{q}", f"sumsq_{q}"]
+
+        self.row_shape = (len(self.fields), self.bins.size)
+        self.row_bytes = len(self.fields) * self.bins.size * 8
+
+        self.reset()
+
+    # An empty cube, the file is overwritten by the next `apply`
+    def reset(self):
+        self.first_day = None
+        self.num_days = 0
+        self.is_loaded = False
+        self.pending = {}
+
+    # The extent of the saved cube, kept by the owner of the cube
+    def load(self, first_day, num_days):
+        self.reset()
+
+        num_saved_days = 0
+        if self.path.exists():
+            num_saved_days = self.path.stat().st_size // self.row_bytes
+
+        if first_day is None or num_days > num_saved_days:
+            return False
+
+        self.first_day = first_day
+        self.num_days = num_days
+        self.is_loaded = True
+        return True
+
+    def get_day(self, timestamp_ns):
+        return int(timestamp_ns // self.ns_per_day)
+
+    # First and last UTC day of `window` for data from `first_day` to
+    # `last_day`: "all", a key of `window_days`, "month" for the month of
+    # `last_day` or a "YYYY-MM" month
+    @classmethod
+    def get_window_days(cls, window, first_day, last_day):
+        if window == "all":
+            return (first_day, last_day)
+
+        if window in cls.window_days:
+            return (last_day - cls.window_days[window] + 1, last_day)
+
+        if window == "month":
+            month = np.datetime64(last_day, "D").astype("datetime64[M]")
+        else:
+            month = np.datetime64(window, "M")
+
+        month_days = np.array([month, month + 1]).astype("datetime64[D]")
+        month_days = month_days.astype(np.int64)
+        return (int(month_days[0]), int(month_days[1]) - 1)
+
+    def open_rows(self, mode="r"):
+        return np.memmap(
+            self.path,
+            dtype=np.float64,
+            mode=mode,
+            shape=(self.num_days, *self.row_shape),
+        )
+
+    # Add intervals to the pending deltas. `values` are the per interval
+    # values of each quantity in order
+    def fold(self, interval_ns, bin_indices, values):
+        days = np.asarray(interval_ns, dtype=np.int64) // self.ns_per_day
+        unique_days, day_positions = np.unique(days, return_inverse=True)
+
+        # One bincount per field over (day, bin) pairs
+        flat_indices = day_positions * self.bins.size + bin_indices
+        minlength = len(unique_days) * self.bins.size
+
+        deltas = np.empty((len(unique_days), *self.row_shape))
+        deltas[:, 0] = np.bincount(flat_indices, minlength=minlength).reshape(
+            len(unique_days), self.bins.size
+        )
+        for i, quantity_values in enumerate(values):
+            for j, weights in enumerate((quantity_values, quantity_values**2)):
+                deltas[:, 1 + 2 * i + j] = np.bincount(
+                    flat_indices, weights=weights, minlength=minlength
+                ).reshape(len(unique_days), self.bins.size)
+
+        for day, delta in zip(unique_days.tolist(), deltas):
+            if day in self.pending:
+                self.pending[day] += delta
+            else:
+                self.pending[day] = delta
+
+    # The cube after applying the pending deltas, as (first_day, num_days,
+    # start_row, rows): the new extent and the new cumulative rows from
+    # `start_row` to the last day. Nothing is written, see `apply`. None when
+    # nothing is pending
+    def prepare(self):
+        if len(self.pending) == 0:
+            return None
+
+        days = sorted(self.pending)
+
+        num_saved_days = self.num_days if self.is_loaded else 0
+        if num_saved_days == 0:
+            first_day = days[0]
+            last_day = days[-1]
+        else:
+            first_day = min(days[0], self.first_day)
+            last_day = max(days[-1], self.first_day + num_saved_days - 1)
+        num_days = last_day - first_day + 1
+
+        # Saved rows move later when data comes before the start of the cube,
+        # rare, every row is rewritten then. Otherwise from the first changed
+        # day, or the first new day if that comes before it
+        shift = 0 if num_saved_days == 0 else self.first_day - first_day
+        start_row = 0 if shift > 0 else min(days[0] - first_day, num_saved_days)
+
+        # Saved cumulative rows, days before the saved ones are zero and days
+        # after them a copy of the last saved row
+        rows = np.zeros((num_days - start_row, *self.row_shape))
+        if num_saved_days > 0:
+            saved_rows = self.open_rows()
+            low = max(start_row, shift)
+            high = shift + num_saved_days
+            if low < high:
+                rows[low - start_row : high - start_row] = saved_rows[
+                    low - shift : high - shift
+                ]
+            rows[max(high - start_row, 0) :] = saved_rows[-1]
+            del saved_rows
+
+        for day in days:
+            rows[day - first_day - start_row :] += self.pending[day]
+
+        return (first_day, num_days, start_row, rows)
+
+    # Write the rows of `prepare` over the cube file and drop the pending
+    # deltas. The rows are written, not added, so applying the same rows again
+    # is harmless, see `replay`
+    def apply(self, first_day, num_days, start_row, rows):
+        mode = "r+b" if self.path.exists() else "w+b"
+        with open(self.path, mode) as f:
+            # Also drops any partial rows left behind by an interrupted write
+            f.truncate(num_days * self.row_bytes)
+            f.seek(start_row * self.row_bytes)
+            f.write(np.ascontiguousarray(rows, dtype=np.float64).tobytes())
+
+        self.first_day = first_day
+        self.num_days = num_days
+        self.is_loaded = True
+        self.pending = {}
+
+    # `apply` the rows of the last save again if the cube file doesn't hold
+    # them, after a crash between writing the owner's state and the cube.
+    # Returns True if anything was written
+    def replay(self, first_day, num_days, start_row, rows):
+        if self.path.exists() and self.path.stat().st_size == num_days * self.row_bytes:
+            saved_rows = np.memmap(
+                self.path,
+                dtype=np.float64,
+                mode="r",
+                shape=(num_days, *self.row_shape),
+            )
+            is_applied = np.array_equal(saved_rows[start_row:], rows)
+            del saved_rows
+
+            if is_applied:
+                return False
+
+        self.apply(first_day, num_days, start_row, rows)
+        return True
+
+    # Cumulative totals of the last saved day, shaped (fields, bins)
+    def get_last_row(self):
+        if self.num_days == 0:
+            return np.zeros(self.row_shape)
+        return np.array(self.open_rows()[-1])
+
+    # Totals of the days from `start_day` to `end_day` inclusive as a dict of
+    # field to flat bin array, None if the window holds no saved days
+    def get_totals(self, start_day, end_day):
+        if self.num_days == 0:
+            return None
+
+        start_day = max(start_day, self.first_day)
+        end_day = min(end_day, self.first_day + self.num_days - 1)
+        if end_day < start_day:
+            return None
+
+        rows = self.open_rows()
+        totals = np.array(rows[end_day - self.first_day])
+        if start_day > self.first_day:
+            totals -= rows[start_day - self.first_day - 1]
+
+        return dict(zip(self.fields, totals))
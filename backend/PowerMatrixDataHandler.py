@@ -1,10 +1,66 @@
-import math
+import os
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
-from mhkit import wave
 import numpy as np
 import pandas as pd
 
+from AppContext import AppContext
 from Logger import Logger
+from PowerMatrixAccumulator import PowerMatrixAccumulator
+from PowerMatrixBins import PowerMatrixBins
+from PowerMatrixCube import PowerMatrixCube
+from PowerQualityFilter import PowerQualityFilter
+from PowerSpectraJoiner import PowerSpectraJoiner
+
+# The handler of a power matrix worker process, built once by
+# `init_power_matrix_worker`
+worker_handler = None
+
+
+# Runs once in every worker process of
+# `PowerMatrixDataHandler.calculate_power_matrices_parallel`. The handler is
+# built from the parent's `settings`, `context` is the parent's `AppContext`
+# unpickled to the worker's own and records go to the parent's `log_queue`
+def init_power_matrix_worker(settings, context, log_queue):
+    global worker_handler
+
+    Logger.init_worker(log_queue)
+    worker_handler = PowerMatrixDataHandler.from_settings(settings, context)
+
+
+# Power matrix statistics of one column over one time window. `task` is
+# (arrays_dir, column, power_name, window, start_ns, end_ns), a few strings
+# and ints, so only that is pickled to a worker. `handler` is the worker's
+# handler unless given.
+#
+# The inputs are read from the .npy files in `arrays_dir` as read only memory
+# maps, so every worker shares the same pages of the page cache instead of
+# receiving a pickled copy of the data. Only the samples from `start_ns` to
+# `end_ns` of the column's file are read. Returns the column, the window and
+# the result of `PowerMatrixDataHandler.calculate_power_matrix_arrays`
+def calculate_power_matrix_window(task, handler=None):
+    arrays_dir, column, power_name, window, start_ns, end_ns = task
+    arrays_dir = Path(arrays_dir)
+    handler = handler or worker_handler
+
+    timestamps_ns = np.load(arrays_dir / "timestamps_ns.npy", mmap_mode="r")
+    first, last = np.searchsorted(timestamps_ns, [start_ns, end_ns])
+
+    power_kw = np.load(arrays_dir / f"{power_name}.npy", mmap_mode="r")
+    spectra = {
+        name: np.load(arrays_dir / f"spectra_{name}.npy", mmap_mode="r")
+        for name in ["ns", "Te", "Hm0", "J"]
+    }
+
+    result = handler.calculate_power_matrix_arrays(
+        timestamps_ns[first:last], power_kw[first:last], spectra, column
+    )
+
+    return (column, window, result)
+
 
 # Steps to generate the power performance Visualization
 # Following: https://mhkit-software.github.io/MHKiT/wave_example.html
@@ -50,129 +106,661 @@ class PowerMatrixDataHandler:
     # Aggregrate power data into hourly averaged chunks
     # Return a df of "UTC_Timestamps" and average power data in watts by
 
-    def __init__(self):
-        self.logger = Logger()
-
-    def average_power_data(self, power_df, column):
-        # Per 62600-100 8.3.1:
-        # Filter out all data that is not 2hz or faster for the whole hour
-        # Not used, but code is kept if necessary
-        min_samples_per_hour = 2 * 60 * 60
-        max_time_delta_ns = 1_000_000_000 / 2  # 2Hz
-
-        averaging_frequency = "30min"
-
-        # NDBC Buoy Times are in UTC, to match formats we convert our unix epoch ns timestamp to UTC
-        power_df.sort_index(inplace=True)
-        df = power_df
-
-        df["UTC_Timestamp"] = pd.to_datetime(df.index)
-
-        first_timestamp = df["UTC_Timestamp"].iloc[0]
-        last_timestamp = df["UTC_Timestamp"].iloc[-1]
-
-        # Move the first timestamp back to its hour
-        first_timestamp = first_timestamp.floor(freq=averaging_frequency)
+    def __init__(self, context=None):
+        self.context = context or AppContext.get()
+        self.logger = self.context.logger
+
+        # Power is averaged over fixed intervals aligned to the unix epoch
+        self.averaging_frequency = "30min"
+        self.averaging_interval_ns = pd.Timedelta(
+            self.averaging_frequency
+        ) // pd.Timedelta(1, "ns")
+
+        # Each interval is paired with the nearest spectrum within this tolerance
+        self.joiner = PowerSpectraJoiner(tolerance="15min", context=self.context)
+
+        # An interval is folded into the accumulators once it ended at least
+        # `settle_period` ago, so no more power data is expected for it. It is
+        # given up on if no spectrum matched it within `grace_period`
+        self.settle_ns = pd.Timedelta("15min") // pd.Timedelta(1, "ns")
+        self.grace_ns = pd.Timedelta("6h") // pd.Timedelta(1, "ns")
+
+        # IEC 62600-100 8.3.1 sample rate and deployment state checks
+        self.quality_filter = PowerQualityFilter(context=self.context)
+
+    # The settings that change the power matrices, plain values that are cheap
+    # to pickle and hash, see `from_settings` and `Runner.get_power_matrix_cache_key`
+    def get_settings(self):
+        return {
+            "averaging_frequency": self.averaging_frequency,
+            "tolerance": self.joiner.tolerance,
+            "quality_filter": [
+                self.quality_filter.enabled,
+                self.quality_filter.min_rate_hz,
+                self.quality_filter.min_coverage,
+                self.quality_filter.max_gap_ns,
+            ],
+        }
+
+    # A handler with the settings of `get_settings`
+    @classmethod
+    def from_settings(cls, settings, context=None):
+        handler = cls(context)
+
+        handler.averaging_frequency = settings["averaging_frequency"]
+        handler.averaging_interval_ns = pd.Timedelta(
+            handler.averaging_frequency
+        ) // pd.Timedelta(1, "ns")
+        handler.joiner = PowerSpectraJoiner(
+            tolerance=settings["tolerance"], context=handler.context
+        )
 
-        # Move the last timestamp forward to its hour
-        last_timestamp = last_timestamp.ceil(freq=averaging_frequency)
+        enabled, min_rate_hz, min_coverage, max_gap_ns = settings["quality_filter"]
+        handler.quality_filter = PowerQualityFilter(
+            enabled,
+            min_rate_hz,
+            min_coverage,
+            pd.Timedelta(max_gap_ns, "ns"),
+            context=handler.context,
+        )
 
-        # Get all data between the first and last timestamp by hour
-        hours_power_data_is_available = pd.date_range(
-            start=first_timestamp, end=last_timestamp, freq=averaging_frequency
+        return handler
+
+    # Average each of `columns` of `power_df` over each `averaging_frequency`
+    # interval. Returns a DataFrame with the interval start as "UTC_Timestamp"
+    # and one mean power column per column. A column is NaN for intervals where
+    # it has no data or a zero mean, intervals where every column is NaN are
+    # not returned. Intervals that fail `quality_filter` are NaN as well,
+    # `initial_state` is passed to `PowerQualityFilter.get_state_mask`.
+    #
+    # All intervals are computed in one pass: every row gets an integer bucket
+    # id (timestamp // interval) once and np.bincount sums the values and
+    # counts the rows of every bucket at once for each column. `power_df` is
+    # not modified.
+    def average_power_columns(self, power_df, columns, initial_state=None):
+        timestamps_ns = self.joiner.to_ns(power_df.index)
+
+        if len(timestamps_ns) == 0:
+            empty_df = pd.DataFrame(
+                {
+                    "UTC_Timestamp": pd.to_datetime(
+                        np.array([], dtype=np.int64), utc=True
+                    )
+                }
+            )
+            for column in columns:
+                empty_df[f"{column}"] = np.array([], dtype=np.float64)
+            return empty_df
+
+        # The state and gap checks need the samples in time order
+        if np.any(timestamps_ns[1:] < timestamps_ns[:-1]):
+            order = np.argsort(timestamps_ns, kind="stable")
+            power_df = power_df.iloc[order]
+            timestamps_ns = timestamps_ns[order]
+
+        # Per 62600-100 8.3.1 only samples taken while deployed are used
+        is_allowed = self.quality_filter.get_state_mask(power_df, initial_state)
+
+        interval_ns, average_power_kw = self.average_power_arrays(
+            timestamps_ns,
+            {
+                f"{column}": power_df[column].to_numpy(dtype=np.float64)
+                for column in columns
+            },
+            is_allowed,
         )
 
-        valid_timestamps = []
-        valid_power_kw = []
+        average_power_df = pd.DataFrame(average_power_kw)
+        average_power_df.insert(
+            0, "UTC_Timestamp", pd.to_datetime(interval_ns, unit="ns", utc=True)
+        )
 
-        for i in range(1, len(hours_power_data_is_available)):
-            hour_start = hours_power_data_is_available[i - 1]
-            hour_end = hours_power_data_is_available[i]
+        average_power_df = average_power_df.dropna(
+            how="all", subset=[f"{column}" for column in columns]
+        )
 
-            # Get all power data between these hour_start and hour_end
-            this_hour_power_data = df[
-                (df["UTC_Timestamp"] >= hour_start) & (df["UTC_Timestamp"] < hour_end)
-            ]
+        return average_power_df.reset_index(drop=True)
+
+    # Array version of `average_power_columns`. `timestamps_ns` are sorted unix
+    # epoch ns, `power_kw` is a dict of column name to float64 values and only
+    # samples where `is_allowed` is True are used. Returns the interval starts
+    # from the first to the last sample and a dict of column name to the mean
+    # of each interval, NaN like in `average_power_columns`
+    def average_power_arrays(self, timestamps_ns, power_kw, is_allowed):
+        # NDBC Buoy Times are in UTC, buckets are counted from the first bucket
+        bucket_ids = timestamps_ns // self.averaging_interval_ns
+        first_bucket_id = bucket_ids.min()
+        bucket_ids -= first_bucket_id
+        num_buckets = bucket_ids.max() + 1
+
+        average_power_kw = {}
+        for column, values in power_kw.items():
+            # Like DataFrame.mean, NaN values do not contribute to the average
+            is_valid = ~np.isnan(values) & is_allowed
+
+            # Per 62600-100 8.3.1 intervals that are not 2hz or faster for the
+            # whole interval are filtered out
+            quality = self.quality_filter.get_interval_quality(
+                timestamps_ns[is_valid],
+                bucket_ids[is_valid],
+                num_buckets,
+                first_bucket_id * self.averaging_interval_ns,
+                self.averaging_interval_ns,
+            )
+            is_passing = self.quality_filter.get_passing(quality)
+            self.quality_filter.log_rejected(column, quality, is_passing)
 
-            if this_hour_power_data.empty:
-                continue
+            counts = quality["count"]
+            sums = np.bincount(
+                bucket_ids[is_valid], weights=values[is_valid], minlength=num_buckets
+            )
 
-            # The commented code below skips hours where the data rate is less that 2hz
-            # if len(this_hour_power_data) < min_samples_per_hour:
-            # continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means = sums / counts
 
-            # this_hour_power_data["Timestamp"] = this_hour_power_data.index
-            # time_delta_ns = this_hour_power_data["Timestamp"].diff(periods=1)
+            # Skip empty intervals and intervals where the WEC produced no power
+            average_power_kw[column] = np.where(
+                is_passing & (counts > 0) & (means != 0), means, np.nan
+            )
 
-            # if time_delta_ns.max() > max_time_delta_ns:
-            #     continue
+        interval_ns = (
+            np.arange(num_buckets) + first_bucket_id
+        ) * self.averaging_interval_ns
 
-            # hour_power_data = this_hour_power_data[column]
+        return (interval_ns, average_power_kw)
 
-            average_power_kw = this_hour_power_data[column].mean()
+    # Single column version of `average_power_columns`
+    def average_power_data(self, power_df, column):
+        return self.average_power_columns(power_df, [column])
 
-            if average_power_kw != 0 and math.isnan(average_power_kw) is False:
-                valid_power_kw.append(average_power_kw)
-                valid_timestamps.append(hour_start)
+    # Combine the averaged power intervals with the nearest spectrum to the
+    # start of each interval. `spectra_df` is indexed by unix seconds or UTC
+    # datetimes. Intervals without a spectrum are dropped, power columns stay
+    # NaN where they have no data
+    def join_spectra(self, average_power_df, spectra_df):
+        combined_df = self.joiner.join(average_power_df, spectra_df[["Te", "Hm0", "J"]])
 
-        return pd.DataFrame(
-            [valid_timestamps, valid_power_kw], ["UTC_Timestamp", f"{column}"]
-        ).T
+        return combined_df.dropna(how="any", subset=["Te", "Hm0", "J"])
 
     # Follow
     # https://github.com/MHKiT-Software/MHKiT-Python/blob/master/examples/wave_example.ipynb
     # to calculate the power matrix data
-    def calculate_power_matrix_mean(self, power_df, spectra_df, column):
-        valid_average_power_df = self.average_power_data(power_df, column)
+    #
+    # All `columns` are averaged together, joined to the spectra once and share
+    # one set of Hm0/Te bin assignments. Returns a dict of column name to
+    # (statistics, UTC timestamps of the intervals used) for every column that
+    # has data. statistics is a dict of "P" (power), "L" (capture length) and
+    # "J" (energy flux) to the `PowerMatrixBins.binned_statistics` matrices as
+    # labelled DataFrames, plus "PM_mean", the mean capture length times the
+    # mean energy flux of each bin
+    def calculate_power_matrices_statistics(
+        self, power_df, spectra_df, columns, initial_state=None
+    ):
+        valid_average_power_df = self.average_power_columns(
+            power_df, columns, initial_state
+        )
 
         if valid_average_power_df.empty:
             self.logger.info(
                 __name__, "Not enough power data to calculate power matrix. Returning.."
             )
-            return
+            return {}
 
-        combined_df = pd.concat([valid_average_power_df, spectra_df], axis="index")
-        # Drop anything with nan
-        combined_df = combined_df.dropna(how="any")
+        combined_df = self.join_spectra(valid_average_power_df, spectra_df)
 
         if combined_df.empty:
             self.logger.info(
                 __name__,
                 "Not enough combined data to calculate power matrix. Returning..",
             )
-            return
-
-        P = np.array(
-            np.abs(combined_df[column].to_numpy()),
-            dtype="float64",
-        )
+            return {}
 
         # These are pre calculated in SpectraHandler.update_spectra
         # Energy Period
-        Te = combined_df["Te"].to_numpy()
+        Te = combined_df["Te"].to_numpy(dtype=np.float64)
 
         # Significant Wave Height
-        Hm0 = combined_df["Hm0"].to_numpy()
+        Hm0 = combined_df["Hm0"].to_numpy(dtype=np.float64)
 
         # Energy Flux
-        J = combined_df["J"].to_numpy()
+        J = combined_df["J"].to_numpy(dtype=np.float64)
+
+        # The same bins are used for every column
+        bins = PowerMatrixBins.from_data(Hm0, Te)
+        bin_indices = bins.get_bin_indices(Hm0, Te)
+
+        timestamps = combined_df["UTC_Timestamp"].reset_index(drop=True)
+
+        power_matrices = {}
+        for column in columns:
+            P = np.abs(combined_df[column].to_numpy(dtype=np.float64))
+            is_valid = ~np.isnan(P)
+
+            if is_valid.any() == False:
+                self.logger.info(
+                    __name__, f"No combined data for {column}, skipping power matrix"
+                )
+                continue
+
+            statistics = self.get_power_matrix_statistics(
+                bins, bin_indices[is_valid], P[is_valid], J[is_valid]
+            )
+
+            power_matrices[column] = (
+                statistics,
+                timestamps[is_valid].reset_index(drop=True),
+            )
+
+        return power_matrices
+
+    # Statistics of `calculate_power_matrices_statistics` for power `P` and
+    # energy flux `J` of intervals in the flat `bin_indices` of `bins`
+    def get_power_matrix_statistics(self, bins, bin_indices, P, J):
+        # Imported on first use, see `SpectraQOICalculator.calculate`
+        from mhkit import wave
 
         # Capture Length
         L = wave.performance.capture_length(P, J)
 
-        Hm0_bins = np.arange(0, Hm0.max() + 0.5, 0.5)
-        Te_bins = np.arange(0, Te.max() + 1, 1)
+        binned = bins.binned_statistics(bin_indices, {"P": P, "L": L, "J": J})
+
+        statistics = {
+            quantity: {
+                name: bins.to_frame(matrix)
+                for name, matrix in quantity_statistics.items()
+            }
+            for quantity, quantity_statistics in binned.items()
+        }
+        statistics["PM_mean"] = bins.to_frame(binned["L"]["mean"] * binned["J"]["mean"])
+
+        return statistics
+
+    # `calculate_power_matrices_statistics` of every column over every window of
+    # `windows` (see `PowerMatrixCube.get_window_days`, over the UTC days of
+    # `power_df`), one task per column and window in a process pool of
+    # `max_workers`. By default there is one worker per task up to the CPU
+    # count, 1 runs every task in this process.
+    #
+    # The samples are sorted and masked by deployment state once, then written
+    # with the spectra as .npy files to a temporary directory that the workers
+    # memory map, see `calculate_power_matrix_window`. Workers get the settings
+    # of this handler once, see `init_power_matrix_worker`. Returns a dict of column
+    # name to a dict of window to (statistics, UTC timestamps of the intervals
+    # used), windows without matched intervals are left out
+    def calculate_power_matrices_parallel(
+        self,
+        power_df,
+        spectra_df,
+        columns,
+        windows=("all",),
+        initial_state=None,
+        max_workers=None,
+    ):
+        power_matrices = {column: {} for column in columns}
+
+        timestamps_ns = self.joiner.to_ns(power_df.index)
+        if len(timestamps_ns) == 0:
+            self.logger.info(
+                __name__, "Not enough power data to calculate power matrix. Returning.."
+            )
+            return power_matrices
+
+        if np.any(timestamps_ns[1:] < timestamps_ns[:-1]):
+            order = np.argsort(timestamps_ns, kind="stable")
+            power_df = power_df.iloc[order]
+            timestamps_ns = timestamps_ns[order]
+
+        is_allowed = self.quality_filter.get_state_mask(power_df, initial_state)
+
+        spectra_ns = self.joiner.to_ns(spectra_df.index, unit="s")
+        spectra_order = np.argsort(spectra_ns, kind="stable")
+
+        first_day = int(timestamps_ns[0] // PowerMatrixCube.ns_per_day)
+        last_day = int(timestamps_ns[-1] // PowerMatrixCube.ns_per_day)
+
+        tasks = []
+        for i, column in enumerate(columns):
+            for window in windows:
+                start_day, end_day = PowerMatrixCube.get_window_days(
+                    window, first_day, last_day
+                )
+                tasks.append(
+                    (
+                        column,
+                        f"power_{i}",
+                        window,
+                        start_day * PowerMatrixCube.ns_per_day,
+                        (end_day + 1) * PowerMatrixCube.ns_per_day,
+                    )
+                )
+
+        if max_workers is None:
+            max_workers = min(len(tasks), os.cpu_count() or 1)
+
+        with tempfile.TemporaryDirectory(prefix="power_matrix_") as arrays_dir:
+            np.save(Path(arrays_dir) / "timestamps_ns.npy", timestamps_ns)
+            for i, column in enumerate(columns):
+                np.save(
+                    Path(arrays_dir) / f"power_{i}.npy",
+                    np.where(
+                        is_allowed, power_df[column].to_numpy(dtype=np.float64), np.nan
+                    ),
+                )
+
+            np.save(Path(arrays_dir) / "spectra_ns.npy", spectra_ns[spectra_order])
+            for name in ["Te", "Hm0", "J"]:
+                np.save(
+                    Path(arrays_dir) / f"spectra_{name}.npy",
+                    spectra_df[name].to_numpy(dtype=np.float64)[spectra_order],
+                )
+
+            if max_workers <= 1:
+                results = [
+                    calculate_power_matrix_window((arrays_dir, *task), self)
+                    for task in tasks
+                ]
+            else:
+                results = []
+                with ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=init_power_matrix_worker,
+                    initargs=(
+                        self.get_settings(),
+                        self.context,
+                        self.logger.get_worker_queue(),
+                    ),
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            calculate_power_matrix_window, (arrays_dir, *task)
+                        ): task
+                        for task in tasks
+                    }
+
+                    for future in as_completed(futures):
+                        column, _, window, _, _ = futures[future]
+                        try:
+                            results.append(future.result())
+                        except Exception as e:
+                            self.logger.error(
+                                __name__,
+                                f"Calculating the {column} {window} power matrix failed with {e}",
+                            )
+
+        for column, window, result in results:
+            if result is not None:
+                power_matrices[column][window] = result
+
+        return power_matrices
+
+    # Statistics of one power column like `calculate_power_matrices_statistics`
+    # from arrays: the sorted unix epoch ns `timestamps_ns`, the `power_kw` of
+    # each sample (NaN where it may not be used) and a dict of "ns" (sorted
+    # unix epoch ns), "Te", "Hm0" and "J" spectra arrays. The bins are built
+    # from the matched intervals of this column alone. Returns (statistics,
+    # UTC timestamps of the intervals used), None without matched intervals
+    def calculate_power_matrix_arrays(self, timestamps_ns, power_kw, spectra, column):
+        if len(timestamps_ns) == 0:
+            return None
+
+        interval_ns, average_power_kw = self.average_power_arrays(
+            timestamps_ns, {column: power_kw}, True
+        )
+        P = np.abs(average_power_kw[column])
+
+        matched_idx = self.joiner.match_nearest(interval_ns, spectra["ns"])
+        is_valid = ~np.isnan(P) & (matched_idx >= 0)
+        spectra_rows = matched_idx[is_valid]
+
+        Te = spectra["Te"][spectra_rows]
+        Hm0 = spectra["Hm0"][spectra_rows]
+        J = spectra["J"][spectra_rows]
+
+        has_spectra = ~(np.isnan(Te) | np.isnan(Hm0) | np.isnan(J))
+        if has_spectra.any() == False:
+            return None
+
+        Te = Te[has_spectra]
+        Hm0 = Hm0[has_spectra]
+        J = J[has_spectra]
+
+        bins = PowerMatrixBins.from_data(Hm0, Te)
+        statistics = self.get_power_matrix_statistics(
+            bins, bins.get_bin_indices(Hm0, Te), P[is_valid][has_spectra], J
+        )
+
+        timestamps = pd.Series(
+            pd.to_datetime(interval_ns[is_valid][has_spectra], unit="ns", utc=True)
+        )
+
+        return (statistics, timestamps)
+
+    # Returns a dict of column name to (PM_mean, UTC timestamps of the
+    # intervals used), see `calculate_power_matrices_statistics`
+    def calculate_power_matrices_mean(self, power_df, spectra_df, columns):
+        return {
+            column: (statistics["PM_mean"], timestamps)
+            for column, (
+                statistics,
+                timestamps,
+            ) in self.calculate_power_matrices_statistics(
+                power_df, spectra_df, columns
+            ).items()
+        }
+
+    # SQL computation path of `calculate_power_matrices_mean`. The half-hour
+    # averaging, quality checks and spectra join run inside SQLite on `db`
+    # against the stored spectra bins of `station`, only one row per occupied
+    # bin is read per column. Intervals are matched to the spectrum nearest to
+    # their start like `join_spectra`. Returns the same dict of column
+    # name to (PM_mean, UTC timestamps of the first and last interval)
+    def calculate_power_matrices_sql(self, db, station, columns, start=None):
+        return {
+            column: (statistics["mean"], timestamps)
+            for column, (
+                statistics,
+                timestamps,
+            ) in self.calculate_power_matrix_statistics_sql(
+                db, station, columns, start
+            ).items()
+        }
+
+    # Like `calculate_power_matrices_sql`, with the statistics of
+    # `PowerMatrixAccumulator.get_statistics` instead of PM_mean: the mean
+    # power matrix ("mean"), the interval count ("count") and the std of the
+    # interval power ("std") per bin
+    def calculate_power_matrix_statistics_sql(self, db, station, columns, start=None):
+        if start is None:
+            start = 0
+
+        if self.quality_filter.enabled:
+            min_samples = (
+                self.quality_filter.min_coverage
+                * self.quality_filter.min_rate_hz
+                * self.averaging_interval_ns
+                / 1_000_000_000
+            )
+            max_gap_ns = self.quality_filter.max_gap_ns
+        else:
+            min_samples = 1
+            max_gap_ns = np.iinfo(np.int64).max
+
+        excluded_periods = self.quality_filter.get_excluded_periods(
+            db.select_triton_c_state_changes(start),
+            db.select_triton_c_state_before(start),
+            start,
+        )
+
+        tolerance_s = self.joiner.tolerance_ns // 1_000_000_000
+
+        bins = PowerMatrixBins.fixed()
+
+        power_matrices = {}
+        for column in columns:
+            bins_df = db.select_half_hour_power_bins(
+                column,
+                station,
+                start,
+                self.averaging_interval_ns,
+                min_samples,
+                max_gap_ns,
+                tolerance_s,
+                excluded_periods,
+            )
+
+            if bins_df.empty:
+                self.logger.info(
+                    __name__, f"No combined data for {column}, skipping power matrix"
+                )
+                continue
+
+            bin_indices = (
+                bins_df["Hm0_Bin"].to_numpy() * bins.shape[1]
+                + bins_df["Te_Bin"].to_numpy()
+            )
+
+            LM_mean = np.full(bins.size, np.nan)
+            LM_mean[bin_indices] = bins_df["Mean_L"].to_numpy()
+
+            JM = np.full(bins.size, np.nan)
+            JM[bin_indices] = bins_df["Mean_J"].to_numpy()
+
+            count = np.zeros(bins.size)
+            count[bin_indices] = bins_df["Count"].to_numpy()
+
+            sum_P = np.zeros(bins.size)
+            sum_P[bin_indices] = bins_df["Mean_P"].to_numpy() * count[bin_indices]
+
+            sum_sq_P = np.zeros(bins.size)
+            sum_sq_P[bin_indices] = bins_df["Sum_Sq_P"].to_numpy()
+
+            std_P = bins.get_std_from_sums(count, sum_P, sum_sq_P)
+
+            statistics = {
+                name: bins.trim(
+                    bins.to_frame(matrix.reshape(bins.shape)),
+                    bins_df["Max_Hm0"].max(),
+                    bins_df["Max_Te"].max(),
+                )
+                for name, matrix in [
+                    ("mean", LM_mean * JM),
+                    ("count", count),
+                    ("std", std_P),
+                ]
+            }
+
+            timestamps = pd.Series(
+                pd.to_datetime(
+                    [
+                        bins_df["First_Bucket"].min() * self.averaging_interval_ns,
+                        bins_df["Last_Bucket"].max() * self.averaging_interval_ns,
+                    ],
+                    unit="ns",
+                    utc=True,
+                )
+            )
 
-        LM_mean = wave.performance.capture_length_matrix(
-            Hm0, Te, L, "mean", Hm0_bins, Te_bins
+            power_matrices[column] = (statistics, timestamps)
+
+        return power_matrices
+
+    def calculate_power_matrix_mean(self, power_df, spectra_df, column):
+        return self.calculate_power_matrices_mean(power_df, spectra_df, [column]).get(
+            column
         )
 
-        # Wave Energy Flux Matrix using mean
-        JM = wave.performance.wave_energy_flux_matrix(
-            Hm0, Te, J, "mean", Hm0_bins, Te_bins
+    # Persisted accumulators for each of `columns`, empty if there is no saved
+    # state yet
+    def load_power_matrix_accumulators(self, columns):
+        accumulators = {}
+        for column in columns:
+            accumulators[column] = PowerMatrixAccumulator(column, self.context)
+            accumulators[column].load()
+        return accumulators
+
+    # Power data must be read from this unix epoch ns timestamp to update all
+    # `accumulators`, None when one of them needs the full history
+    def get_accumulators_watermark(self, accumulators):
+        watermarks = [accumulator.watermark_ns for accumulator in accumulators.values()]
+        if None in watermarks:
+            return None
+        return min(watermarks)
+
+    # Spectra must be read from this unix epoch ns timestamp to join the
+    # intervals from `watermark` on, every interval starts at or after it and
+    # is matched within the join tolerance. None reads every spectrum
+    def get_spectra_watermark(self, watermark):
+        if watermark is None:
+            return None
+        return watermark - self.joiner.tolerance_ns
+
+    # Start of the last interval up to `last_timestamp_ns` (unix epoch ns) that
+    # is complete at `now`, so it can be folded into the accumulators. Later
+    # runs can only fold more intervals once this changes
+    def get_last_complete_interval_ns(self, last_timestamp_ns, now=None):
+        if now is None:
+            now = pd.Timestamp.now(tz="UTC")
+        now_ns = self.joiner.to_ns(pd.DatetimeIndex([now]))[0]
+
+        last_complete_ns = now_ns - self.settle_ns - self.averaging_interval_ns
+        last_complete_ns = min(int(last_complete_ns), int(last_timestamp_ns))
+
+        return (
+            last_complete_ns // self.averaging_interval_ns
+        ) * self.averaging_interval_ns
+
+    # Fold the intervals of `power_df` that are complete, matched to a spectrum
+    # and not yet folded into each accumulator, then move the watermarks past
+    # the grace period. `power_df` must hold every row since
+    # `get_accumulators_watermark`, `initial_state` is the deployment state
+    # before it. `now` defaults to the current time
+    def update_power_matrix_accumulators(
+        self, accumulators, power_df, spectra_df, now=None, initial_state=None
+    ):
+        if now is None:
+            now = pd.Timestamp.now(tz="UTC")
+        now_ns = self.joiner.to_ns(pd.DatetimeIndex([now]))[0]
+
+        columns = list(accumulators)
+        average_power_df = self.average_power_columns(power_df, columns, initial_state)
+        combined_df = self.join_spectra(average_power_df, spectra_df)
+
+        interval_ns = self.joiner.to_ns(combined_df["UTC_Timestamp"])
+        is_complete = (
+            interval_ns + self.averaging_interval_ns <= now_ns - self.settle_ns
         )
 
-        PM_mean = wave.performance.power_matrix(LM_mean, JM)
+        Te = combined_df["Te"].to_numpy(dtype=np.float64)
+        Hm0 = combined_df["Hm0"].to_numpy(dtype=np.float64)
+        J = combined_df["J"].to_numpy(dtype=np.float64)
+
+        # Interval aligned, every interval before it is older than the grace period
+        watermark_ns = (
+            (now_ns - self.grace_ns) // self.averaging_interval_ns
+        ) * self.averaging_interval_ns
+
+        for column, accumulator in accumulators.items():
+            P = np.abs(combined_df[column].to_numpy(dtype=np.float64))
+            is_new = ~np.isnan(P) & is_complete & accumulator.get_unfolded(interval_ns)
+
+            if is_new.any():
+                from mhkit import wave
+
+                L = wave.performance.capture_length(P[is_new], J[is_new])
+                accumulator.fold(
+                    interval_ns[is_new],
+                    Hm0[is_new],
+                    Te[is_new],
+                    P[is_new],
+                    L,
+                    J[is_new],
+                )
+
+            accumulator.advance_watermark(watermark_ns)
+
+            self.logger.info(
+                __name__,
+                f"Folded {is_new.sum()} intervals into the {column} power matrix accumulator",
+            )
 
-        # Timestamps are used for filenames?
-        return (PM_mean, combined_df.index.astype("int64"))
+        return accumulators
@@ -0,0 +1,74 @@
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+import numpy as np
+
+
+# One reusable power matrix figure, drawn like mhkit's `plot_matrix`.
+#
+# The figure, axes, image and colorbar are built once with the object
+# oriented API on their own Agg canvas, so pyplot never holds a reference to
+# them and they are freed with this object. `update` replaces the matrix in
+# place: the image data, extent and ticks change, the norm is rescaled to the
+# new values and the colorbar follows it through the norm callbacks.
+class PowerMatrixFigure:
+    def __init__(self, width, height, dpi, cmap):
+        self.fig = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+
+        self.norm = Normalize(vmin=0, vmax=1)
+        self.image = self.ax.imshow(
+            np.full((1, 1), np.nan),
+            origin="lower",
+            aspect="auto",
+            cmap=cmap,
+            norm=self.norm,
+            interpolation="none",
+        )
+
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax)
+        self.colorbar.set_label("Mean Power (kW)", rotation=270, labelpad=15)
+
+        self.ax.set_xlabel("Te (s)")
+        self.ax.set_ylabel("Hm0 (m)")
+
+    def update(self, power_matrix_mean, title, date_range):
+        values = power_matrix_mean.to_numpy(dtype=np.float64)
+        num_rows, num_columns = values.shape
+
+        self.fig.suptitle(title)
+        self.ax.set_title(date_range)
+
+        self.image.set_data(values)
+        extent = (-0.5, num_columns - 0.5, -0.5, num_rows - 0.5)
+        self.image.set_extent(extent)
+        self.ax.set_xlim(extent[0], extent[1])
+        self.ax.set_ylim(extent[2], extent[3])
+
+        if np.isfinite(values).any():
+            self.norm.autoscale(np.ma.masked_invalid(values))
+
+        self.ax.set_xticks(
+            np.arange(num_columns), labels=list(power_matrix_mean.columns)
+        )
+        self.ax.set_yticks(np.arange(num_rows), labels=list(power_matrix_mean.index))
+
+        self.fig.tight_layout()
+
+    # Draw the figure, returns the canvas RGBA buffer. It is overwritten by
+    # the next draw
+    def draw_rgba(self):
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())
+
+    def save_svg(self, path):
+        self.fig.savefig(path, format="svg")
+
+    def close(self):
+        self.fig.clear()
+        self.fig = None
+        self.canvas = None
+        self.ax = None
+        self.image = None
+        self.colorbar = None
@@ -1,49 +1,128 @@
-import matplotlib.pyplot as plt
-from mhkit import wave
+import matplotlib
+from PIL import Image
 
-from FileManager import FileManager
+from AppContext import AppContext
+from PowerMatrixFigure import PowerMatrixFigure
 
 
+# Renders power matrices for the dashboard and, optionally, for reports.
+#
+# The dashboard gets small raster images at screen resolution. Each matrix is
+# drawn once with the Agg backend and the same RGBA buffer is encoded as every
+# format in `raster_formats`, so adding a format costs an encode, not a render.
+# SVG is only written when `is_svg` is set. The matrix is drawn as an image
+# without interpolation, so an SVG embeds one pixel per bin instead of a
+# bitmap at the figure dpi.
+#
+# Figures are `PowerMatrixFigure`s kept in a pool and updated in place for
+# every matrix, pyplot is not used. `close` frees the pool, so a long running
+# process holds at most the figures that were in use at the same time.
 class PowerMatrixImageGenerator:
-    def __init__(self):
-        self.file_manager = FileManager()
+    def __init__(self, raster_formats=("webp", "png"), is_svg=False, context=None):
+        self.file_manager = (context or AppContext.get()).file_manager
 
         self.fig_width = 8
         self.fig_height = 8
-        self.img_format = "svg"
-        self.dpi = 1200
 
+        # 8 x 8 inches at 100 dpi is 800 x 800 pixels
+        self.dpi = 100
+        self.raster_formats = list(raster_formats)
+        self.is_svg = is_svg
+
+        # Pillow encoder options per raster format
+        self.raster_options = {"png": {"optimize": False}, "webp": {"lossless": True}}
+
+        # Built once and shared by every figure
+        self.cmap = matplotlib.colormaps["viridis"]
+
+        self.figure_pool = []
+
+    # A pooled figure, or a new one when every pooled figure is in use. Give
+    # it back with `release_figure`
+    def acquire_figure(self):
+        if len(self.figure_pool) > 0:
+            return self.figure_pool.pop()
+
+        return PowerMatrixFigure(self.fig_width, self.fig_height, self.dpi, self.cmap)
+
+    def release_figure(self, figure):
+        self.figure_pool.append(figure)
+
+    # Free every pooled figure
+    def close(self):
+        for figure in self.figure_pool:
+            figure.close()
+        self.figure_pool = []
+
+    # Every image format written for a matrix
+    def get_image_formats(self):
+        if self.is_svg:
+            return self.raster_formats + ["svg"]
+        return self.raster_formats
+
+    # Draw `figure` once and encode it as each format of `paths`, a dict of
+    # raster format to path
+    def save_raster(self, figure, paths):
+        image = Image.fromarray(figure.draw_rgba())
+
+        for image_format, path in paths.items():
+            self.file_manager.write_atomic(
+                path,
+                lambda tmp_path: image.save(
+                    tmp_path,
+                    format=image_format.upper(),
+                    **self.raster_options.get(image_format, {}),
+                ),
+            )
+
+    def save_svg(self, figure, path):
+        self.file_manager.write_atomic(path, figure.save_svg)
+
+    # Returns the paths of the written images
     def build_power_matrix_mean_visualization(
-        self, power_matrix_mean, pto_name, title, date_range, all_ns_timestamps
+        self,
+        power_matrix_mean,
+        pto_name,
+        title,
+        date_range,
+        all_ns_timestamps,
+        window="all",
     ):
-        plt.figure(figsize=(8, 8))
-        plt.suptitle(title)
-        plt.title(date_range)
-
-        ax = plt.gca()
-
-        wave.graphics.plot_matrix(
-            power_matrix_mean,
-            xlabel="Te (s)",
-            ylabel="Hm0 (m)",
-            zlabel="Mean Power (kW)",
-            show_values=False,
-            ax=ax,
-        )
-
-        plt.tight_layout()
-
-        self.file_manager.archive_last_power_matrix(
-            pto_name,
-            self.img_format,
-            start=all_ns_timestamps[0],
-            end=all_ns_timestamps[-1],
-        )
-
-        plt.savefig(
-            self.file_manager.get_power_matrix_latest_filename(
-                pto_name, self.img_format
-            ),
-            format=self.img_format,
-            dpi=self.dpi,
-        )
+        image_paths = {}
+        for image_format in self.get_image_formats():
+            self.file_manager.archive_last_power_matrix(
+                pto_name,
+                image_format,
+                start=all_ns_timestamps.iloc[0],
+                end=all_ns_timestamps.iloc[-1],
+                window=window,
+            )
+
+            image_paths[image_format] = (
+                self.file_manager.get_power_matrix_latest_filename(
+                    pto_name, image_format, window
+                )
+            )
+
+        figure = self.acquire_figure()
+        try:
+            figure.update(power_matrix_mean, title, date_range)
+
+            self.save_raster(
+                figure,
+                {
+                    image_format: image_paths[image_format]
+                    for image_format in self.raster_formats
+                },
+            )
+
+            if self.is_svg:
+                self.save_svg(figure, image_paths["svg"])
+        except Exception:
+            # A figure that failed part way is not reused
+            figure.close()
+            raise
+
+        self.release_figure(figure)
+
+        return list(image_paths.values())
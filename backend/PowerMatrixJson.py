@@ -0,0 +1,106 @@
+import json
+
+import numpy as np
+
+from AppContext import AppContext
+from PowerMatrixBins import PowerMatrixBins
+
+
+# Power matrices as JSON for the dashboard to render client side.
+#
+# Each matrix is written next to its images as
+# `<pto>[_<window>]_power_matrix_latest.json`:
+#
+#   {
+#     "version": 1,
+#     "pto": "Total_Power_kW",
+#     "window": "7_utc_days",
+#     "start": "2024-06-01T00:00:00Z",     first and last interval, UTC
+#     "end": "2024-06-07T23:30:00Z",
+#     "Hm0": {"centers": [...], "edges": [...], "units": "m"},
+#     "Te": {"centers": [...], "edges": [...], "units": "s"},
+#     "mean": [[...], ...],                mean power, kW
+#     "count": [[...], ...],               half-hour intervals
+#     "std": [[...], ...]                  std of the interval power, kW,
+#                                          ddof=0 like mhkit 1.x
+#   }
+#
+# Matrices are rows of Hm0 by columns of Te, empty bins are null. `edges` has
+# one more value than `centers`, the outer bins also hold the values beyond
+# the outer edges, see `PowerMatrixBins`. `version` changes with the layout.
+class PowerMatrixJson:
+    version = 1
+
+    # Decimals kept for the kW matrices, a watt is enough for the dashboard
+    decimals = 3
+
+    def __init__(self, context=None):
+        self.file_manager = (context or AppContext.get()).file_manager
+        self.bins = PowerMatrixBins.fixed()
+
+    # A matrix as nested lists, NaN as None
+    def to_rows(self, matrix, decimals=None):
+        values = matrix.to_numpy(dtype=np.float64)
+        if decimals is not None:
+            values = values.round(decimals)
+
+        return [
+            [value if np.isfinite(value) else None for value in row]
+            for row in values.tolist()
+        ]
+
+    def to_axis(self, centers, width, units):
+        return {
+            "centers": [float(center) for center in centers],
+            "edges": self.bins.get_edges(centers, width).tolist(),
+            "units": units,
+        }
+
+    def to_timestamp(self, timestamp):
+        return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # `statistics` is a dict of "mean", "count" and "std" to labelled matrices,
+    # see `PowerMatrixAccumulator.get_statistics`
+    def to_dict(self, statistics, pto_name, timestamps, window="all"):
+        mean = statistics["mean"]
+
+        return {
+            "version": self.version,
+            "pto": pto_name,
+            "window": window,
+            "start": self.to_timestamp(timestamps.iloc[0]),
+            "end": self.to_timestamp(timestamps.iloc[-1]),
+            "Hm0": self.to_axis(mean.index, self.bins.Hm0_width, "m"),
+            "Te": self.to_axis(mean.columns, self.bins.Te_width, "s"),
+            "mean": self.to_rows(mean, self.decimals),
+            "count": statistics["count"].to_numpy(dtype=np.int64).tolist(),
+            "std": self.to_rows(statistics["std"], self.decimals),
+        }
+
+    # Write the JSON of one matrix atomically, returns its path
+    def write(self, statistics, pto_name, timestamps, window="all"):
+        path = self.file_manager.get_power_matrix_latest_filename(
+            pto_name, "json", window
+        )
+        content = json.dumps(
+            self.to_dict(statistics, pto_name, timestamps, window),
+            separators=(",", ":"),
+            allow_nan=False,
+        )
+
+        self.file_manager.write_atomic(
+            path, lambda tmp_path: tmp_path.write_text(content)
+        )
+
+        return path
+
+
+if __name__ == "__main__":
+    from PowerMatrixAccumulator import PowerMatrixAccumulator
+
+    accumulator = PowerMatrixAccumulator("Total_Power_kW")
+    if accumulator.load():
+        window_statistics = accumulator.get_window_statistics("all")
+        if window_statistics is not None:
+            statistics, timestamps = window_statistics
+            print(PowerMatrixJson().write(statistics, "Total_Power_kW", timestamps))
@@ -0,0 +1,133 @@
+import os
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from AppContext import AppContext
+from Logger import Logger
+from PowerMatrixImageGenerator import PowerMatrixImageGenerator
+
+# The generator of a render worker process, built once by `init_render_worker`
+render_generator = None
+
+
+# Runs once in every worker process when it starts. Importing this module
+# already loaded matplotlib with the Agg backend, the generator and its first
+# figure are built here so the first task doesn't pay for them. `context` is
+# the parent's `AppContext`, unpickled to the worker's own, and records go to
+# the parent's `log_queue`
+def init_render_worker(raster_formats, is_svg, context, log_queue):
+    global render_generator
+
+    Logger.init_worker(log_queue)
+    render_generator = PowerMatrixImageGenerator(raster_formats, is_svg, context)
+    render_generator.release_figure(render_generator.acquire_figure())
+
+
+# Render one matrix in a worker process, returns the written image paths
+def render_power_matrix_task(*payload):
+    return render_generator.build_power_matrix_mean_visualization(*payload)
+
+
+# Render stage of `Runner.build_visualizations`.
+#
+# Matrices are submitted as soon as they are computed and queued to a pool of
+# `max_workers` render processes, so images are rendered while the next
+# matrices are computed and renders run on several cores. A payload is the
+# arguments of `PowerMatrixImageGenerator.build_power_matrix_mean_visualization`,
+# a labelled matrix of a few hundred bins and its timestamps, cheap to pickle.
+# With `max_workers` 1 matrices are rendered in this process as they are
+# submitted.
+#
+# Images are written atomically by the generator, see
+# `FileManager.write_atomic`.
+class PowerMatrixRenderPool:
+    def __init__(
+        self,
+        max_workers=None,
+        raster_formats=("webp", "png"),
+        is_svg=False,
+        context=None,
+    ):
+        context = context or AppContext.get()
+        self.logger = context.logger
+
+        # Renders take a fraction of a second, more workers than this mostly
+        # add start up time
+        if max_workers is None:
+            max_workers = min(4, os.cpu_count() or 1)
+
+        self.max_workers = max_workers
+        self.executor = None
+        self.generator = None
+
+        if max_workers <= 1:
+            self.generator = PowerMatrixImageGenerator(raster_formats, is_svg, context)
+        else:
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_render_worker,
+                initargs=(
+                    list(raster_formats),
+                    is_svg,
+                    context,
+                    self.logger.get_worker_queue(),
+                ),
+            )
+
+        # (future, name) of every submitted matrix, in order
+        self.submitted = []
+
+    # Queue a matrix for rendering, see
+    # `PowerMatrixImageGenerator.build_power_matrix_mean_visualization`
+    def submit(
+        self,
+        power_matrix_mean,
+        pto_name,
+        title,
+        date_range,
+        all_ns_timestamps,
+        window="all",
+    ):
+        payload = (
+            power_matrix_mean,
+            pto_name,
+            title,
+            date_range,
+            all_ns_timestamps,
+            window,
+        )
+
+        if self.executor is not None:
+            future = self.executor.submit(render_power_matrix_task, *payload)
+        else:
+            future = Future()
+            try:
+                future.set_result(
+                    self.generator.build_power_matrix_mean_visualization(*payload)
+                )
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submitted.append((future, f"{pto_name} {window}"))
+
+    # Wait for every submitted matrix. Returns the written image paths in
+    # submission order, failed renders are logged and skipped
+    def wait(self):
+        image_paths = []
+        for future, name in self.submitted:
+            try:
+                image_paths += future.result()
+            except Exception as e:
+                self.logger.error(__name__, f"Rendering {name} failed with {e}")
+
+        self.submitted = []
+        return image_paths
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if self.generator is not None:
+            self.generator.close()
+            self.generator = None
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+from AppContext import AppContext
+
+
+# IEC 62600-100 8.3.1 data quality checks for averaging intervals.
+#
+# An interval is only used for a power matrix if its power samples are 2 Hz
+# or faster for the whole interval. For each interval and power column this
+# computes, in one pass over the sorted int64 timestamps:
+#   * count: Number of power samples
+#   * max_gap_ns: Longest time without a sample, including the gaps from the
+#     interval start to the first sample and from the last sample to the end
+#   * coverage: count / the number of samples at `min_rate_hz`, at most 1
+# Intervals pass when coverage >= `min_coverage` and max gap <= `max_gap`.
+#
+# The defaults are the 2 Hz rule: full coverage and no gap over 0.5 s, one
+# missing sample at 2 Hz rejects the interval. A lower `min_coverage` or a
+# longer `max_gap` accepts intervals that are not IEC 62600-100 compliant,
+# only pass them for data exploration.
+#
+# Samples taken while the WEC is not deployed or is in maintenance are not
+# used at all, which lowers the coverage of intervals that are only partly
+# deployed. Is_Deployed and Is_Maint are only stored when they change, so the
+# state is carried forward from the last stored value. Samples before any
+# known state are kept.
+class PowerQualityFilter:
+    def __init__(
+        self,
+        enabled=True,
+        min_rate_hz=2.0,
+        min_coverage=1.0,
+        max_gap="500ms",
+        context=None,
+    ):
+        self.logger = (context or AppContext.get()).logger
+
+        self.enabled = enabled
+        self.min_rate_hz = min_rate_hz
+        self.min_coverage = min_coverage
+        self.max_gap_ns = pd.Timedelta(max_gap) // pd.Timedelta(1, "ns")
+
+    # Boolean mask of the rows of `power_df` taken while deployed and not in
+    # maintenance. `initial_state` is a dict with the "Is_Deployed" and
+    # "Is_Maint" values in effect before the first row, see
+    # `SQLite.select_triton_c_state_before`
+    def get_state_mask(self, power_df, initial_state=None):
+        is_allowed = np.ones(len(power_df), dtype=bool)
+
+        if self.enabled is False:
+            return is_allowed
+
+        if initial_state is None:
+            initial_state = {}
+
+        for column, excluded_value in (("Is_Deployed", 0), ("Is_Maint", 1)):
+            if column not in power_df.columns:
+                continue
+
+            state = pd.to_numeric(power_df[column]).ffill()
+            if initial_state.get(column) is not None:
+                state = state.fillna(initial_state[column])
+
+            is_allowed &= (state != excluded_value).to_numpy()
+
+        return is_allowed
+
+    # (start, end) unix epoch ns ranges where samples are not used, from the
+    # state changes of `SQLite.select_triton_c_state_changes` at or after
+    # `start`. `initial_state` is the state before `start`
+    def get_excluded_periods(self, state_changes_df, initial_state=None, start=0):
+        if self.enabled is False:
+            return []
+
+        if initial_state is None:
+            initial_state = {}
+
+        initial_df = pd.DataFrame(
+            {
+                column: [initial_state.get(column)]
+                for column in ["Is_Deployed", "Is_Maint"]
+            },
+            dtype=np.float64,
+        )
+        states_df = pd.concat(
+            [initial_df, state_changes_df.reset_index(drop=True)], ignore_index=True
+        )
+
+        is_allowed = self.get_state_mask(states_df)
+        period_starts = np.r_[
+            np.int64(start), np.asarray(state_changes_df.index, dtype=np.int64)
+        ]
+        period_ends = np.r_[period_starts[1:], np.iinfo(np.int64).max]
+
+        return list(zip(period_starts[~is_allowed], period_ends[~is_allowed]))
+
+    # Quality of every bucket for the samples in `timestamps_ns` (sorted unix
+    # epoch ns) with the bucket ids `bucket_ids` (0 based, timestamp //
+    # interval - first bucket). `bucket_start_ns` is the start of bucket 0.
+    # Returns a dict of count, max_gap_ns and coverage arrays of `num_buckets`
+    def get_interval_quality(
+        self, timestamps_ns, bucket_ids, num_buckets, bucket_start_ns, interval_ns
+    ):
+        count = np.bincount(bucket_ids, minlength=num_buckets)
+
+        # Buckets without samples are one gap as long as the interval
+        max_gap_ns = np.full(num_buckets, interval_ns, dtype=np.int64)
+
+        if len(timestamps_ns) > 0:
+            starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+            ends = np.r_[starts[1:], len(timestamps_ns)] - 1
+            occupied = bucket_ids[starts]
+
+            # Gaps between samples of the same bucket, the first sample of each
+            # bucket has no previous sample in the bucket
+            gaps = np.zeros(len(timestamps_ns), dtype=np.int64)
+            gaps[1:] = np.diff(timestamps_ns)
+            gaps[starts] = 0
+            inner_gap = np.maximum.reduceat(gaps, starts)
+
+            interval_start = bucket_start_ns + occupied * interval_ns
+            leading_gap = timestamps_ns[starts] - interval_start
+            trailing_gap = interval_start + interval_ns - timestamps_ns[ends]
+
+            max_gap_ns[occupied] = np.maximum(
+                inner_gap, np.maximum(leading_gap, trailing_gap)
+            )
+
+        expected_count = self.min_rate_hz * interval_ns / 1_000_000_000
+        coverage = np.minimum(count / expected_count, 1.0)
+
+        return {"count": count, "max_gap_ns": max_gap_ns, "coverage": coverage}
+
+    # Boolean mask of the buckets that pass the thresholds
+    def get_passing(self, quality):
+        if self.enabled is False:
+            return quality["count"] > 0
+
+        return (quality["coverage"] >= self.min_coverage) & (
+            quality["max_gap_ns"] <= self.max_gap_ns
+        )
+
+    def log_rejected(self, column, quality, is_passing):
+        is_rejected = (quality["count"] > 0) & ~is_passing
+        if is_rejected.any() == False:
+            return
+
+        low_coverage = is_rejected & (quality["coverage"] < self.min_coverage)
+        long_gap = is_rejected & (quality["max_gap_ns"] > self.max_gap_ns)
+        self.logger.info(
+            __name__,
+            f"{column}: rejected {is_rejected.sum()} of {(quality['count'] > 0).sum()} intervals ({low_coverage.sum()} below {self.min_coverage:.0%} coverage at {self.min_rate_hz} Hz, {long_gap.sum()} with gaps over {self.max_gap_ns / 1e9:g} s)",
+        )
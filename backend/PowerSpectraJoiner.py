@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from AppContext import AppContext
+
+
+# Time aligned join of averaged power intervals and wave spectra.
+#
+# Power intervals are labelled by their start as UTC datetimes, spectra are
+# indexed by unix seconds (as stored in the `spectra` table) or UTC datetimes.
+# Both sides are mapped to int64 unix epoch ns, the spectra are sorted once and
+# every power interval is paired with the nearest spectrum within `tolerance`
+# using np.searchsorted, like `pd.merge_asof(direction="nearest")`. That is
+# O((n + m) log m), so multi-year histories join in well under a second.
+class PowerSpectraJoiner:
+    def __init__(self, tolerance="15min", context=None):
+        self.logger = (context or AppContext.get()).logger
+
+        self.tolerance = tolerance
+        self.tolerance_ns = pd.Timedelta(tolerance) // pd.Timedelta(1, "ns")
+
+        # Fraction of power intervals matched by the last `join`
+        self.match_rate = None
+
+    # Unix epoch ns integers from datetimes (any timezone) or from numbers in
+    # `unit` ("s" or "ns")
+    def to_ns(self, values, unit="ns"):
+        if isinstance(values, pd.Series):
+            values = pd.Index(values)
+
+        if isinstance(values, pd.DatetimeIndex):
+            if values.tz is not None:
+                values = values.tz_convert("UTC").tz_localize(None)
+            return values.values.astype("datetime64[ns]").astype(np.int64)
+
+        values = np.asarray(values)
+        if unit == "s":
+            return values.astype(np.int64) * 1_000_000_000
+
+        return values.astype(np.int64)
+
+    # Pair each row of `average_power_df` (with a "UTC_Timestamp" column) with
+    # the nearest row of `spectra_df` within the tolerance. `spectra_unit` is
+    # the unit of a numeric `spectra_df` index. Returns the matched power rows
+    # with the spectra columns and the matched "Spectra_Timestamp" added
+    def join(self, average_power_df, spectra_df, spectra_unit="s"):
+        power_ns = self.to_ns(average_power_df["UTC_Timestamp"])
+        spectra_ns = self.to_ns(spectra_df.index, unit=spectra_unit)
+
+        spectra_order = np.argsort(spectra_ns, kind="stable")
+        spectra_ns = spectra_ns[spectra_order]
+
+        matched_idx = self.match_nearest(power_ns, spectra_ns)
+        is_matched = matched_idx >= 0
+
+        self.match_rate = is_matched.mean() if len(power_ns) > 0 else 0.0
+        self.logger.info(
+            __name__,
+            f"Matched {is_matched.sum()} of {len(power_ns)} power intervals ({self.match_rate:.1%}) to spectra within {self.tolerance}",
+        )
+
+        spectra_rows = spectra_order[matched_idx[is_matched]]
+
+        combined_df = average_power_df.iloc[np.flatnonzero(is_matched)].reset_index(
+            drop=True
+        )
+        matched_spectra_df = spectra_df.iloc[spectra_rows].reset_index(drop=True)
+        matched_spectra_df.insert(
+            0,
+            "Spectra_Timestamp",
+            pd.to_datetime(spectra_ns[matched_idx[is_matched]], unit="ns", utc=True),
+        )
+
+        return pd.concat([combined_df, matched_spectra_df], axis="columns")
+
+    # For every value of `left_ns`, the index of the nearest value of the
+    # sorted `right_ns` within the tolerance, or -1. Ties go to the earlier value
+    def match_nearest(self, left_ns, right_ns):
+        if len(right_ns) == 0:
+            return np.full(len(left_ns), -1, dtype=np.int64)
+
+        after = np.searchsorted(right_ns, left_ns, side="left")
+        before = after - 1
+
+        after_clipped = np.minimum(after, len(right_ns) - 1)
+        before_clipped = np.maximum(before, 0)
+
+        distance_after = np.where(
+            after < len(right_ns),
+            right_ns[after_clipped] - left_ns,
+            np.iinfo(np.int64).max,
+        )
+        distance_before = np.where(
+            before >= 0, left_ns - right_ns[before_clipped], np.iinfo(np.int64).max
+        )
+
+        use_before = distance_before <= distance_after
+        nearest = np.where(use_before, before_clipped, after_clipped)
+        distance = np.where(use_before, distance_before, distance_after)
+
+        return np.where(distance <= self.tolerance_ns, nearest, -1)
+
+
+if __name__ == "__main__":
+    joiner = PowerSpectraJoiner()
+
+    power_df = pd.DataFrame(
+        {
+            "UTC_Timestamp": pd.date_range(
+                "2024-01-01", periods=6, freq="30min", tz="UTC"
+            ),
+            "Total_Power_kW": np.arange(6, dtype=float),
+        }
+    )
+    spectra_df = pd.DataFrame(
+        {"Hm0": [1.0, 1.5, 2.0], "Te": [8.0, 9.0, 10.0], "J": [4.0, 8.0, 16.0]},
+        index=pd.Index([1704067260, 1704070800, 1704074700], name="Timestamp"),
+    )
+
+    print(joiner.join(power_df, spectra_df))
@@ -0,0 +1,300 @@
+import json
+
+import numpy as np
+
+from AppContext import AppContext
+
+
+# Downsampled PTO power time series for the dashboard's `PowerPerformanceChart`.
+#
+# Raw power is sampled at up to 10 Hz, far more points than a chart can draw.
+# Each level splits time into buckets of a fixed width and keeps, for every
+# power column, the count, sum, min and max of the samples in each bucket. The
+# chart draws the mean and can shade the min to max band, so short spikes that
+# plain averaging would hide stay visible at every zoom level.
+#
+# Buckets only depend on their own samples, so new rows are folded into the
+# last bucket and appended after it, only the rows after `watermark_ns` are
+# read. Each level keeps the buckets of its retention period and is written as
+# a small static JSON file to `DirectoryManager.power_series_dir`:
+#
+#   {
+#     "version": 1,
+#     "level": "15min",
+#     "interval_s": 900,
+#     "timestamps": [...],                 bucket starts, unix epoch seconds
+#     "series": {
+#       "Total_Power_kW": {"mean": [...], "min": [...], "max": [...]},
+#       ...
+#     }
+#   }
+#
+# Buckets without samples are left out, buckets with only missing values of a
+# column are null in its series. Rows stored with a Timestamp before the
+# watermark are not folded, `rebuild` folds the full history again, see
+# `Runner.rebuild_power_series`.
+class PowerTimeSeries:
+    version = 1
+
+    columns = [
+        "PTO_Bow_Power_kW",
+        "PTO_Port_Power_kW",
+        "PTO_Starboard_Power_kW",
+        "Total_Power_kW",
+    ]
+
+    # Level name to (bucket width, retention) in seconds, None keeps every bucket
+    levels = {
+        "1min": (60, 24 * 3600),
+        "15min": (15 * 60, 14 * 24 * 3600),
+        "1h": (3600, 90 * 24 * 3600),
+        "1d": (24 * 3600, None),
+    }
+
+    fields = ("count", "sum", "min", "max")
+
+    # Rows read from the database at once, bounds memory on the first run
+    chunk_rows = 500_000
+
+    # Decimals kept in the JSON files, 10 W is enough for the chart
+    decimals = 2
+
+    def __init__(self, context=None):
+        context = context or AppContext.get()
+
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.path = self.file_manager.get_power_series_state_path()
+
+        self.reset()
+
+    def reset(self):
+        # Level to bucket starts (unix epoch ns) and level to field to
+        # (bucket x column) arrays
+        self.starts = {}
+        self.buckets = {}
+        for level in self.levels:
+            self.starts[level] = np.array([], dtype=np.int64)
+            self.buckets[level] = {
+                "count": np.zeros((0, len(self.columns)), dtype=np.int64),
+                "sum": np.zeros((0, len(self.columns))),
+                "min": np.zeros((0, len(self.columns))),
+                "max": np.zeros((0, len(self.columns))),
+            }
+
+        # Timestamp of the last folded row
+        self.watermark_ns = None
+
+    def load(self):
+        if self.path.exists() is False:
+            return False
+
+        with np.load(self.path) as state:
+            if state["columns"].tolist() != self.columns or any(
+                f"{level}_starts" not in state for level in self.levels
+            ):
+                self.logger.warning(
+                    __name__,
+                    f"{self.path} has different columns or levels, rebuilding the power series",
+                )
+                return False
+
+            for level in self.levels:
+                self.starts[level] = state[f"{level}_starts"]
+                for field in self.fields:
+                    self.buckets[level][field] = state[f"{level}_{field}"]
+
+            watermark_ns = int(state["watermark_ns"])
+            self.watermark_ns = None if watermark_ns < 0 else watermark_ns
+
+        return True
+
+    # Write to a temporary file then rename, so a crash never leaves a
+    # partially written state behind
+    def save(self):
+        arrays = {
+            "columns": np.array(self.columns),
+            "watermark_ns": np.int64(
+                -1 if self.watermark_ns is None else self.watermark_ns
+            ),
+        }
+        for level in self.levels:
+            arrays[f"{level}_starts"] = self.starts[level]
+            for field in self.fields:
+                arrays[f"{level}_{field}"] = self.buckets[level][field]
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+
+        self.file_manager.write_atomic(self.path, write)
+
+    # Bucket starts and statistics of sorted `timestamps_ns` with one row of
+    # `values` (samples x columns) each, for buckets of `width_ns`
+    def aggregate(self, timestamps_ns, values, width_ns):
+        bucket_starts = timestamps_ns // width_ns * width_ns
+        starts = np.flatnonzero(np.r_[True, bucket_starts[1:] != bucket_starts[:-1]])
+
+        is_valid = np.isfinite(values)
+        return bucket_starts[starts], {
+            "count": np.add.reduceat(is_valid, starts, axis=0).astype(np.int64),
+            "sum": np.add.reduceat(np.where(is_valid, values, 0.0), starts, axis=0),
+            # fmin and fmax ignore NaN, buckets of only NaN stay NaN
+            "min": np.fmin.reduceat(values, starts, axis=0),
+            "max": np.fmax.reduceat(values, starts, axis=0),
+        }
+
+    # Add sorted rows newer than the watermark to every level
+    def fold(self, timestamps_ns, values):
+        if len(timestamps_ns) == 0:
+            return
+
+        for level, (width_s, retention_s) in self.levels.items():
+            width_ns = width_s * 1_000_000_000
+            starts, buckets = self.aggregate(timestamps_ns, values, width_ns)
+            level_starts = self.starts[level]
+            level_buckets = self.buckets[level]
+
+            # Rows are newer than every folded row, only the last bucket can
+            # get more samples
+            if len(level_starts) > 0 and level_starts[-1] == starts[0]:
+                level_buckets["count"][-1] += buckets["count"][0]
+                level_buckets["sum"][-1] += buckets["sum"][0]
+                level_buckets["min"][-1] = np.fmin(
+                    level_buckets["min"][-1], buckets["min"][0]
+                )
+                level_buckets["max"][-1] = np.fmax(
+                    level_buckets["max"][-1], buckets["max"][0]
+                )
+
+                starts = starts[1:]
+                buckets = {field: buckets[field][1:] for field in self.fields}
+
+            level_starts = np.concatenate([level_starts, starts])
+            for field in self.fields:
+                level_buckets[field] = np.concatenate(
+                    [level_buckets[field], buckets[field]]
+                )
+
+            if retention_s is not None:
+                is_kept = level_starts >= (
+                    level_starts[-1] - retention_s * 1_000_000_000
+                )
+                level_starts = level_starts[is_kept]
+                for field in self.fields:
+                    level_buckets[field] = level_buckets[field][is_kept]
+
+            self.starts[level] = level_starts
+
+        self.watermark_ns = int(timestamps_ns[-1])
+
+    # Fold every row after the watermark, a page of `chunk_rows` at a time.
+    # Returns the number of folded rows
+    def update_from_db(self, db):
+        num_rows = 0
+        while True:
+            df = db.select_triton_c_power_after(
+                -1 if self.watermark_ns is None else self.watermark_ns,
+                self.chunk_rows,
+            )
+            if df.empty:
+                break
+
+            self.fold(
+                df["Timestamp"].to_numpy(dtype=np.int64),
+                df[self.columns].to_numpy(dtype=np.float64),
+            )
+            num_rows += len(df)
+
+            if len(df) < self.chunk_rows:
+                break
+
+        return num_rows
+
+    # Mean per bucket, NaN for buckets without samples of a column
+    def get_mean(self, level):
+        count = self.buckets[level]["count"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(count > 0, self.buckets[level]["sum"] / count, np.nan)
+
+    def to_list(self, values):
+        return [
+            value if np.isfinite(value) else None
+            for value in values.round(self.decimals).tolist()
+        ]
+
+    def to_dict(self, level):
+        width_s = self.levels[level][0]
+        statistics = {
+            "mean": self.get_mean(level),
+            "min": self.buckets[level]["min"],
+            "max": self.buckets[level]["max"],
+        }
+
+        return {
+            "version": self.version,
+            "level": level,
+            "interval_s": width_s,
+            "timestamps": (self.starts[level] // 1_000_000_000).tolist(),
+            "series": {
+                column: {
+                    name: self.to_list(values[:, i])
+                    for name, values in statistics.items()
+                }
+                for i, column in enumerate(self.columns)
+            },
+        }
+
+    # Write the JSON file of every level atomically, returns their paths
+    def write(self):
+        paths = []
+        for level in self.levels:
+            path = self.file_manager.get_power_series_path(level)
+            content = json.dumps(
+                self.to_dict(level), separators=(",", ":"), allow_nan=False
+            )
+            self.file_manager.write_atomic(
+                path, lambda tmp_path: tmp_path.write_text(content)
+            )
+            paths.append(path)
+
+        return paths
+
+    # Fold the new rows of the `triton_c` table of `db` and rewrite the JSON
+    # files. Nothing is written when there are no new rows. Returns the number
+    # of folded rows
+    def update(self, db):
+        if self.load() is False:
+            self.reset()
+
+        num_rows = self.update_from_db(db)
+        if num_rows == 0:
+            self.logger.info(__name__, "No new power rows, power series unchanged")
+            return num_rows
+
+        self.save()
+        paths = self.write()
+        self.logger.info(
+            __name__,
+            f"Folded {num_rows} power rows into power series",
+            rows=num_rows,
+            bytes=self.file_manager.get_total_size(paths),
+        )
+        return num_rows
+
+    # Fold the full `triton_c` history again, picks up rows stored with a
+    # Timestamp before the watermark. Returns the number of folded rows
+    def rebuild(self, db):
+        self.reset()
+        num_rows = self.update_from_db(db)
+        self.save()
+        self.write()
+        return num_rows
+
+
+if __name__ == "__main__":
+    series = PowerTimeSeries()
+    series.update(AppContext.get().db)
+    for level in series.levels:
+        print(level, len(series.starts[level]))
@@ -1,29 +1,85 @@
 import traceback
+from functools import cached_property
 
-import pandas as pd
+import numpy as np
 
 from zoneinfo import ZoneInfo
 
-from DirectoryManager import DirectoryManager
-from Logger import Logger
-from SQLite import SQLite
-from TritonCHandler import TritonC
-from FileManager import FileManager
-from SpectraHandler import SpectraHandler
+from AppContext import AppContext
+from GPSTrack import GPSTrack
+from PowerMatrixAccumulator import PowerMatrixAccumulator
+from PowerMatrixBins import PowerMatrixBins
+from PowerMatrixCache import PowerMatrixCache
 from PowerMatrixDataHandler import PowerMatrixDataHandler
-from PowerMatrixImageGenerator import PowerMatrixImageGenerator
-
-
+from PowerMatrixJson import PowerMatrixJson
+from PowerTimeSeries import PowerTimeSeries
+
+
+# Every cron job is one method, started by a three line script. A job only
+# imports what it uses: modules that pull in requests, xarray, mhkit or
+# matplotlib are imported by the jobs that need them and the handlers are
+# created on first use, so `collect_WEC_data` every 5 minutes doesn't pay for
+# the spectra and rendering stacks. `check_import_budget.py` keeps it that way.
+#
+# Every class a job builds gets the runner's `AppContext`, so directories,
+# logging and the database connection are set up once per process
 class Runner:
-    def __init__(self):
-        self.triton_c = TritonC()
-        self.spectra = SpectraHandler()
-        self.logger = Logger()
-
-        self.db = SQLite()
-
-        self.dirs = DirectoryManager()
-        self.files = FileManager()
+    def __init__(self, context=None):
+        self.context = context or AppContext.get()
+
+        self.logger = self.context.logger
+
+        self.db = self.context.db
+
+        self.dirs = self.context.dirs
+        self.files = self.context.file_manager
+
+        self.pto_col_names = [
+            "PTO_Bow_Power_kW",
+            "PTO_Port_Power_kW",
+            "PTO_Starboard_Power_kW",
+            "Total_Power_kW",
+        ]
+
+        # See `PowerMatrixAccumulator.get_window`, UTC days ending on the day of
+        # the last folded interval
+        self.power_matrix_windows = [
+            "all",
+            "utc_day",
+            "7_utc_days",
+            "30_utc_days",
+            "month",
+        ]
+
+        # Where `build_visualizations` gets the matrices from:
+        #   "accumulators": every window from the power matrix accumulators,
+        #     only new power data is read
+        #   "sql": the all time matrices computed inside SQLite, raw power
+        #     data never leaves the database
+        #   "recompute": every window recomputed from the full history in
+        #     `power_matrix_workers` processes
+        self.power_matrix_source = "accumulators"
+
+        # Worker processes of the "recompute" source, None for one per PTO and
+        # window up to the CPU count and 1 to compute in this process, see
+        # `PowerMatrixDataHandler.calculate_power_matrices_parallel`
+        self.power_matrix_workers = None
+
+        # Render worker processes, None for up to 4 and 1 to render in this
+        # process, see `PowerMatrixRenderPool`
+        self.render_workers = None
+
+    @cached_property
+    def triton_c(self):
+        from TritonCHandler import TritonC
+
+        return TritonC(self.context)
+
+    @cached_property
+    def spectra(self):
+        from SpectraHandler import SpectraHandler
+
+        return SpectraHandler(self.context)
 
     # Run once to create all files necessary for running the application
     def create_files(self):
@@ -34,26 +90,60 @@ class Runner:
     # 5 minutes * 10 hz = 60 * 10 * 10 = 3000
     # If we are not collecting all data increase the value of CanaryRequester.default_max_size
     def collect_WEC_data(self):
-        self.logger.info(__name__, "Starting collect_WEC_data...")
-        try:
-            last_10_min = "Now-10Min"
-            # last_hour = "Now-1Hour"
-            # last_day = "Now-1Hour"
-            # last_month = "Now-1Month"
-
-            self.triton_c.init_canary_request()
-
-            self.triton_c.update_triton_c(last_10_min)
-
-            # These are being run for legacy purposes. If the triton_c table works
-            # nominally these commands (and db tables) should be deprecated
-            # self.triton_c.update_gps_coords(last_10_min)
-            # self.triton_c.update_deployment_state(last_10_min)
-            # self.triton_c.update_power_performance(last_10_min)
-        except Exception as e:
-            self.logger.error("collect_WEC_data", e)
-
-        self.logger.info(__name__, "Finished collect_WEC_data!")
+        with self.logger.timed(__name__, "collect_WEC_data") as fields:
+            try:
+                last_10_min = "Now-10Min"
+                # last_hour = "Now-1Hour"
+                # last_day = "Now-1Hour"
+                # last_month = "Now-1Month"
+
+                self.triton_c.init_canary_request()
+
+                fields["rows"] = self.triton_c.update_triton_c(last_10_min)
+
+                # These are being run for legacy purposes. If the triton_c table works
+                # nominally these commands (and db tables) should be deprecated
+                # self.triton_c.update_gps_coords(last_10_min)
+                # self.triton_c.update_deployment_state(last_10_min)
+                # self.triton_c.update_power_performance(last_10_min)
+            except Exception as e:
+                self.logger.error("collect_WEC_data", e)
+
+        self.update_power_series()
+        self.update_gps_track()
+
+    # Fold the rows added since the last run into the downsampled power time
+    # series of the dashboard, see `PowerTimeSeries`
+    def update_power_series(self):
+        with self.logger.timed(__name__, "update_power_series") as fields:
+            try:
+                fields["rows"] = PowerTimeSeries(self.context).update(self.db)
+            except Exception as e:
+                self.logger.error("update_power_series", e)
+
+    # Fold the positions added since the last run into the simplified GPS
+    # track of the dashboard, see `GPSTrack`
+    def update_gps_track(self):
+        with self.logger.timed(__name__, "update_gps_track") as fields:
+            try:
+                fields["rows"] = GPSTrack(self.context).update(self.db)
+            except Exception as e:
+                self.logger.error("update_gps_track", e)
+
+    # Run manually after rows were stored with a Timestamp older than the
+    # last collected one, e.g. a backfill. `update_power_series` and
+    # `update_gps_track` only fold rows after their watermarks, this folds the
+    # full `triton_c` history into both again
+    def rebuild_power_series(self):
+        for stage, state in [
+            ("rebuild_power_series", PowerTimeSeries(self.context)),
+            ("rebuild_gps_track", GPSTrack(self.context)),
+        ]:
+            with self.logger.timed(__name__, stage) as fields:
+                try:
+                    fields["rows"] = state.rebuild(self.db)
+                except Exception as e:
+                    self.logger.error(stage, e)
 
     # Set up the database from saved files
     # Should run once to initialize the database
@@ -69,79 +159,344 @@ class Runner:
 
     # Updates every hour
     # Should run every half hour
+    # Collects every enabled station in StationRegistry in parallel
     def collect_spectra_data(self):
-        self.logger.info(__name__, "Starting collect_spectra_data...")
-        try:
-            self.spectra.update_spectra()
-        except Exception as e:
-            self.logger.error("collect_spectra_data", e)
-        self.logger.info(__name__, "Finished collect_spectra_data!")
+        with self.logger.timed(__name__, "collect_spectra_data") as fields:
+            try:
+                fields["rows"] = self.spectra.update_all_spectra()
+            except Exception as e:
+                self.logger.error("collect_spectra_data", e)
+
+    # Run manually after changing a QOI definition or station depth
+    # Recomputes the `spectra` table QOI from the stored spectral densities
+    def recompute_spectra_qoi(self):
+        with self.logger.timed(__name__, "recompute_spectra_qoi", rows=0) as fields:
+            for station_id in self.spectra.stations.enabled_station_ids():
+                try:
+                    fields["rows"] += self.spectra.recompute_spectra_qoi(station_id)
+                except Exception as e:
+                    self.logger.error("recompute_spectra_qoi", e)
+
+            # The recomputed rows keep their Timestamps, so the cache key can't
+            # see the change
+            PowerMatrixCache(self.context).clear()
 
     # Run every half hour
+    # Skipped when no triton_c or spectra rows arrived and no more intervals
+    # completed since the last run, see `PowerMatrixCache`
     def build_visualizations(self):
-        self.logger.info(__name__, "Starting build_visualizations...")
-        try:
-            pto_col_names = [
-                "PTO_Bow_Power_kW",
-                "PTO_Port_Power_kW",
-                "PTO_Starboard_Power_kW",
-                "Total_Power_kW",
-            ]
-
-            spectra_df = self.spectra.read_spectra()
-            # Create a nanosecond timestamp index
-            spectra_df.index = pd.to_datetime(
-                spectra_df.index, unit="s", origin="unix", utc=True
+        with self.logger.timed(__name__, "build_visualizations") as fields:
+            try:
+                power_matrix_handler = PowerMatrixDataHandler(self.context)
+
+                cache = PowerMatrixCache(self.context)
+                cache_key = self.get_power_matrix_cache_key(cache, power_matrix_handler)
+
+                if cache.load(cache_key) is None:
+                    if self.power_matrix_source == "sql":
+                        _, output_paths = self.build_sql_visualizations(
+                            power_matrix_handler
+                        )
+                    elif self.power_matrix_source == "recompute":
+                        _, output_paths = self.build_recomputed_visualizations(
+                            power_matrix_handler
+                        )
+                    else:
+                        _, output_paths = self.build_accumulator_visualizations(
+                            power_matrix_handler
+                        )
+
+                    cache.save(cache_key, output_paths)
+                    fields["bytes"] = self.files.get_total_size(output_paths)
+            except Exception as e:
+                self.logger.error("build_visualizations", e)
+
+    # `PowerMatrixCache` key of the current input tables and power matrix
+    # settings
+    def get_power_matrix_cache_key(self, cache, power_matrix_handler):
+        tables = {
+            table: self.db.select_table_summary(table)
+            for table in ["triton_c", "spectra"]
+        }
+
+        # Intervals are only folded once they are complete, so the matrices can
+        # change without new rows
+        last_timestamp = tables["triton_c"][0]
+        last_complete_interval_ns = None
+        if last_timestamp is not None:
+            last_complete_interval_ns = (
+                power_matrix_handler.get_last_complete_interval_ns(last_timestamp)
             )
-            spectra_df = spectra_df.sort_index()
 
-            power_df = self.triton_c.db.select_all_triton_c()
-            # Create a nanosecond timestamp index
-            power_df.index = pd.to_datetime(
-                power_df.index, unit="ns", origin="unix", utc=True
+        bins = PowerMatrixBins.fixed()
+
+        config = {
+            "pto_col_names": self.pto_col_names,
+            "power_matrix_windows": self.power_matrix_windows,
+            "power_matrix_source": self.power_matrix_source,
+            "station": self.spectra.stations.primary_station,
+            "bins": [bins.Hm0_width, bins.Te_width, *bins.shape],
+            **power_matrix_handler.get_settings(),
+            "last_complete_interval_ns": last_complete_interval_ns,
+        }
+
+        return cache.get_key(tables, config)
+
+    # Fold the new power data into the accumulators, write the JSON of every
+    # window and render it. Returns a dict of PTO to a dict of window to
+    # (PM_mean, UTC timestamps) and the written JSON and image paths
+    def build_accumulator_visualizations(self, power_matrix_handler):
+        from PowerMatrixRenderPool import PowerMatrixRenderPool
+
+        # Started first, the render workers start up while the data is read
+        render_pool = PowerMatrixRenderPool(self.render_workers, context=self.context)
+        power_matrix_json = PowerMatrixJson(self.context)
+        try:
+            # Only the power data after the accumulator watermarks is read, the
+            # rest of the history is already folded into the accumulators
+            accumulators = power_matrix_handler.load_power_matrix_accumulators(
+                self.pto_col_names
             )
-            power_df = power_df.sort_index()
+            watermark = power_matrix_handler.get_accumulators_watermark(accumulators)
+            with self.logger.timed(__name__, "read_power_matrix_data") as fields:
+                power_df = self.triton_c.db.select_triton_c_since(watermark)
+                initial_state = self.triton_c.db.select_triton_c_state_before(watermark)
+                spectra_df = self.spectra.read_spectra(
+                    since_ns=power_matrix_handler.get_spectra_watermark(watermark)
+                )
+                fields["rows"] = len(power_df) + len(spectra_df)
+
+            with self.logger.timed(__name__, "update_power_matrix_accumulators"):
+                power_matrix_handler.update_power_matrix_accumulators(
+                    accumulators, power_df, spectra_df, initial_state=initial_state
+                )
+
+            # Matrices are rendered while the next ones are computed, or in
+            # this process with one render worker, so the stage covers both
+            with self.logger.timed(__name__, "render_power_matrices") as fields:
+                power_matrices = {}
+                json_paths = []
+                for pto in self.pto_col_names:
+                    accumulators[pto].save()
+
+                    power_matrices[pto] = {}
+                    for window in self.power_matrix_windows:
+                        print(f"\tBuilding {pto} {window} vizualization...")
+                        window_statistics = accumulators[pto].get_window_statistics(
+                            window
+                        )
+
+                        if window_statistics is None:
+                            continue
+
+                        statistics, timestamps = window_statistics
+                        json_paths.append(
+                            power_matrix_json.write(statistics, pto, timestamps, window)
+                        )
 
-            viz_generator = PowerMatrixImageGenerator()
+                        power_matrices[pto][window] = (statistics["mean"], timestamps)
+                        self.render_power_matrix(
+                            render_pool, pto, window, statistics["mean"], timestamps
+                        )
+
+                image_paths = render_pool.wait()
+                fields["bytes"] = self.files.get_total_size(image_paths)
+        finally:
+            render_pool.close()
+
+        return (power_matrices, json_paths + image_paths)
+
+    # All time matrices from `PowerMatrixDataHandler.calculate_power_matrices_sql`,
+    # returned like `build_accumulator_visualizations`. Each PTO is rendered
+    # while the next one is computed
+    def build_sql_visualizations(self, power_matrix_handler):
+        from PowerMatrixRenderPool import PowerMatrixRenderPool
 
-            for pto in pto_col_names:
-                print(f"\tBuilding {pto} vizualization...")
-                power_matrix_result = (
-                    PowerMatrixDataHandler().calculate_power_matrix_mean(
-                        power_df, spectra_df, pto
+        render_pool = PowerMatrixRenderPool(self.render_workers, context=self.context)
+        power_matrix_json = PowerMatrixJson(self.context)
+        try:
+            # Matrices are rendered while the next ones are computed, or in
+            # this process with one render worker, so the stage covers both
+            with self.logger.timed(__name__, "render_power_matrices") as fields:
+                power_matrices = {}
+                json_paths = []
+                for pto in self.pto_col_names:
+                    window_statistics = (
+                        power_matrix_handler.calculate_power_matrix_statistics_sql(
+                            self.db, self.spectra.stations.primary_station, [pto]
+                        ).get(pto)
                     )
-                )
 
-                if power_matrix_result is not None:
-                    power_matrix_data = power_matrix_result[0]
-                    nanosecond_timestamps = power_matrix_result[1]
+                    if window_statistics is None:
+                        continue
+
+                    print(f"\tBuilding {pto} vizualization...")
+
+                    statistics, timestamps = window_statistics
+                    json_paths.append(
+                        power_matrix_json.write(statistics, pto, timestamps)
+                    )
+
+                    power_matrices[pto] = {"all": (statistics["mean"], timestamps)}
+                    self.render_power_matrix(
+                        render_pool, pto, "all", statistics["mean"], timestamps
+                    )
+
+                image_paths = render_pool.wait()
+                fields["bytes"] = self.files.get_total_size(image_paths)
+        finally:
+            render_pool.close()
+
+        return (power_matrices, json_paths + image_paths)
 
-                    earliest_timestamp = nanosecond_timestamps.iloc[0]
-                    latest_timestamp = nanosecond_timestamps.iloc[-1]
+    # Every PTO and window recomputed from the full `triton_c` history, one
+    # task per PTO and window in `power_matrix_workers` processes. Returned
+    # like `build_accumulator_visualizations`
+    def build_recomputed_visualizations(self, power_matrix_handler):
+        from PowerMatrixRenderPool import PowerMatrixRenderPool
 
-                    # Define the Honolulu timezone using zoneinfo
-                    honolulu_tz = ZoneInfo("Pacific/Honolulu")
+        render_pool = PowerMatrixRenderPool(self.render_workers, context=self.context)
+        power_matrix_json = PowerMatrixJson(self.context)
+        try:
+            with self.logger.timed(__name__, "read_power_matrix_data") as fields:
+                power_df = self.triton_c.db.select_triton_c_since(None)
+                spectra_df = self.spectra.read_spectra()
+                fields["rows"] = len(power_df) + len(spectra_df)
+
+            with self.logger.timed(
+                __name__,
+                "calculate_power_matrices",
+                workers=self.power_matrix_workers,
+            ):
+                results = power_matrix_handler.calculate_power_matrices_parallel(
+                    power_df,
+                    spectra_df,
+                    self.pto_col_names,
+                    self.power_matrix_windows,
+                    max_workers=self.power_matrix_workers,
+                )
 
-                    # Convert to Honolulu time
-                    earliest_honolulu_time = earliest_timestamp.astimezone(honolulu_tz)
-                    latest_honolulu_time = latest_timestamp.astimezone(honolulu_tz)
+            with self.logger.timed(__name__, "render_power_matrices") as fields:
+                power_matrices = {}
+                json_paths = []
+                for pto in self.pto_col_names:
+                    power_matrices[pto] = {}
+                    for window, (statistics, timestamps) in results[pto].items():
+                        print(f"\tBuilding {pto} {window} vizualization...")
+
+                        # The statistics of `PowerMatrixAccumulator.get_statistics`
+                        window_statistics = {
+                            "mean": statistics["PM_mean"],
+                            "count": statistics["P"]["count"],
+                            "std": statistics["P"]["std"],
+                        }
+                        json_paths.append(
+                            power_matrix_json.write(
+                                window_statistics, pto, timestamps, window
+                            )
+                        )
 
-                    # Format the timestamps to the desired string format
-                    earliest_str = earliest_honolulu_time.strftime("%Y-%m-%d %H:%M")
-                    latest_str = latest_honolulu_time.strftime("%Y-%m-%d %H:%M")
+                        power_matrices[pto][window] = (
+                            statistics["PM_mean"],
+                            timestamps,
+                        )
+                        self.render_power_matrix(
+                            render_pool, pto, window, statistics["PM_mean"], timestamps
+                        )
 
-                    if power_matrix_data is not None:
-                        viz_generator.build_power_matrix_mean_visualization(
-                            power_matrix_data,
-                            pto,
-                            f"Triton-C {pto}",
-                            f"{earliest_str} to {latest_str} Pacific/Honolulu",
-                            nanosecond_timestamps,
+                image_paths = render_pool.wait()
+                fields["bytes"] = self.files.get_total_size(image_paths)
+        finally:
+            render_pool.close()
+
+        return (power_matrices, json_paths + image_paths)
+
+    # Queue one matrix on `render_pool`, titled with its date range in
+    # Honolulu time
+    def render_power_matrix(
+        self, render_pool, pto, window, power_matrix_data, nanosecond_timestamps
+    ):
+        earliest_timestamp = nanosecond_timestamps.iloc[0]
+        latest_timestamp = nanosecond_timestamps.iloc[-1]
+
+        # Define the Honolulu timezone using zoneinfo
+        honolulu_tz = ZoneInfo("Pacific/Honolulu")
+
+        # Convert to Honolulu time
+        earliest_honolulu_time = earliest_timestamp.astimezone(honolulu_tz)
+        latest_honolulu_time = latest_timestamp.astimezone(honolulu_tz)
+
+        # Format the timestamps to the desired string format
+        earliest_str = earliest_honolulu_time.strftime("%Y-%m-%d %H:%M")
+        latest_str = latest_honolulu_time.strftime("%Y-%m-%d %H:%M")
+
+        render_pool.submit(
+            power_matrix_data,
+            pto,
+            f"Triton-C {pto}",
+            f"{earliest_str} to {latest_str} Pacific/Honolulu",
+            nanosecond_timestamps,
+            window,
+        )
+
+    # Run manually to verify the power matrix accumulators
+    # Rebuilds them from the full `triton_c` history, logs how far the
+    # incrementally updated matrices were from the rebuilt ones and saves the
+    # rebuilt accumulators
+    def rebuild_power_matrix_accumulators(self):
+        with self.logger.timed(__name__, "rebuild_power_matrix_accumulators"):
+            try:
+                power_matrix_handler = PowerMatrixDataHandler(self.context)
+
+                incremental = power_matrix_handler.load_power_matrix_accumulators(
+                    self.pto_col_names
+                )
+                rebuilt = {
+                    pto: PowerMatrixAccumulator(pto, self.context)
+                    for pto in self.pto_col_names
+                }
+
+                power_matrix_handler.update_power_matrix_accumulators(
+                    rebuilt,
+                    self.triton_c.db.select_triton_c_since(None),
+                    self.spectra.read_spectra(),
+                )
+
+                for pto in self.pto_col_names:
+                    incremental_matrix = incremental[pto].to_power_matrix()
+                    rebuilt_matrix = rebuilt[pto].to_power_matrix()
+
+                    if incremental_matrix is None or rebuilt_matrix is None:
+                        difference = "n/a, one of the matrices is empty"
+                    elif incremental_matrix.shape != rebuilt_matrix.shape:
+                        difference = f"shapes differ {incremental_matrix.shape} != {rebuilt_matrix.shape}"
+                    else:
+                        difference = np.nanmax(
+                            np.abs(incremental_matrix.values - rebuilt_matrix.values),
+                            initial=0,
                         )
-        except Exception as e:
-            self.logger.error("build_visualizations", e)
 
-        self.logger.info(__name__, "Finished build_visualizations!")
+                    self.logger.info(
+                        __name__,
+                        f"{pto} incremental vs rebuilt power matrix max difference: {difference}",
+                    )
+
+                    rebuilt[pto].save()
+
+                PowerMatrixCache(self.context).clear()
+            except Exception as e:
+                self.logger.error("rebuild_power_matrix_accumulators", e)
+
+    # Runs until stopped, serves the dashboard data over HTTP on
+    # http://127.0.0.1:8050, see `DashboardAPI`
+    def serve_dashboard_api(self):
+        from DashboardAPI import DashboardAPI
+
+        with self.logger.timed(__name__, "serve_dashboard_api"):
+            try:
+                DashboardAPI(context=self.context).serve()
+            except Exception as e:
+                self.logger.error("serve_dashboard_api", e)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,53 @@
 import sqlite3
+from pathlib import Path
 
 import pandas as pd
 
-from FileManager import FileManager
+from AppContext import AppContext
 
 
 class SQLite:
-    def __init__(self):
-        self.fm = FileManager()
+    # `read_only` connections can't write, a writer can't be blocked by them
+    # holding a write lock, and can be used from any thread, one at a time.
+    # Jobs share the connection of `AppContext.db`
+    def __init__(self, read_only=False, context=None):
+        self.fm = (context or AppContext.get()).file_manager
         self.db_fname = self.fm.get_db_filepath()
+        self.read_only = read_only
 
         (self.con, self.cursor) = self.init_db_connection()
 
     # Initialize the sqlite database connection, gracefully handle any errors
     def init_db_connection(self):
-        con = sqlite3.connect(self.db_fname)
+        if self.read_only:
+            con = sqlite3.connect(
+                f"{Path(self.db_fname).resolve().as_uri()}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            con = sqlite3.connect(self.db_fname)
         cursor = con.cursor()
         return (con, cursor)
 
+    # Changes whenever another connection commits to the database, see
+    # https://www.sqlite.org/pragma.html#pragma_data_version
+    def select_data_version(self):
+        return self.cursor.execute("PRAGMA data_version;").fetchone()[0]
+
+    # Schema changes are numbered with `PRAGMA user_version`, a database at
+    # `schema_version` needs no migration. 1: `spectra` keyed by Station and
+    # Timestamp with the Hm0_Bin and Te_Bin columns
+    schema_version = 1
+
+    def select_user_version(self):
+        return self.cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+    # PRAGMA values can't be bound parameters
+    def set_user_version(self, version):
+        self.cursor.execute(f"PRAGMA user_version = {int(version)};")
+        self.con.commit()
+
     def finish(self):
         self.con.close()
 
@@ -117,6 +147,276 @@ SELECT Timestamp, GPS_Lat, GPS_Lng, Is_Deployed, Is_Maint, PTO_Bow_Power_kW, PTO
 
         return self.set_df_timestamp_to_index(df)
 
+    # Power rows at or after `timestamp` (unix epoch ns integer), all rows if
+    # `timestamp` is None
+    def select_triton_c_since(self, timestamp):
+        if timestamp is None:
+            timestamp = 0
+
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp, Is_Deployed, Is_Maint, PTO_Bow_Power_kW, PTO_Starboard_Power_kW, PTO_Port_Power_kW, Total_Power_kW
+    FROM triton_c
+    WHERE Timestamp >= ?
+    ORDER BY Timestamp;
+""",
+            self.con,
+            index_col="Timestamp",
+            params=(int(timestamp),),
+        )
+
+        return self.set_df_timestamp_to_index(df)
+
+    # Up to `limit` rows of the power columns after `timestamp` (unix epoch ns
+    # integer), oldest first. Timestamp is kept as a unix epoch ns column so
+    # the next page starts after the last returned Timestamp
+    def select_triton_c_power_after(self, timestamp, limit):
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp, PTO_Bow_Power_kW, PTO_Port_Power_kW, PTO_Starboard_Power_kW, Total_Power_kW
+    FROM triton_c
+    WHERE Timestamp > ?
+    ORDER BY Timestamp
+    LIMIT ?;
+""",
+            self.con,
+            params=(int(timestamp), int(limit)),
+        )
+
+        return df
+
+    # Up to `limit` rows with a GPS position after `timestamp` (unix epoch ns
+    # integer), oldest first, paged like `select_triton_c_power_after`
+    def select_triton_c_gps_after(self, timestamp, limit):
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp, GPS_Lat, GPS_Lng
+    FROM triton_c
+    WHERE Timestamp > ? AND GPS_Lat IS NOT NULL AND GPS_Lng IS NOT NULL
+    ORDER BY Timestamp
+    LIMIT ?;
+""",
+            self.con,
+            params=(int(timestamp), int(limit)),
+        )
+
+        return df
+
+    # Count, mean, min and max of each power column per bucket of `width_ns`
+    # for rows from `start` up to `end` (unix epoch ns integers). Bucket is the
+    # unix epoch ns start of the bucket, buckets without rows are left out
+    def select_triton_c_rollup(self, start, end, width_ns):
+        df = pd.read_sql(
+            f"""
+SELECT
+    Timestamp / :width_ns * :width_ns AS Bucket,
+    COUNT(*) AS Count,
+    AVG(PTO_Bow_Power_kW) AS PTO_Bow_Power_kW_mean,
+    MIN(PTO_Bow_Power_kW) AS PTO_Bow_Power_kW_min,
+    MAX(PTO_Bow_Power_kW) AS PTO_Bow_Power_kW_max,
+    AVG(PTO_Port_Power_kW) AS PTO_Port_Power_kW_mean,
+    MIN(PTO_Port_Power_kW) AS PTO_Port_Power_kW_min,
+    MAX(PTO_Port_Power_kW) AS PTO_Port_Power_kW_max,
+    AVG(PTO_Starboard_Power_kW) AS PTO_Starboard_Power_kW_mean,
+    MIN(PTO_Starboard_Power_kW) AS PTO_Starboard_Power_kW_min,
+    MAX(PTO_Starboard_Power_kW) AS PTO_Starboard_Power_kW_max,
+    AVG(Total_Power_kW) AS Total_Power_kW_mean,
+    MIN(Total_Power_kW) AS Total_Power_kW_min,
+    MAX(Total_Power_kW) AS Total_Power_kW_max
+FROM triton_c
+WHERE Timestamp >= :start AND Timestamp < :end
+GROUP BY Bucket
+ORDER BY Bucket;
+""",
+            self.con,
+            params={"start": int(start), "end": int(end), "width_ns": int(width_ns)},
+        )
+
+        return df
+
+    # The last stored Is_Deployed and Is_Maint values before `timestamp` (unix
+    # epoch ns integer) as a dict, None for unknown values. Both are only
+    # stored when they change
+    def select_triton_c_state_before(self, timestamp):
+        state = {"Is_Deployed": None, "Is_Maint": None}
+        if timestamp is None:
+            return state
+
+        for column in state:
+            result = self.cursor.execute(
+                f"""
+SELECT {column}
+    FROM triton_c
+    WHERE Timestamp < ? AND {column} IS NOT NULL
+    ORDER BY Timestamp DESC
+    LIMIT 1;
+""",
+                (int(timestamp),),
+            ).fetchone()
+
+            if result is not None:
+                state[column] = result[0]
+
+        return state
+
+    # Rows where Is_Deployed or Is_Maint changed, at or after `timestamp`
+    def select_triton_c_state_changes(self, timestamp=None):
+        if timestamp is None:
+            timestamp = 0
+
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp, Is_Deployed, Is_Maint
+    FROM triton_c
+    WHERE Timestamp >= ? AND (Is_Deployed IS NOT NULL OR Is_Maint IS NOT NULL)
+    ORDER BY Timestamp;
+""",
+            self.con,
+            index_col="Timestamp",
+            params=(int(timestamp),),
+        )
+
+        return self.set_df_timestamp_to_index(df)
+
+    # Half-hour power matrix input computed inside SQLite, only the per bin
+    # result set is returned. `column` is a triton_c power column.
+    #   1. Samples of `column` at or after `start` (unix epoch ns) that are not
+    #      in `excluded_periods`, a list of (start, end) unix epoch ns ranges
+    #   2. Averaged per interval, bucket = Timestamp / `interval_ns`. Intervals
+    #      with fewer than `min_samples` samples or a gap (including the gaps
+    #      to the interval edges) longer than `max_gap_ns` are dropped
+    #   3. Joined to the `station` spectrum nearest to the interval start
+    #      within `tolerance_s` like `PowerSpectraJoiner.match_nearest`: the
+    #      last spectrum before the start or the first at or after it, ties go
+    #      to the earlier one, and a spectrum can serve several intervals.
+    #      Intervals whose nearest spectrum has no J or bins are dropped
+    #   4. Aggregated per stored (Hm0_Bin, Te_Bin)
+    # Returns a df with one row per occupied bin: Hm0_Bin, Te_Bin, Count,
+    # Mean_P, Sum_Sq_P (sum of squared P), Mean_L (capture length P / J),
+    # Mean_J, Max_Hm0, Max_Te, First_Bucket and Last_Bucket
+    def select_half_hour_power_bins(
+        self,
+        column,
+        station,
+        start,
+        interval_ns,
+        min_samples,
+        max_gap_ns,
+        tolerance_s,
+        excluded_periods,
+    ):
+        self.cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS excluded_periods(Start INT, End INT);"
+        )
+        self.cursor.execute("DELETE FROM temp.excluded_periods;")
+        self.cursor.executemany(
+            "INSERT INTO temp.excluded_periods VALUES (?, ?);",
+            [
+                (int(period_start), int(period_end))
+                for period_start, period_end in excluded_periods
+            ],
+        )
+
+        interval_s = interval_ns // 1_000_000_000
+
+        df = pd.read_sql(
+            f"""
+WITH samples AS (
+    SELECT
+        Timestamp,
+        {column} AS P,
+        Timestamp / :interval_ns AS Bucket,
+        CASE
+            WHEN LAG(Timestamp) OVER w / :interval_ns = Timestamp / :interval_ns
+            THEN Timestamp - LAG(Timestamp) OVER w
+        END AS Gap
+    FROM triton_c
+    WHERE Timestamp >= :start
+        AND {column} IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM temp.excluded_periods e
+            WHERE triton_c.Timestamp >= e.Start AND triton_c.Timestamp < e.End
+        )
+    WINDOW w AS (ORDER BY Timestamp)
+),
+intervals AS (
+    SELECT
+        Bucket,
+        AVG(P) AS Mean_P,
+        COUNT(*) AS Samples,
+        MAX(
+            COALESCE(MAX(Gap), 0),
+            MIN(Timestamp) - Bucket * :interval_ns,
+            (Bucket + 1) * :interval_ns - MAX(Timestamp)
+        ) AS Max_Gap
+    FROM samples
+    GROUP BY Bucket
+    HAVING Mean_P != 0 AND Samples >= :min_samples AND Max_Gap <= :max_gap_ns
+),
+neighbours AS (
+    SELECT
+        Bucket,
+        Bucket * :interval_s AS Start,
+        (
+            SELECT MAX(Timestamp) FROM spectra
+            WHERE Station = :station AND Timestamp < Bucket * :interval_s
+        ) AS Before,
+        (
+            SELECT MIN(Timestamp) FROM spectra
+            WHERE Station = :station AND Timestamp >= Bucket * :interval_s
+        ) AS After
+    FROM intervals
+),
+nearest_spectra AS (
+    SELECT
+        n.Bucket,
+        sp.Spectral_Hm0 AS Hm0,
+        sp.Spectral_Te AS Te,
+        sp.Spectral_J AS J,
+        sp.Hm0_Bin,
+        sp.Te_Bin
+    FROM neighbours n
+        JOIN spectra sp ON sp.Station = :station AND sp.Timestamp = CASE
+            WHEN n.After IS NULL OR n.Start - n.Before <= n.After - n.Start
+            THEN n.Before
+            ELSE n.After
+        END
+    WHERE ABS(sp.Timestamp - n.Start) <= :tolerance_s
+        AND sp.Spectral_J IS NOT NULL
+        AND sp.Hm0_Bin IS NOT NULL
+        AND sp.Te_Bin IS NOT NULL
+)
+SELECT
+    s.Hm0_Bin,
+    s.Te_Bin,
+    COUNT(*) AS Count,
+    AVG(ABS(i.Mean_P)) AS Mean_P,
+    SUM(i.Mean_P * i.Mean_P) AS Sum_Sq_P,
+    AVG(ABS(i.Mean_P) / s.J) AS Mean_L,
+    AVG(s.J) AS Mean_J,
+    MAX(s.Hm0) AS Max_Hm0,
+    MAX(s.Te) AS Max_Te,
+    MIN(i.Bucket) AS First_Bucket,
+    MAX(i.Bucket) AS Last_Bucket
+FROM intervals i
+    JOIN nearest_spectra s ON i.Bucket = s.Bucket
+GROUP BY s.Hm0_Bin, s.Te_Bin
+ORDER BY s.Hm0_Bin, s.Te_Bin;
+""",
+            self.con,
+            params={
+                "start": int(start),
+                "interval_ns": int(interval_ns),
+                "interval_s": int(interval_s),
+                "min_samples": min_samples,
+                "max_gap_ns": int(max_gap_ns),
+                "tolerance_s": int(tolerance_s),
+                "station": station,
+            },
+        )
+
+        return df
+
     def select_all_triton_c_with_power(self):
         df = pd.read_sql(
             f"""
@@ -360,15 +660,19 @@ SELECT Timestamp, Is_Deployed, Is_Maint, PTO_Bow_Power_kW, PTO_Starboard_Power_k
         return self.select_matching_timestamps("power_performance", timestamp_list)
 
     # `spectra` Table
-    # Timestamp: Unix Time as integer, UNIQUE allows one row per timestamp
+    # Station: Station id from StationRegistry as string
+    # Timestamp: Unix Time as integer, UNIQUE with Station allows one row per station and timestamp
     # Raw_Timestamp: Original timestamp as string
     # Te: Real
     # Hm0: Real
     # J: Real
+    # Hm0_Bin, Te_Bin: Integer bin indices of Hm0 and Te on the fixed power
+    #     matrix grid (PowerMatrixBins.fixed), see `update_spectra_bins`
     def init_spectra_table(self):
         command = """
 CREATE TABLE spectra(
-    Timestamp INT UNIQUE,
+    Station TEXT NOT NULL,
+    Timestamp INT,
     Raw_Timestamp TEXT DEFAULT NULL,
     Spectral_Hm0 REAL DEFAULT NULL,
     Spectral_Te REAL DEFAULT NULL,
@@ -382,30 +686,159 @@ CREATE TABLE spectra(
     WMI_waveTa REAL DEFAULT NULL,
     WMI_waveDp REAL DEFAULT NULL,
     WMI_wavePeakPSD REAL DEFAULT NULL,
-    WMI_waveTz REAL DEFAULT NULL
+    WMI_waveTz REAL DEFAULT NULL,
+    Hm0_Bin INT DEFAULT NULL,
+    Te_Bin INT DEFAULT NULL,
+    UNIQUE(Station, Timestamp)
 )
         """
         self.execute_sql(command)
 
+    def get_table_columns(self, table):
+        result = self.execute_sql(f"PRAGMA table_info({table});")
+        if result is None:
+            return []
+        # PRAGMA table_info rows are (cid, name, type, notnull, dflt_value, pk)
+        return [row[1] for row in result]
+
+    # (largest Timestamp, number of rows) of `table`. The tables are append
+    # only, so this changes whenever rows are added
+    def select_table_summary(self, table):
+        result = self.cursor.execute(
+            f"SELECT MAX(Timestamp), COUNT(*) FROM {table};"
+        ).fetchone()
+        return (result[0], result[1])
+
+    # Older databases have a `spectra` table keyed by Timestamp only, with
+    # every row from `default_station`. SQLite can't change a UNIQUE
+    # constraint in place, so the table is rebuilt with the Station column
+    def migrate_spectra_table(self, default_station):
+        columns = self.get_table_columns("spectra")
+        if len(columns) == 0 or "Station" in columns:
+            return
+
+        column_list = ", ".join(columns)
+
+        self.cursor.execute("ALTER TABLE spectra RENAME TO spectra_legacy;")
+        self.init_spectra_table()
+        self.cursor.execute(
+            f"""
+INSERT INTO spectra (Station, {column_list})
+    SELECT ?, {column_list} FROM spectra_legacy;
+""",
+            (default_station,),
+        )
+        self.cursor.execute("DROP TABLE spectra_legacy;")
+        self.con.commit()
+
+    # Databases created before the bin columns existed
+    def migrate_spectra_bins(self):
+        columns = self.get_table_columns("spectra")
+        if len(columns) == 0:
+            return
+
+        for column in ["Hm0_Bin", "Te_Bin"]:
+            if column not in columns:
+                self.cursor.execute(
+                    f"ALTER TABLE spectra ADD COLUMN {column} INT DEFAULT NULL;"
+                )
+        self.con.commit()
+
+    # Store the bin index of each row, like PowerMatrixBins.get_axis_indices:
+    # round(value / width) clipped to the grid. Only rows without bins unless
+    # `only_missing` is False, e.g. after the QOI are recomputed
+    def update_spectra_bins(
+        self, Hm0_width, Te_width, num_Hm0_bins, num_Te_bins, only_missing=True
+    ):
+        where = "WHERE Hm0_Bin IS NULL OR Te_Bin IS NULL" if only_missing else ""
+        self.cursor.execute(
+            f"""
+UPDATE spectra
+    SET Hm0_Bin = MAX(0, MIN(CAST(Spectral_Hm0 / :Hm0_width + 0.5 AS INT), :max_Hm0_bin)),
+        Te_Bin = MAX(0, MIN(CAST(Spectral_Te / :Te_width + 0.5 AS INT), :max_Te_bin))
+    {where};
+""",
+            {
+                "Hm0_width": Hm0_width,
+                "Te_width": Te_width,
+                "max_Hm0_bin": num_Hm0_bins - 1,
+                "max_Te_bin": num_Te_bins - 1,
+            },
+        )
+        self.con.commit()
+
     def insert_spectra(self, df):
         # df.to_sql("spectra", self.con, if_exists="append", index_label="Timestamp")
         df.to_sql("spectra", self.con, if_exists="append", index=False)
         self.con.commit()
 
-    def select_spectra(self):
+    # Overwrite the "Spectral_" QOI columns of existing rows with the values in
+    # `df`, other columns are left as they are
+    def update_spectra_qoi(self, station, df):
+        columns = [col for col in df.columns if col.startswith("Spectral_")]
+        assignments = ", ".join([f"{col} = ?" for col in columns])
+
+        rows = zip(
+            *[df[col].astype(float).tolist() for col in columns],
+            [station] * len(df),
+            df["Timestamp"].astype(int).tolist(),
+        )
+
+        self.cursor.executemany(
+            f"UPDATE spectra SET {assignments} WHERE Station = ? AND Timestamp = ?;",
+            rows,
+        )
+        self.con.commit()
+
+    # Spectra of `station` from `since` (unix epoch seconds, None for all) on
+    def select_spectra(self, station, since=None):
+        if since is None:
+            since = 0
+
         df = pd.read_sql(
             f"""
 SELECT Timestamp, Raw_Timestamp, Spectral_Te, Spectral_Hm0, Spectral_J
     FROM spectra
+    WHERE Station = ? AND Timestamp >= ?
     ORDER BY Timestamp;
 """,
             self.con,
             index_col="Timestamp",
+            params=(station, int(since)),
         )
 
-        df = df.rename(columns=lambda x: x.strip("Spectral_"))
+        df = df.rename(columns=lambda x: x.removeprefix("Spectral_"))
 
         return self.set_df_timestamp_to_index(df)
 
-    def select_matching_spectra_timestamps(self, timestamp_list):
-        return self.select_matching_timestamps("spectra", timestamp_list)
+    # Spectral QOIs of `station` from `start` up to `end` (unix epoch seconds)
+    # with the Spectral_ prefix removed, at most `limit` rows, oldest first
+    def select_spectra_qoi(self, station, start, end, limit):
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp, Spectral_Hm0, Spectral_Te, Spectral_J, Spectral_Tavg, Spectral_Tm, Spectral_Tp, Spectral_Tz
+    FROM spectra
+    WHERE Station = ? AND Timestamp >= ? AND Timestamp < ?
+    ORDER BY Timestamp
+    LIMIT ?;
+""",
+            self.con,
+            params=(station, int(start), int(end), int(limit)),
+        )
+
+        return df.rename(columns=lambda x: x.removeprefix("Spectral_"))
+
+    def select_matching_spectra_timestamps(self, timestamp_list, station):
+        timestamp_list = pd.to_numeric(timestamp_list)
+        df = pd.read_sql(
+            f"""
+SELECT Timestamp
+    FROM spectra
+    WHERE Station = ? AND Timestamp in ({", ".join([f"'{str(x)}'" for x in timestamp_list])})
+    ORDER BY Timestamp;
+""",
+            self.con,
+            params=(station,),
+        )
+        df["Timestamp"] = pd.to_numeric(df["Timestamp"])
+        return df
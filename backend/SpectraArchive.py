@@ -0,0 +1,264 @@
+import numpy as np
+import xarray as xr
+
+from CDIPDatasetLoader import CDIPDatasetLoader
+from AppContext import AppContext
+
+
+# Append-only archive of the CDIP `waveTime` variables for one station.
+#
+# The archive is a chunked Zarr store that grows along the `waveTime`
+# dimension. Each update only writes timestamps that are newer than the last
+# archived timestamp, so the cost of an update depends on the size of the new
+# realtime file and not on the length of the deployment. Because timestamps are
+# only ever appended in ascending order `waveTime` stays sorted, and lookups
+# use a binary search over the time index instead of scanning the store.
+class SpectraArchive:
+    def __init__(self, station, context=None):
+        context = context or AppContext.get()
+
+        self.station = station
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.store_path = self.file_manager.get_cdip_realtime_zarr_path(station)
+        self.time_dim = "waveTime"
+
+        # Number of `waveTime` entries per chunk. CDIP realtime files hold
+        # roughly a month of half-hourly data, so one chunk is ~3 weeks
+        self.time_chunk_size = 1024
+
+        self.loader = CDIPDatasetLoader()
+
+        # Meta variables that don't have dimensions, these are written once
+        # when the store is created
+        self.meta_vars = self.loader.meta_vars
+
+    def exists(self):
+        return self.store_path.exists()
+
+    def open(self):
+        """Lazily open the archive, nothing is read until values are accessed."""
+        return xr.open_dataset(self.store_path, engine="zarr", chunks=None)
+
+    def read_time_index(self):
+        """Return the sorted archived `waveTime` values as unix epoch ns integers."""
+        if self.exists() is False:
+            return np.array([], dtype=np.int64)
+
+        with self.open() as ds:
+            return self.to_ns(ds[self.time_dim].values)
+
+    def select(self, start=None, end=None):
+        """Return the archived data between `start` and `end` (inclusive).
+
+        `start` and `end` are anything `np.datetime64` understands. The time
+        index is sorted, so the slice bounds come from a binary search.
+        """
+        time_index = self.read_time_index()
+
+        first = 0
+        last = len(time_index)
+        if start is not None:
+            first = np.searchsorted(time_index, self.to_ns(start), side="left")
+        if end is not None:
+            last = np.searchsorted(time_index, self.to_ns(end), side="right")
+
+        return self.open().isel({self.time_dim: slice(first, last)})
+
+    # Append the `waveTime` variables of `ds_new` that are not yet in the
+    # archive. Returns the number of timestamps written
+    def append(self, ds_new):
+        if self.exists() is False:
+            self.import_existing_netcdf()
+
+        ds_wave = self.get_wave_time_dataset(ds_new)
+        new_times = self.to_ns(ds_wave[self.time_dim].values)
+
+        # Sort and drop duplicate timestamps within the incoming file
+        new_times, unique_idx = np.unique(new_times, return_index=True)
+        ds_wave = ds_wave.isel({self.time_dim: unique_idx})
+
+        if self.exists() is False:
+            self.create(ds_wave, ds_new)
+            return len(new_times)
+
+        existing_times = self.read_time_index()
+
+        if len(existing_times) > 0:
+            last_archived = existing_times[-1]
+
+            # Timestamps that are missing from the archive but older than the
+            # last archived timestamp can't be appended without breaking the
+            # sort order of `waveTime`
+            pos = np.searchsorted(existing_times, new_times)
+            is_archived = (pos < len(existing_times)) & (
+                existing_times[np.minimum(pos, len(existing_times) - 1)] == new_times
+            )
+            is_out_of_order = (~is_archived) & (new_times < last_archived)
+
+            if is_out_of_order.any():
+                self.logger.warning(
+                    __name__,
+                    f"Skipping {is_out_of_order.sum()} out of order timestamps for station {self.station}",
+                )
+
+            is_new = new_times > last_archived
+            ds_wave = ds_wave.isel({self.time_dim: np.flatnonzero(is_new)})
+            new_times = new_times[is_new]
+
+        if len(new_times) == 0:
+            self.logger.info(
+                __name__, f"No new spectra to archive for station {self.station}"
+            )
+            return 0
+
+        with self.open() as ds_existing:
+            if self.has_matching_frequencies(ds_existing, ds_new) is False:
+                self.logger.error(
+                    __name__,
+                    f"waveFrequency of the new dataset does not match the archive for station {self.station}. Not archiving.",
+                )
+                return 0
+
+            self.check_metadata(ds_existing, ds_new)
+
+            archived_vars = [
+                var
+                for var in ds_existing.variables
+                if self.time_dim in ds_existing[var].dims
+            ]
+
+        # Every archived variable has to grow together along `waveTime`
+        missing_vars = [var for var in archived_vars if var not in ds_wave.variables]
+        if len(missing_vars) > 0:
+            self.logger.error(
+                __name__,
+                f"New dataset is missing archived variables {missing_vars} for station {self.station}. Not archiving.",
+            )
+            return 0
+
+        # Only the variables along the append dimension are written, the
+        # frequency coordinate and meta variables are already in the store
+        append_vars = archived_vars
+        ds_wave = self.clear_encoding(ds_wave[append_vars])
+        ds_wave.to_zarr(self.store_path, mode="a", append_dim=self.time_dim)
+
+        self.logger.info(
+            __name__,
+            f"Archived {len(new_times)} new spectra for station {self.station}",
+        )
+
+        return len(new_times)
+
+    def create(self, ds_wave, ds_source):
+        ds_wave = ds_wave.copy()
+        ds_wave.attrs = ds_source.attrs
+
+        for var in self.meta_vars:
+            if var in ds_source.variables:
+                ds_wave[var] = ds_source[var]
+
+        ds_wave = self.clear_encoding(ds_wave)
+
+        encoding = {
+            self.time_dim: {"units": "seconds since 1970-01-01", "dtype": "int64"}
+        }
+        for var in ds_wave.data_vars:
+            if self.time_dim in ds_wave[var].dims:
+                chunks = [
+                    self.time_chunk_size if dim == self.time_dim else size
+                    for dim, size in ds_wave[var].sizes.items()
+                ]
+                encoding[var] = {"chunks": chunks}
+
+        ds_wave.to_zarr(self.store_path, mode="w", encoding=encoding)
+
+        self.logger.info(
+            __name__,
+            f"Created spectra archive {self.store_path} with {ds_wave.sizes[self.time_dim]} timestamps",
+        )
+
+    # Seed the archive from the legacy concatenated NetCDF file if it exists.
+    # Duplicate timestamps in the legacy file are removed
+    def import_existing_netcdf(self):
+        legacy_path = self.file_manager.get_existing_cdip_realtime_nc_path(
+            self.station
+        )
+        if legacy_path.exists() is False:
+            return
+
+        self.logger.info(__name__, f"Importing {legacy_path} into {self.store_path}")
+
+        with self.loader.open(legacy_path) as ds_legacy:
+            ds_wave = self.get_wave_time_dataset(ds_legacy)
+            legacy_times = self.to_ns(ds_wave[self.time_dim].values)
+            _, unique_idx = np.unique(legacy_times, return_index=True)
+            ds_wave = ds_wave.isel({self.time_dim: unique_idx}).load()
+            self.create(ds_wave, ds_legacy)
+
+    def get_wave_time_dataset(self, ds):
+        wave_time_vars = {
+            var: ds[var] for var in ds.data_vars if self.time_dim in ds[var].dims
+        }
+        return xr.Dataset(wave_time_vars)
+
+    def has_matching_frequencies(self, ds_existing, ds_new):
+        if "waveFrequency" not in ds_existing.variables:
+            return True
+        if "waveFrequency" not in ds_new.variables:
+            return True
+
+        return np.array_equal(
+            ds_existing["waveFrequency"].values, ds_new["waveFrequency"].values
+        )
+
+    # Check global attributes and meta variables against the archive, values
+    # in the archive are always kept
+    def check_metadata(self, ds_existing, ds_new):
+        for attr, value in ds_new.attrs.items():
+            if attr in ds_existing.attrs and not np.array_equal(
+                ds_existing.attrs[attr], value
+            ):
+                self.logger.warning(
+                    __name__,
+                    f"Attribute '{attr}' differs between datasets. Keeping value from the existing dataset.",
+                )
+            elif attr not in ds_existing.attrs:
+                self.logger.warning(
+                    __name__,
+                    f"New attribute '{attr}' found in the new dataset. Ignoring it.",
+                )
+
+        for var in self.meta_vars:
+            if var in ds_existing.variables:
+                if var in ds_new.variables and not np.array_equal(
+                    ds_existing[var].values, ds_new[var].values
+                ):
+                    self.logger.warning(
+                        __name__,
+                        f"Meta variable '{var}' differs between datasets. Keeping value from the existing dataset.",
+                    )
+            elif var in ds_new.variables:
+                self.logger.warning(
+                    __name__,
+                    f"Meta variable '{var}' found only in the new dataset. It is not added to the archive.",
+                )
+
+    # Encodings copied from the source NetCDF file (compression, chunk sizes,
+    # fill values) do not apply to the Zarr store
+    def clear_encoding(self, ds):
+        for var in ds.variables:
+            ds[var].encoding = {}
+        return ds
+
+    def to_ns(self, values):
+        return np.asarray(values, dtype="datetime64[ns]").astype(np.int64)
+
+
+if __name__ == "__main__":
+    archive = SpectraArchive("225")
+    time_index = archive.read_time_index()
+    print(f"{archive.store_path}: {len(time_index)} timestamps")
+    if len(time_index) > 0:
+        print(np.datetime64(time_index[0], "ns"), np.datetime64(time_index[-1], "ns"))
@@ -1,107 +1,237 @@
-import xarray as xr
+import os
 
-from CDIPRealTimeParser import CDIPRealTimeParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from AppContext import AppContext
 from DataHandler import DataHandler
-from FileManager import FileManager
 from Logger import Logger
-from SQLite import SQLite
+from PowerMatrixBins import PowerMatrixBins
+from SpectralDensityStore import SpectralDensityStore
+from StationRegistry import StationRegistry
+
+
+# Download, parse and archive the latest spectra for one station. Returns the
+# station id and a DataFrame of spectral QOI ready for the `spectra` table, or
+# None if nothing could be parsed.
+#
+# This runs in a worker process, so it only touches files owned by the
+# station (the downloaded file, the station archive and the spectral density
+# store) and leaves database writes to the parent process. `context` is the
+# parent's `AppContext`, unpickled to the worker's own
+def collect_station_spectra(station_id, context=None):
+    # The parsers and the archive import xarray and mhkit, only the collection
+    # jobs import them
+    from CDIPRealTimeParser import CDIPRealTimeParser
+    from NDBCRealTimeRawSpectralParser import NDBCRealTimeRawSpectralParser
+    from SpectraArchive import SpectraArchive
+
+    context = context or AppContext.get()
+    logger = context.logger
+    station = StationRegistry().get(station_id)
+
+    density_store = SpectralDensityStore(station_id, context)
+
+    if station["source"] == "cdip":
+        wmi_df, ds_new = CDIPRealTimeParser(station_id, context).parse_latest_nc_file()
+
+        if wmi_df is not None:
+            # Append only the new `waveTime` entries to the station archive
+            SpectraArchive(station_id, context).append(ds_new)
+
+            density_store.append(
+                ds_new["waveTime"].values.astype("datetime64[ns]").astype(np.int64),
+                ds_new["waveFrequency"].values,
+                ds_new["waveEnergyDensity"].values,
+            )
+    elif station["source"] == "ndbc":
+        parser = NDBCRealTimeRawSpectralParser(station_id, context)
+        spectra_df, _ = parser.parse_latest_spec_file()
+
+        wmi_df = None
+        if spectra_df.empty is False:
+            wmi_df = parser.calculate_qoi(spectra_df, station["depth"])
+
+            density_store.append(
+                spectra_df.index.values, spectra_df.columns, spectra_df.values
+            )
+    else:
+        logger.error(
+            __name__, f"Unknown spectra source {station['source']} for {station_id}"
+        )
+        return (station_id, None)
+
+    if wmi_df is None:
+        logger.error(__name__, f"No spectra parsed for station {station_id}")
+        return (station_id, None)
+
+    wmi_df.insert(0, "Station", station_id)
+
+    return (station_id, wmi_df)
 
 
 class SpectraHandler(DataHandler):
-    def __init__(self):
-        super().__init__()
-        # https://cdip.ucsd.edu/m/products/?stn=225p1
-        self.CDIP_KBAY_STATION_NUMBER = "225"
+    def __init__(self, context=None):
+        super().__init__(context)
+        self.stations = StationRegistry()
+
+        self.db = self.context.db
+        self.file_manager = self.context.file_manager
+        self.logger = self.context.logger
 
-        self.db = SQLite()
-        self.file_manager = FileManager()
-        self.logger = Logger()
+        # Only databases from before `SQLite.schema_version` are inspected
+        if self.db.select_user_version() < self.db.schema_version:
+            self.db.migrate_spectra_table(self.stations.primary_station)
+            self.db.migrate_spectra_bins()
+            self.db.set_user_version(self.db.schema_version)
 
-    def update_spectra(self):
-        parser = CDIPRealTimeParser(self.CDIP_KBAY_STATION_NUMBER)
-        wmi_df, ds_new = parser.parse_latest_nc_file()
+        # Hm0 and Te are binned in the database for the SQL power matrix path
+        self.power_matrix_bins = PowerMatrixBins.fixed()
 
+    def db_update_spectra(self, station_id, wmi_df):
         # Upload the vap calculations to the db
         super(SpectraHandler, self).unique_insert(
-            wmi_df, self.db.insert_spectra, self.db.select_matching_spectra_timestamps
+            wmi_df,
+            self.db.insert_spectra,
+            partial(self.db.select_matching_spectra_timestamps, station=station_id),
         )
-
-        # Combine existing and new spectral data into one nc file and save it
-        ds_existing_path = self.file_manager.get_existing_cdip_realtime_nc_path(
-            self.CDIP_KBAY_STATION_NUMBER
+        self.update_spectra_bins()
+
+    def update_spectra_bins(self, only_missing=True):
+        self.db.update_spectra_bins(
+            self.power_matrix_bins.Hm0_width,
+            self.power_matrix_bins.Te_width,
+            *self.power_matrix_bins.shape,
+            only_missing=only_missing,
         )
 
-        ds_existing = xr.open_dataset(ds_existing_path)
-
-        wave_time_vars_existing = {
-            var: ds_existing[var]
-            for var in ds_existing.data_vars
-            if "waveTime" in ds_existing[var].dims
-        }
-        wave_time_vars_new = {
-            var: ds_new[var]
-            for var in ds_new.data_vars
-            if "waveTime" in ds_new[var].dims
-        }
-
-        # Create new datasets with just the 'waveTime' related variables
-        ds_existing_wave = xr.Dataset(wave_time_vars_existing)
-        ds_new_wave = xr.Dataset(wave_time_vars_new)
-
-        combined_wave_ds = xr.concat([ds_existing_wave, ds_new_wave], dim="waveTime")
-
-        # Include global attributes from the existing dataset and check for differences
-        combined_wave_ds.attrs = ds_existing.attrs
-        for attr, value in ds_new.attrs.items():
-            if attr in ds_existing.attrs and ds_existing.attrs[attr] != value:
-                self.logger.warning(
-                    __name__,
-                    f"Attribute '{attr}' differs between datasets. Keeping value from the existing dataset.",
-                )
-            elif attr not in ds_existing.attrs:
-                self.logger.warning(
-                    __name__,
-                    f"New attribute '{attr}' found in the new dataset. Ignoring it.",
-                )
+    # Update a single station in this process
+    def update_spectra(self, station_id=None):
+        if station_id is None:
+            station_id = self.stations.primary_station
+
+        _, wmi_df = collect_station_spectra(station_id, self.context)
+
+        if wmi_df is None:
+            return
+
+        self.db_update_spectra(station_id, wmi_df)
 
-        # Add meta variables that don't have dimensions from the existing dataset
-        meta_vars = [
-            "metaStationName",
-            "metaPlatform",
-            "metaInstrumentation",
-            "metaDeployLatitude",
-            "metaDeployLongitude",
-            "metaWaterDepth",
-            "metaDeclination",
-            "metaGridMapping",
-        ]
-
-        for var in meta_vars:
-            if var in ds_existing.variables:
-                combined_wave_ds[var] = ds_existing[var]
-                # Check if the variable is in the new dataset and differs
-                if var in ds_new.variables and not ds_existing[var].identical(
-                    ds_new[var]
-                ):
-                    # warnings.warn(
-                    self.logger.warning(
-                        __name__,
-                        f"Meta variable '{var}' differs between datasets. Keeping value from the existing dataset.",
+        return wmi_df
+
+    # Update every enabled station. Stations are downloaded and processed in
+    # parallel worker processes, the results are inserted into the database
+    # here as they complete. Returns the number of parsed spectra rows
+    def update_all_spectra(self, max_workers=None):
+        station_ids = self.stations.enabled_station_ids()
+        num_rows = 0
+
+        if max_workers is None:
+            max_workers = min(len(station_ids), os.cpu_count() or 1)
+
+        if max_workers <= 1:
+            for station_id in station_ids:
+                wmi_df = self.update_spectra(station_id)
+                if wmi_df is not None:
+                    num_rows += len(wmi_df)
+            return num_rows
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=Logger.init_worker,
+            initargs=(self.logger.get_worker_queue(),),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    collect_station_spectra, station_id, self.context
+                ): station_id
+                for station_id in station_ids
+            }
+
+            for future in as_completed(futures):
+                station_id = futures[future]
+                try:
+                    _, wmi_df = future.result()
+                except Exception as e:
+                    self.logger.error(
+                        __name__, f"Collecting station {station_id} failed with {e}"
                     )
-            elif var in ds_new.variables:
-                # Only add from the new dataset if it doesn't exist in the existing one
-                combined_wave_ds[var] = ds_new[var]
-                # warnings.warn(
-                self.logger.warning(
-                    __name__,
-                    f"Meta variable '{var}' found only in the new dataset. Adding it to the output.",
+                    continue
+
+                if wmi_df is not None:
+                    self.db_update_spectra(station_id, wmi_df)
+                    num_rows += len(wmi_df)
+
+        return num_rows
+
+    # Water depth for energy flux. Sources without depth in their files have it
+    # in the station registry, CDIP stations use the archived metaWaterDepth
+    def get_station_depth(self, station_id):
+        station = self.stations.get(station_id)
+        if station.get("depth") is not None:
+            return station["depth"]
+
+        from SpectraArchive import SpectraArchive
+
+        with SpectraArchive(station_id, self.context).open() as ds:
+            return float(ds["metaWaterDepth"].values)
+
+    # Recompute the spectral QOI columns of the `spectra` table for a station
+    # from the spectral density store, without downloading anything. Rows in
+    # the store but not in the table are inserted. `depth` overrides the
+    # station depth. Spectra are processed in chunks of `chunk_size` rows
+    # straight from the memory mapped store
+    def recompute_spectra_qoi(self, station_id=None, depth=None, chunk_size=50_000):
+        from SpectraQOICalculator import SpectraQOICalculator
+
+        if station_id is None:
+            station_id = self.stations.primary_station
+
+        if depth is None:
+            depth = self.get_station_depth(station_id)
+
+        calculator = SpectraQOICalculator()
+        store = SpectralDensityStore(station_id, self.context)
+        num_rows = 0
+
+        for version in store.grid_versions():
+            timestamps, frequencies, density = store.load(version)
+
+            for start in range(0, len(timestamps), chunk_size):
+                end = start + chunk_size
+                spectra_df = pd.DataFrame(
+                    density[start:end],
+                    index=pd.to_datetime(timestamps[start:end], unit="ns", utc=True),
+                    columns=frequencies,
                 )
 
-        self.file_manager.update_cdip_realtime_nc(
-            combined_wave_ds, self.CDIP_KBAY_STATION_NUMBER
+                result_df = calculator.calculate(spectra_df, depth)
+                result_df = calculator.index_by_unix_seconds(result_df)
+                result_df.insert(0, "Station", station_id)
+
+                self.db_update_spectra(station_id, result_df)
+                self.db.update_spectra_qoi(station_id, result_df)
+
+                num_rows += len(result_df)
+
+        # Hm0 and Te may have changed
+        self.update_spectra_bins(only_missing=False)
+
+        self.logger.info(
+            __name__,
+            f"Recomputed {num_rows} spectral QOI rows for station {station_id} with depth {depth}",
         )
 
-        return wmi_df
+        return num_rows
+
+    # Spectra of a station from `since_ns` (unix epoch ns, None for all) on
+    def read_spectra(self, station_id=None, since_ns=None):
+        if station_id is None:
+            station_id = self.stations.primary_station
+
+        since = None if since_ns is None else since_ns // 1_000_000_000
 
-    def read_spectra(self):
-        return self.db.select_spectra()
+        return self.db.select_spectra(station_id, since)
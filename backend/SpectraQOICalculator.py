@@ -0,0 +1,51 @@
+import pandas as pd
+
+
+# Calculate the spectral wave QOI stored in the `spectra` table.
+#
+# Every spectral source (CDIP NetCDF, NDBC data_spec) is reduced to the same
+# shape before it gets here: a DataFrame of spectral energy density with one
+# row per timestamp and one column per frequency (Hz). Keeping the QOI
+# calculation in one place means every source produces identical columns.
+class SpectraQOICalculator:
+    # Returns a DataFrame indexed like `spectra_df` with "Spectral_" prefixed
+    # columns for Hm0, Tz, Tavg, Tm, Tp, Te and J
+    def calculate(self, spectra_df, depth):
+        # mhkit imports scipy, sklearn and matplotlib, seconds of start up, so
+        # it is only imported by the jobs that calculate QOI
+        from mhkit import wave
+
+        # mhkit expects frequency as the index and one column per timestamp
+        df = spectra_df.copy()
+        df.columns = [float(col) for col in df.columns]
+        df = df.T
+
+        Hm_0 = wave.resource.significant_wave_height(df)
+        T_e = wave.resource.energy_period(df)
+        J = wave.resource.energy_flux(df, depth)
+        T_avg = wave.resource.average_crest_period(df)
+        T_m = wave.resource.average_wave_period(df)
+        T_p = wave.resource.peak_period(df)
+        T_z = wave.resource.average_zero_crossing_period(df)
+
+        # One column per QOI, all share the timestamp index
+        result_df = pd.concat([Hm_0, T_z, T_avg, T_m, T_p, T_e, J], axis="columns")
+
+        return result_df.add_prefix("Spectral_")
+
+    # The `spectra` table uses unix seconds for Timestamp. Adds "Timestamp" and
+    # "Raw_Timestamp" columns and indexes `result_df` by "Timestamp"
+    def index_by_unix_seconds(self, result_df):
+        result_df.index = pd.to_datetime(result_df.index, utc=True)
+        result_df.index.name = "time"
+
+        # Unix seconds
+        result_df["Timestamp"] = (
+            result_df.index - pd.Timestamp(0, tz="UTC")
+        ) // pd.Timedelta(seconds=1)
+        result_df["Raw_Timestamp"] = result_df.index.astype(str)
+
+        # This is dumb but everything else is in unix seconds
+        result_df.index = result_df["Timestamp"]
+
+        return result_df
@@ -0,0 +1,137 @@
+import hashlib
+
+import numpy as np
+
+from AppContext import AppContext
+
+
+# Compact, memory-mappable store of spectral energy density for one station.
+#
+# Densities are kept so QOIs can be recomputed (new definitions, a corrected
+# depth) without re-downloading or re-decoding source files. Rows are grouped
+# by frequency grid. A grid version is a short hash of the grid, and for each
+# version the station directory holds:
+#   * grid_<version>.npy: Frequencies in Hz as float64, written once
+#   * timestamps_<version>.i8: Unix epoch ns timestamps as raw int64, sorted
+#   * density_<version>.f32: Spectral energy density as raw float32, one row
+#     of len(grid) values per timestamp
+#
+# Both raw files are append-only. The timestamp file is written after the
+# density file and decides how many rows exist, so an interrupted append never
+# exposes a partial row.
+class SpectralDensityStore:
+    def __init__(self, station, context=None):
+        context = context or AppContext.get()
+
+        self.station = station
+        self.file_manager = context.file_manager
+        self.logger = context.logger
+
+        self.store_dir = self.file_manager.get_spectral_density_dir(station)
+
+    def get_grid_version(self, frequencies):
+        frequencies = np.ascontiguousarray(frequencies, dtype=np.float64)
+        return hashlib.sha1(frequencies.tobytes()).hexdigest()[:12]
+
+    def get_grid_path(self, version):
+        return self.store_dir.joinpath(f"grid_{version}.npy")
+
+    def get_timestamps_path(self, version):
+        return self.store_dir.joinpath(f"timestamps_{version}.i8")
+
+    def get_density_path(self, version):
+        return self.store_dir.joinpath(f"density_{version}.f32")
+
+    def grid_versions(self):
+        return sorted(
+            path.stem.removeprefix("grid_")
+            for path in self.store_dir.glob("grid_*.npy")
+        )
+
+    def read_frequencies(self, version):
+        return np.load(self.get_grid_path(version))
+
+    def read_timestamps(self, version):
+        path = self.get_timestamps_path(version)
+        if path.exists() is False:
+            return np.array([], dtype=np.int64)
+
+        # Ignore a partially written trailing timestamp
+        num_timestamps = path.stat().st_size // np.dtype(np.int64).itemsize
+        if num_timestamps == 0:
+            return np.array([], dtype=np.int64)
+
+        return np.memmap(path, dtype=np.int64, mode="r", shape=(num_timestamps,))
+
+    # Returns (timestamps, frequencies, density) for a grid version. timestamps
+    # and density are read-only memory maps, density has the shape
+    # (len(timestamps), len(frequencies))
+    def load(self, version):
+        frequencies = self.read_frequencies(version)
+        timestamps = self.read_timestamps(version)
+
+        if len(timestamps) == 0:
+            density = np.empty((0, len(frequencies)), dtype=np.float32)
+        else:
+            density = np.memmap(
+                self.get_density_path(version),
+                dtype=np.float32,
+                mode="r",
+                shape=(len(timestamps), len(frequencies)),
+            )
+
+        return (timestamps, frequencies, density)
+
+    # Append spectra newer than the last stored timestamp of their grid.
+    # timestamps: Unix epoch ns integers, one per density row
+    # frequencies: Frequency grid in Hz
+    # density: Array like of shape (len(timestamps), len(frequencies))
+    # Returns the number of rows written
+    def append(self, timestamps, frequencies, density):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        density = np.asarray(density, dtype=np.float32)
+
+        version = self.get_grid_version(frequencies)
+
+        grid_path = self.get_grid_path(version)
+        if grid_path.exists() is False:
+            np.save(grid_path, frequencies)
+            self.logger.info(
+                __name__,
+                f"New frequency grid {version} ({len(frequencies)} frequencies) for station {self.station}",
+            )
+
+        # Sort and drop duplicate timestamps, then keep what is newer than the store
+        timestamps, unique_idx = np.unique(timestamps, return_index=True)
+        density = density[unique_idx]
+
+        existing_timestamps = self.read_timestamps(version)
+        num_existing = len(existing_timestamps)
+        if num_existing > 0:
+            is_new = timestamps > existing_timestamps[-1]
+            timestamps = timestamps[is_new]
+            density = density[is_new]
+
+        if len(timestamps) == 0:
+            return 0
+
+        # Drop any partial rows left behind by an interrupted append
+        row_bytes = len(frequencies) * np.dtype(np.float32).itemsize
+        density_path = self.get_density_path(version)
+        with open(density_path, "ab") as f:
+            f.truncate(num_existing * row_bytes)
+            f.write(np.ascontiguousarray(density).tobytes())
+
+        with open(self.get_timestamps_path(version), "ab") as f:
+            f.truncate(num_existing * timestamps.itemsize)
+            f.write(timestamps.tobytes())
+
+        return len(timestamps)
+
+
+if __name__ == "__main__":
+    store = SpectralDensityStore("225")
+    for version in store.grid_versions():
+        timestamps, frequencies, density = store.load(version)
+        print(version, density.shape, frequencies[0], frequencies[-1])
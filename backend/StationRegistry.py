@@ -0,0 +1,57 @@
+# StationRegistry co-locates the wave buoys the backend collects spectra from.
+#
+# The primary station is the buoy used for the power matrices, the other
+# enabled stations are collected alongside it to cross-check conditions at
+# WETS. Each station is keyed by the id used in its source's URLs, and that id
+# is also the `Station` value in the `spectra` table.
+class StationRegistry:
+    def __init__(self):
+        # https://cdip.ucsd.edu/m/products/?stn=225p1
+        self.primary_station = "225"
+
+        # source: "cdip" for CDIP realtime NetCDF files, "ndbc" for NDBC
+        #     realtime data_spec files
+        # name: Human readable station name
+        # enabled: Collected by `SpectraHandler.update_all_spectra`
+        # depth: Water depth in meters, only needed by sources that don't
+        #     include it (NDBC). Used for the energy flux calculation
+        self.stations = {
+            "225": {
+                "source": "cdip",
+                "name": "Kaneohe Bay, WETS, HI (NDBC 51210)",
+                "enabled": True,
+            },
+            # https://cdip.ucsd.edu/m/products/?stn=198p1
+            "198": {
+                "source": "cdip",
+                "name": "Kaneohe Bay, HI (NDBC 51207)",
+                "enabled": True,
+            },
+            # https://www.ndbc.noaa.gov/station_page.php?station=51210
+            # The NDBC feed of CDIP 225, an alternate source if CDIP is down
+            "51210": {
+                "source": "ndbc",
+                "name": "Kaneohe Bay, WETS, HI (CDIP 225)",
+                "enabled": False,
+                "depth": 80.0,
+            },
+        }
+
+    def get(self, station_id):
+        if station_id not in self.stations:
+            raise KeyError(f"Station {station_id} is not in the station registry")
+
+        return self.stations[station_id]
+
+    def enabled_station_ids(self):
+        return [
+            station_id
+            for station_id, station in self.stations.items()
+            if station["enabled"] is True
+        ]
+
+
+if __name__ == "__main__":
+    registry = StationRegistry()
+    for station_id in registry.enabled_station_ids():
+        print(station_id, registry.get(station_id))
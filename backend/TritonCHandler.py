@@ -5,27 +5,23 @@ import pandas as pd
 
 from CanaryRequester import CanaryRequester
 from DataHandler import DataHandler
-from DirectoryManager import DirectoryManager
-from FileManager import FileManager
-from Logger import Logger
-from SQLite import SQLite
 
 
 class TritonC(DataHandler):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, context=None):
+        super().__init__(context)
         self.server = None
-        self.db = SQLite()
-        self.file_manager = FileManager()
-        self.dirs = DirectoryManager()
+        self.db = self.context.db
+        self.file_manager = self.context.file_manager
+        self.dirs = self.context.dirs
 
         self.populate_count = {}
-        self.logger = Logger()
+        self.logger = self.context.logger
 
         self.canary_ip_address = "10.0.2.8"
 
     def init_canary_request(self):
-        self.server = CanaryRequester(self.canary_ip_address)
+        self.server = CanaryRequester(self.canary_ip_address, self.context)
         self.server.setup()
 
     #  Populate -------------------------------------------------------------{{{
@@ -125,6 +121,7 @@ class TritonC(DataHandler):
             df, self.db.insert_triton_c, self.db.select_matching_triton_c_timestamps
         )
 
+    # Returns the number of rows received from Canary
     def update_triton_c(self, canary_time_interval):
         self.init_canary_request()
 
@@ -135,13 +132,16 @@ class TritonC(DataHandler):
                     __name__,
                     "Canary is running but there is no available data, returning...",
                 )
-                return
+                return 0
 
             self.file_manager.save_triton_c_all(df)
 
             super(TritonC, self).unique_insert(
                 df, self.db.insert_triton_c, self.db.select_matching_triton_c_timestamps
             )
+            return len(df)
+
+        return 0
 
     #  End triton_c ---------------------------------------------------------}}}
     #  Gps Coords -----------------------------------------------------------{{{
@@ -0,0 +1,504 @@
+# Benchmarks for the backend processing stages, run from the backend directory:
+#
+#   python3 benchmarks.py average_power_data [--days 90] [--rate-hz 10]
+#   python3 benchmarks.py join_spectra [--years 5]
+#   python3 benchmarks.py binned_statistics [--years 5]
+#   python3 benchmarks.py power_matrices_parallel [--days 90] [--workers 1,2,4]
+#   python3 benchmarks.py render_power_matrix [--repeat 5]
+#   python3 benchmarks.py render_soak [--renders 2000] [--pyplot]
+#
+# Each benchmark builds synthetic Triton-C data, so they can run without a
+# populated database.
+import argparse
+import math
+import os
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+from mhkit import wave
+import numpy as np
+import pandas as pd
+
+from PowerMatrixBins import PowerMatrixBins
+from PowerMatrixDataHandler import PowerMatrixDataHandler
+from PowerMatrixImageGenerator import PowerMatrixImageGenerator
+from PowerSpectraJoiner import PowerSpectraJoiner
+
+
+# Synthetic `triton_c` power data: `days` of samples at `rate_hz` with a UTC
+# DatetimeIndex. Includes offline periods (zero power) and missing samples (NaN)
+def build_power_df(days, rate_hz, columns=("Total_Power_kW",), seed=0):
+    rng = np.random.default_rng(seed)
+    num_samples = int(days * 24 * 60 * 60 * rate_hz)
+    start_ns = pd.Timestamp("2024-01-01T00:00:07", tz="UTC").value
+    period_ns = int(1_000_000_000 / rate_hz)
+
+    index = pd.to_datetime(
+        start_ns + np.arange(num_samples, dtype=np.int64) * period_ns,
+        unit="ns",
+        utc=True,
+    )
+
+    data = {}
+    for column in columns:
+        power_kw = rng.gamma(2.0, 10.0, num_samples)
+        # Offline for a few hours every 3 days
+        power_kw[(np.arange(num_samples) // (rate_hz * 3600)) % 72 < 4] = 0
+        power_kw[rng.random(num_samples) < 0.01] = np.nan
+        data[column] = power_kw
+
+    return pd.DataFrame(data, index=index)
+
+
+# The half-hour averaging loop PowerMatrixDataHandler used before it was
+# vectorized, kept as the reference for output and timing comparisons
+def legacy_average_power_data(power_df, column):
+    averaging_frequency = "30min"
+
+    power_df.sort_index(inplace=True)
+    df = power_df
+
+    df["UTC_Timestamp"] = pd.to_datetime(df.index)
+
+    first_timestamp = df["UTC_Timestamp"].iloc[0].floor(freq=averaging_frequency)
+    last_timestamp = df["UTC_Timestamp"].iloc[-1].ceil(freq=averaging_frequency)
+
+    hours_power_data_is_available = pd.date_range(
+        start=first_timestamp, end=last_timestamp, freq=averaging_frequency
+    )
+
+    valid_timestamps = []
+    valid_power_kw = []
+
+    for i in range(1, len(hours_power_data_is_available)):
+        hour_start = hours_power_data_is_available[i - 1]
+        hour_end = hours_power_data_is_available[i]
+
+        this_hour_power_data = df[
+            (df["UTC_Timestamp"] >= hour_start) & (df["UTC_Timestamp"] < hour_end)
+        ]
+
+        if this_hour_power_data.empty:
+            continue
+
+        average_power_kw = this_hour_power_data[column].mean()
+
+        if average_power_kw != 0 and math.isnan(average_power_kw) is False:
+            valid_power_kw.append(average_power_kw)
+            valid_timestamps.append(hour_start)
+
+    return pd.DataFrame(
+        [valid_timestamps, valid_power_kw], ["UTC_Timestamp", f"{column}"]
+    ).T
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (result, time.perf_counter() - start)
+
+
+def benchmark_average_power_data(args):
+    column = "Total_Power_kW"
+    handler = PowerMatrixDataHandler()
+
+    # The legacy loop has no quality filtering
+    handler.quality_filter.enabled = False
+
+    # The legacy loop is O(bins x rows), so it only runs on a short subset.
+    # Its full size cost is extrapolated from the subset
+    legacy_df = build_power_df(args.legacy_days, args.rate_hz)
+    legacy_result, legacy_seconds = timed(
+        legacy_average_power_data, legacy_df.copy(), column
+    )
+    subset_result, subset_seconds = timed(handler.average_power_data, legacy_df, column)
+
+    is_identical = len(legacy_result) == len(subset_result) and np.allclose(
+        legacy_result[column].to_numpy(dtype=np.float64),
+        subset_result[column].to_numpy(),
+        rtol=1e-12,
+    )
+    is_identical = is_identical and bool(
+        (
+            pd.to_datetime(legacy_result["UTC_Timestamp"], utc=True).to_numpy()
+            == subset_result["UTC_Timestamp"].to_numpy()
+        ).all()
+    )
+
+    print(f"{args.legacy_days} days @ {args.rate_hz} Hz ({len(legacy_df):,} rows)")
+    print(f"\tlegacy loop:  {legacy_seconds:.3f} s")
+    print(f"\tvectorized:   {subset_seconds:.3f} s")
+    print(f"\tidentical output: {is_identical}")
+
+    power_df = build_power_df(args.days, args.rate_hz)
+    result, seconds = timed(handler.average_power_data, power_df, column)
+
+    scale = (len(power_df) / len(legacy_df)) * (args.days / args.legacy_days)
+    print(f"{args.days} days @ {args.rate_hz} Hz ({len(power_df):,} rows)")
+    print(f"\tvectorized:   {seconds:.3f} s for {len(result):,} intervals")
+    print(f"\tlegacy loop:  ~{legacy_seconds * scale:,.0f} s (extrapolated)")
+
+    handler.quality_filter.enabled = True
+    filtered_result, filtered_seconds = timed(
+        handler.average_power_data, power_df, column
+    )
+    print(
+        f"\tquality filtered: {filtered_seconds:.3f} s for {len(filtered_result):,} intervals"
+    )
+
+
+# Synthetic half-hour averages and `spectra` rows (unix seconds index) over
+# `years`. Spectra arrive every 30 minutes with jitter and random outages
+def build_join_inputs(years, seed=0, start="2020-01-01"):
+    rng = np.random.default_rng(seed)
+    num_intervals = int(years * 365 * 48)
+
+    average_power_df = pd.DataFrame(
+        {
+            "UTC_Timestamp": pd.date_range(
+                start, periods=num_intervals, freq="30min", tz="UTC"
+            ),
+            "Total_Power_kW": rng.gamma(2.0, 10.0, num_intervals),
+        }
+    )
+
+    spectra_s = pd.Timestamp(start, tz="UTC").value // 1_000_000_000
+    spectra_s += np.arange(num_intervals, dtype=np.int64) * 1800
+    spectra_s += rng.integers(-600, 600, num_intervals)
+    spectra_s = spectra_s[rng.random(num_intervals) > 0.1]
+
+    spectra_df = pd.DataFrame(
+        {
+            "Te": rng.uniform(4, 14, len(spectra_s)),
+            "Hm0": rng.uniform(0.2, 3, len(spectra_s)),
+            "J": rng.uniform(1, 50, len(spectra_s)),
+        },
+        index=pd.Index(spectra_s, name="Timestamp"),
+    )
+
+    return (average_power_df, spectra_df)
+
+
+def benchmark_join_spectra(args):
+    average_power_df, spectra_df = build_join_inputs(args.years)
+    joiner = PowerSpectraJoiner(tolerance=args.tolerance)
+
+    combined_df, seconds = timed(joiner.join, average_power_df, spectra_df)
+
+    print(
+        f"{args.years} years ({len(average_power_df):,} intervals, {len(spectra_df):,} spectra)"
+    )
+    print(f"\tjoin:         {seconds:.3f} s")
+    print(f"\tmatched:      {len(combined_df):,} ({joiner.match_rate:.1%})")
+
+
+# Every statistic of P, L and J from one mhkit performance matrix call each,
+# against one `PowerMatrixBins.binned_statistics` pass, which must give the
+# same matrices
+def benchmark_binned_statistics(args):
+    rng = np.random.default_rng(0)
+    num_intervals = int(args.years * 365 * 48)
+
+    Hm0 = rng.uniform(0.2, 4, num_intervals)
+    Te = rng.uniform(3, 16, num_intervals)
+    J = rng.uniform(1, 50, num_intervals)
+    P = rng.gamma(2.0, 10.0, num_intervals)
+    L = P / J
+
+    bins = PowerMatrixBins.from_data(Hm0, Te)
+
+    def mhkit_statistics():
+        return {
+            name: {
+                statistic: np.asarray(
+                    wave.performance.capture_width_matrix(
+                        Hm0, Te, values, statistic, bins.Hm0_centers, bins.Te_centers
+                    )
+                )
+                for statistic in ["count", "mean", "std", "min", "max", "frequency"]
+            }
+            for name, values in {"P": P, "L": L, "J": J}.items()
+        }
+
+    def single_pass_statistics():
+        bin_indices = bins.get_bin_indices(Hm0, Te)
+        return bins.binned_statistics(bin_indices, {"P": P, "L": L, "J": J})
+
+    mhkit_result, mhkit_seconds = timed(mhkit_statistics)
+    single_pass_result, single_pass_seconds = timed(single_pass_statistics)
+
+    is_identical = all(
+        np.allclose(
+            single_pass_result[name][statistic],
+            mhkit_result[name][statistic],
+            rtol=1e-9,
+            equal_nan=True,
+        )
+        for name in mhkit_result
+        for statistic in mhkit_result[name]
+    )
+
+    print(f"{args.years} years ({num_intervals:,} intervals, {bins.size} bins)")
+    print(f"\tmhkit, 18 calls: {mhkit_seconds:.3f} s")
+    print(f"\tsingle pass:     {single_pass_seconds:.3f} s")
+    print(f"\tidentical output: {is_identical}")
+
+
+# Every PTO over every dashboard window with each worker count, compared to
+# the single process result
+def benchmark_power_matrices_parallel(args):
+    columns = [
+        "PTO_Bow_Power_kW",
+        "PTO_Port_Power_kW",
+        "PTO_Starboard_Power_kW",
+        "Total_Power_kW",
+    ]
+    windows = ["all", "utc_day", "7_utc_days", "30_utc_days", "month"]
+
+    power_df = build_power_df(args.days, args.rate_hz, columns)
+    _, spectra_df = build_join_inputs(args.days / 365, start="2024-01-01")
+
+    handler = PowerMatrixDataHandler()
+
+    print(
+        f"{args.days} days @ {args.rate_hz} Hz ({len(power_df):,} rows), {len(columns)} PTOs x {len(windows)} windows"
+    )
+
+    reference = None
+    reference_seconds = None
+    for max_workers in [int(w) for w in args.workers.split(",")]:
+        result, seconds = timed(
+            handler.calculate_power_matrices_parallel,
+            power_df,
+            spectra_df,
+            columns,
+            windows,
+            None,
+            max_workers,
+        )
+
+        if reference is None:
+            reference = result
+            reference_seconds = seconds
+
+        is_identical = all(
+            result[column][window][0]["PM_mean"].equals(
+                reference[column][window][0]["PM_mean"]
+            )
+            for column in reference
+            for window in reference[column]
+        )
+
+        print(
+            f"\t{max_workers} workers: {seconds:.3f} s ({reference_seconds / seconds:.2f}x), identical output: {is_identical}"
+        )
+
+
+# The SVG at 1200 dpi through mhkit's plot_matrix that the dashboard used
+# before the raster tier, kept as the reference for render timings
+def legacy_render_power_matrix(power_matrix_mean, title, date_range, path):
+    plt.figure(figsize=(8, 8))
+    plt.suptitle(title)
+    plt.title(date_range)
+
+    wave.graphics.plot_matrix(
+        power_matrix_mean,
+        xlabel="Te (s)",
+        ylabel="Hm0 (m)",
+        zlabel="Mean Power (kW)",
+        show_values=False,
+        ax=plt.gca(),
+    )
+
+    plt.tight_layout()
+    plt.savefig(path, format="svg", dpi=1200)
+    plt.close()
+
+
+# Mean power matrix of `years` of synthetic half-hour intervals
+def build_power_matrix_mean(years=5, seed=0):
+    rng = np.random.default_rng(seed)
+    num_intervals = int(years * 365 * 48)
+
+    Hm0 = rng.gamma(4.0, 0.4, num_intervals)
+    Te = rng.normal(9, 2, num_intervals)
+    bins = PowerMatrixBins.from_data(Hm0, Te)
+    statistics = bins.binned_statistics(
+        bins.get_bin_indices(Hm0, Te), {"P": rng.gamma(2.0, 10.0, num_intervals)}
+    )
+    return bins.to_frame(statistics["P"]["mean"])
+
+
+# Resident set size of this process in MiB. Where /proc is not available
+# (macOS) this is the peak RSS, which still shows growth
+def get_rss_mib():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except FileNotFoundError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+# Render time and file size of a power matrix in each output format
+def benchmark_render_power_matrix(args):
+    power_matrix_mean = build_power_matrix_mean()
+    bins_shape = power_matrix_mean.shape
+
+    title = "Triton-C Total_Power_kW"
+    date_range = "2020-01-01 00:00 to 2024-12-31 23:30 Pacific/Honolulu"
+
+    generator = PowerMatrixImageGenerator()
+
+    print(f"{bins_shape[0]} x {bins_shape[1]} bins, best of {args.repeat}")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+
+        def run(name, render):
+            path = Path(output_dir, name)
+            seconds = min(timed(render, path)[1] for _ in range(args.repeat))
+            print(
+                f"\t{name:<16} {seconds * 1000:8.1f} ms {os.path.getsize(path) / 1024:10.1f} KiB"
+            )
+
+        def render_one(image_format):
+            def render(path):
+                figure = generator.acquire_figure()
+                figure.update(power_matrix_mean, title, date_range)
+                if image_format == "svg":
+                    generator.save_svg(figure, path)
+                else:
+                    generator.save_raster(figure, {image_format: path})
+                generator.release_figure(figure)
+
+            return render
+
+        run(
+            "legacy.svg",
+            lambda path: legacy_render_power_matrix(
+                power_matrix_mean, title, date_range, path
+            ),
+        )
+        for image_format in ["svg", "png", "webp"]:
+            run(f"matrix.{image_format}", render_one(image_format))
+
+        # The dashboard formats share one render
+        def render_dashboard(path):
+            figure = generator.acquire_figure()
+            figure.update(power_matrix_mean, title, date_range)
+            generator.save_raster(
+                figure, {"png": Path(output_dir, "dashboard.png"), "webp": path}
+            )
+            generator.release_figure(figure)
+
+        run("dashboard.webp", render_dashboard)
+        print("\t(dashboard.webp includes writing dashboard.png)")
+
+    generator.close()
+
+
+# RSS over many dashboard renders of matrices of different shapes, like a long
+# running process would do. With `--pyplot` every render opens a pyplot figure
+# and never closes it, as the generator did before the figure pool
+def benchmark_render_soak(args):
+    matrices = [
+        build_power_matrix_mean(years, seed)
+        for seed, years in enumerate([0.1, 0.5, 1, 5])
+    ]
+    title = "Triton-C Total_Power_kW"
+
+    generator = PowerMatrixImageGenerator()
+
+    def render_pooled(power_matrix_mean, date_range, output_dir):
+        figure = generator.acquire_figure()
+        figure.update(power_matrix_mean, title, date_range)
+        generator.save_raster(
+            figure,
+            {
+                "webp": Path(output_dir, "soak.webp"),
+                "png": Path(output_dir, "soak.png"),
+            },
+        )
+        generator.release_figure(figure)
+
+    def render_pyplot(power_matrix_mean, date_range, output_dir):
+        plt.figure(figsize=(8, 8))
+        plt.suptitle(title)
+        plt.title(date_range)
+        wave.graphics.plot_matrix(
+            power_matrix_mean,
+            xlabel="Te (s)",
+            ylabel="Hm0 (m)",
+            zlabel="Mean Power (kW)",
+            show_values=False,
+            ax=plt.gca(),
+        )
+        plt.tight_layout()
+        plt.savefig(Path(output_dir, "soak.png"), format="png", dpi=100)
+
+    render = render_pyplot if args.pyplot else render_pooled
+
+    print(
+        f"{args.renders:,} renders ({'pyplot, never closed' if args.pyplot else 'figure pool'})"
+    )
+
+    start = time.perf_counter()
+    samples = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for i in range(args.renders):
+            render(matrices[i % len(matrices)], f"render {i}", output_dir)
+
+            if (i + 1) % args.sample_every == 0:
+                samples.append(get_rss_mib())
+                print(f"\t{i + 1:>8,} renders: {samples[-1]:8.1f} MiB RSS")
+
+    generator.close()
+    plt.close("all")
+
+    seconds = time.perf_counter() - start
+    print(f"\t{seconds / args.renders * 1000:.1f} ms per render")
+    if len(samples) > 1:
+        print(
+            f"\tRSS growth after the first sample: {samples[-1] - samples[0]:+.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    average_parser = subparsers.add_parser("average_power_data")
+    average_parser.add_argument("--days", type=float, default=90)
+    average_parser.add_argument("--rate-hz", type=int, default=10)
+    average_parser.add_argument("--legacy-days", type=float, default=2)
+    average_parser.set_defaults(run=benchmark_average_power_data)
+
+    join_parser = subparsers.add_parser("join_spectra")
+    join_parser.add_argument("--years", type=float, default=5)
+    join_parser.add_argument("--tolerance", default="15min")
+    join_parser.set_defaults(run=benchmark_join_spectra)
+
+    statistics_parser = subparsers.add_parser("binned_statistics")
+    statistics_parser.add_argument("--years", type=float, default=5)
+    statistics_parser.set_defaults(run=benchmark_binned_statistics)
+
+    parallel_parser = subparsers.add_parser("power_matrices_parallel")
+    parallel_parser.add_argument("--days", type=float, default=90)
+    parallel_parser.add_argument("--rate-hz", type=int, default=2)
+    parallel_parser.add_argument("--workers", default="1,2,4")
+    parallel_parser.set_defaults(run=benchmark_power_matrices_parallel)
+
+    render_parser = subparsers.add_parser("render_power_matrix")
+    render_parser.add_argument("--repeat", type=int, default=5)
+    render_parser.set_defaults(run=benchmark_render_power_matrix)
+
+    soak_parser = subparsers.add_parser("render_soak")
+    soak_parser.add_argument("--renders", type=int, default=2000)
+    soak_parser.add_argument("--sample-every", type=int, default=250)
+    soak_parser.add_argument("--pyplot", action="store_true")
+    soak_parser.set_defaults(run=benchmark_render_soak)
+
+    args = parser.parse_args()
+    args.run(args)
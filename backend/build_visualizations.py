@@ -1,4 +1,21 @@
+# Run from cron, see the README. `--source recompute --workers 4` recomputes
+# every window from the full history in 4 processes instead of reading the
+# accumulators, see `Runner.power_matrix_source`
+import argparse
+
 from Runner import Runner
 
-runner = Runner()
-runner.build_visualizations()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source",
+        choices=["accumulators", "sql", "recompute"],
+        default="accumulators",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    runner = Runner()
+    runner.power_matrix_source = args.source
+    runner.power_matrix_workers = args.workers
+    runner.build_visualizations()
@@ -0,0 +1,298 @@
+# Consistency checks of the power matrix stages, run from the backend
+# directory:
+#
+#   python3 check_consistency.py [name ...]
+#
+# Each check builds a small synthetic fixture and asserts that two paths which
+# must agree do, for example `PowerMatrixBins.binned_statistics` and mhkit.
+# Runs every check without names. Exits with 1 when a check fails. The
+# fixtures are small, the timings of the same stages are in `benchmarks.py`.
+# Checks run in a temporary dashboard directory, see `AppContext.configure`.
+import argparse
+import sys
+import tempfile
+import traceback
+
+import numpy as np
+
+
+# Every statistic of `PowerMatrixBins.binned_statistics` against mhkit's
+# performance matrices, and the std of `get_std_from_sums` against both. Few
+# intervals, so many bins hold a single value
+def check_binned_statistics():
+    from mhkit import wave
+
+    from PowerMatrixBins import PowerMatrixBins
+
+    rng = np.random.default_rng(0)
+    Hm0 = rng.uniform(0.2, 4, 60)
+    Te = rng.uniform(3, 16, 60)
+    P = rng.gamma(2.0, 10.0, 60)
+
+    bins = PowerMatrixBins.from_data(Hm0, Te)
+    bin_indices = bins.get_bin_indices(Hm0, Te)
+    statistics = bins.binned_statistics(bin_indices, {"P": P})["P"]
+    assert (statistics["count"] == 1).any(), "fixture has no single value bins"
+
+    for statistic, matrix in statistics.items():
+        expected = np.asarray(
+            wave.performance.capture_width_matrix(
+                Hm0, Te, P, statistic, bins.Hm0_centers, bins.Te_centers
+            )
+        )
+        assert np.allclose(
+            matrix, expected, rtol=1e-9, equal_nan=True
+        ), f"{statistic} differs from mhkit"
+
+    std = bins.get_std_from_sums(
+        np.bincount(bin_indices, minlength=bins.size),
+        np.bincount(bin_indices, weights=P, minlength=bins.size),
+        np.bincount(bin_indices, weights=P**2, minlength=bins.size),
+    )
+    assert np.allclose(
+        std.reshape(bins.shape), statistics["std"], equal_nan=True
+    ), "std from sums differs from binned_statistics"
+
+
+# `PowerQualityFilter` keeps only 2 Hz intervals without gaps by default,
+# and only explicitly loosened thresholds accept a missing sample
+def check_quality_filter():
+    from PowerQualityFilter import PowerQualityFilter
+
+    interval_ns = 30 * 60 * 1_000_000_000
+
+    def get_passing(quality_filter, rate_hz, missing=()):
+        timestamps_ns = np.delete(
+            np.arange(0, interval_ns, 1_000_000_000 // rate_hz), list(missing)
+        )
+        quality = quality_filter.get_interval_quality(
+            timestamps_ns,
+            np.zeros(len(timestamps_ns), dtype=np.int64),
+            1,
+            0,
+            interval_ns,
+        )
+        return bool(quality_filter.get_passing(quality)[0])
+
+    compliant = PowerQualityFilter()
+    assert get_passing(compliant, 2), "rejected a 2 Hz interval"
+    assert get_passing(compliant, 10, [100, 101, 102]), "rejected a 0.4 s gap at 10 Hz"
+    assert not get_passing(compliant, 2, [100]), "accepted a missing 2 Hz sample"
+    assert not get_passing(compliant, 1), "accepted a 1 Hz interval"
+
+    loosened = PowerQualityFilter(min_coverage=0.95, max_gap="10s")
+    assert get_passing(loosened, 2, [100]), "loosened filter rejected a missing sample"
+    assert not get_passing(loosened, 1), "loosened filter accepted a 1 Hz interval"
+
+
+# `calculate_power_matrix_statistics_sql` against the accumulators folded by
+# `update_power_matrix_accumulators` on one database. Both must pair every
+# interval with the spectrum `PowerSpectraJoiner.match_nearest` picks: ties go
+# to the earlier spectrum, a spectrum can serve two intervals, and an interval
+# whose nearest spectrum has no J is dropped rather than matched to the next
+def check_sql_join():
+    import pandas as pd
+
+    from AppContext import AppContext
+    from PowerMatrixAccumulator import PowerMatrixAccumulator
+    from PowerMatrixBins import PowerMatrixBins
+    from PowerMatrixDataHandler import PowerMatrixDataHandler
+
+    context = AppContext.get()
+    db = context.db
+    db.create_tables()
+
+    station = "check"
+    columns = ["PTO_Bow_Power_kW", "Total_Power_kW"]
+    start_s = pd.Timestamp("2024-01-01", tz="UTC").value // 1_000_000_000
+    num_intervals = 12
+
+    rng = np.random.default_rng(1)
+    timestamps_ns = start_s * 1_000_000_000 + np.arange(
+        0, num_intervals * 30 * 60 * 1_000_000_000, 500_000_000
+    )
+    power_df = pd.DataFrame(
+        {
+            "Is_Deployed": 1,
+            "Is_Maint": 0,
+            **{column: rng.normal(5, 20, len(timestamps_ns)) for column in columns},
+        },
+        index=timestamps_ns,
+    )
+    db.insert_triton_c(power_df)
+
+    # Seconds after the first interval start, interval i starts at i * 1800
+    spectra_offsets = [
+        -100,
+        100,  # tie at interval 0
+        1800,  # at the start of interval 1
+        4100,  # interval 2
+        6300,  # 900 s from intervals 3 and 4
+        8900,
+        9010,  # interval 5, the nearest one has no J
+        11800,  # interval 7 only
+        14370,
+        14420,  # interval 8, the later one is nearer
+        16250,
+        18100,
+        19740,  # intervals 9 to 11
+    ]
+    Hm0 = rng.uniform(0.5, 3, len(spectra_offsets))
+    Te = rng.uniform(4, 12, len(spectra_offsets))
+    J = rng.uniform(5, 40, len(spectra_offsets))
+    J[spectra_offsets.index(9010)] = np.nan
+    db.insert_spectra(
+        pd.DataFrame(
+            {
+                "Station": station,
+                "Timestamp": start_s + np.array(spectra_offsets),
+                "Spectral_Hm0": Hm0,
+                "Spectral_Te": Te,
+                "Spectral_J": J,
+            }
+        )
+    )
+    bins = PowerMatrixBins.fixed()
+    db.update_spectra_bins(bins.Hm0_width, bins.Te_width, *bins.shape)
+
+    handler = PowerMatrixDataHandler(context)
+    accumulators = {
+        column: PowerMatrixAccumulator(column, context) for column in columns
+    }
+    handler.update_power_matrix_accumulators(
+        accumulators,
+        db.select_triton_c_since(None),
+        db.select_spectra(station),
+        now=pd.Timestamp("2025-01-01", tz="UTC"),
+    )
+    sql_matrices = handler.calculate_power_matrix_statistics_sql(db, station, columns)
+
+    for column in columns:
+        expected, expected_timestamps = accumulators[column].get_window_statistics(
+            "all"
+        )
+        statistics, timestamps = sql_matrices[column]
+
+        num_matched = expected["count"].values.sum()
+        assert num_matched == 10, f"{column} matched {num_matched} of 10 intervals"
+        for name, matrix in expected.items():
+            assert (
+                statistics[name].shape == matrix.shape
+            ), f"{column} {name} shapes differ"
+            assert np.allclose(
+                statistics[name].values, matrix.values, equal_nan=True
+            ), f"{column} {name} differs between SQL and the accumulators"
+        assert timestamps.equals(expected_timestamps), f"{column} timestamps differ"
+
+
+# A `PowerMatrixAccumulator` that crashed after writing its state but before
+# or while writing its `PowerMatrixCube` replays the cube rows on `load`, so
+# every window matches an accumulator that saved the same folds normally
+def check_cube_replay():
+    from AppContext import AppContext
+    from PowerMatrixAccumulator import PowerMatrixAccumulator
+    from PowerMatrixCube import PowerMatrixCube
+
+    context = AppContext.get()
+    rng = np.random.default_rng(2)
+
+    def fold(accumulator, days):
+        interval_ns = np.sort(
+            np.array(days) * PowerMatrixCube.ns_per_day
+            + rng.integers(0, 48, len(days)) * 30 * 60 * 1_000_000_000
+        )
+        Hm0 = rng.uniform(0.5, 4, len(days))
+        Te = rng.uniform(3, 14, len(days))
+        P = rng.gamma(2.0, 10.0, len(days))
+        J = rng.uniform(5, 40, len(days))
+        accumulator.fold(interval_ns, Hm0, Te, P, P / J, J)
+
+    def crash_before_write(self, *cube_rows):
+        pass
+
+    def crash_during_write(self, *cube_rows):
+        apply(self, *cube_rows)
+        with open(self.path, "r+b") as f:
+            f.truncate(self.path.stat().st_size - self.row_bytes // 2)
+
+    apply = PowerMatrixCube.apply
+    crashed = PowerMatrixAccumulator("crashed", context)
+    expected = PowerMatrixAccumulator("expected", context)
+
+    # Starts a cube, then adds days before, within and after the saved ones
+    saves = [
+        (list(range(19750, 19760)) * 3, None),
+        ([19745, 19752, 19760, 19761, 19761], crash_before_write),
+        ([19758, 19762, 19790, 19790], crash_during_write),
+    ]
+    for days, crash in saves:
+        state = rng.bit_generator.state
+        fold(crashed, days)
+        rng.bit_generator.state = state
+        fold(expected, days)
+
+        if crash is not None:
+            PowerMatrixCube.apply = crash
+        try:
+            crashed.save()
+        finally:
+            PowerMatrixCube.apply = apply
+        expected.save()
+
+        crashed = PowerMatrixAccumulator("crashed", context)
+        expected = PowerMatrixAccumulator("expected", context)
+        assert crashed.load() and expected.load(), "no saved accumulator"
+        assert (
+            crashed.cube.get_last_row()[0].sum() == crashed.count.sum()
+        ), "cube count differs from the accumulator after replay"
+
+        for window in ["all", "month", *PowerMatrixCube.window_days]:
+            statistics, timestamps = crashed.get_window_statistics(window)
+            expected_statistics, expected_timestamps = expected.get_window_statistics(
+                window
+            )
+            for name, matrix in expected_statistics.items():
+                assert np.allclose(
+                    statistics[name].values, matrix.values, equal_nan=True
+                ), f"{window} {name} differs after replay"
+            assert timestamps.equals(expected_timestamps), f"{window} timestamps differ"
+
+
+checks = {
+    "binned_statistics": check_binned_statistics,
+    "cube_replay": check_cube_replay,
+    "quality_filter": check_quality_filter,
+    "sql_join": check_sql_join,
+}
+
+
+def run_check(name):
+    try:
+        checks[name]()
+    except Exception:
+        print(f"FAIL {name}")
+        traceback.print_exc()
+        return False
+
+    print(f"ok   {name}")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in checks]
+    if unknown:
+        parser.error(f"unknown checks {', '.join(unknown)}, one of {', '.join(checks)}")
+
+    from AppContext import AppContext
+    from Logger import Logger
+
+    with tempfile.TemporaryDirectory(prefix="check_consistency_") as base_dir:
+        AppContext.configure(base_dir)
+        results = [run_check(name) for name in args.names or checks]
+        Logger.stop_listeners()
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,132 @@
+# Import time budget of each backend entry point, run from the backend
+# directory:
+#
+#   python3 check_import_budget.py [--repeat 3] [--scale 1.0]
+#
+# Each entry point script runs one `Runner` job. The modules that job imports
+# are imported in a fresh interpreter with `python -X importtime`, best of
+# `--repeat` runs. Exits with 1 when an entry point is over its budget or
+# imports a library it doesn't need, for example mhkit in `collect_WEC_data`.
+# Budgets are for the dashboard server, `--scale` multiplies them on slower
+# or faster machines. The library check doesn't depend on the machine.
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# Heavy libraries, seconds of start up together
+heavy_libraries = ["mhkit", "xarray", "zarr", "scipy", "sklearn", "matplotlib", "PIL"]
+
+# Entry point to (modules imported by its job, budget in ms, libraries it must
+# not import). Libraries imported on first use, like mhkit by
+# `SpectraQOICalculator.calculate`, are not counted
+entry_points = {
+    "collect_WEC_data": (
+        ["Runner", "TritonCHandler"],
+        1000,
+        heavy_libraries,
+    ),
+    "build_visualizations": (
+        ["Runner", "SpectraHandler", "PowerMatrixRenderPool"],
+        2000,
+        ["mhkit", "xarray", "zarr", "scipy", "sklearn"],
+    ),
+    "collect_spectra_data": (
+        [
+            "Runner",
+            "SpectraHandler",
+            "CDIPRealTimeParser",
+            "NDBCRealTimeRawSpectralParser",
+            "SpectraArchive",
+        ],
+        2000,
+        ["matplotlib", "PIL"],
+    ),
+    "recompute_spectra_qoi": (
+        ["Runner", "SpectraHandler", "SpectraQOICalculator", "SpectraArchive"],
+        2000,
+        ["matplotlib", "PIL"],
+    ),
+    "rebuild_power_matrix_accumulators": (
+        ["Runner", "TritonCHandler", "SpectraHandler"],
+        1000,
+        heavy_libraries,
+    ),
+    "rebuild_power_series": (
+        ["Runner", "TritonCHandler", "SpectraHandler"],
+        1000,
+        heavy_libraries,
+    ),
+    "serve_dashboard_api": (
+        ["Runner", "DashboardAPI"],
+        1000,
+        heavy_libraries,
+    ),
+}
+
+
+# Import `modules` with -X importtime. Returns the import time of `modules`
+# in ms and the names of every imported module
+def measure_imports(modules):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).parent,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    total_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") is False or "cumulative" in line:
+            continue
+
+        _, cumulative_us, name = line.split("|")
+        imported.add(name.strip())
+
+        # Nested imports are indented, top level ones are the -c imports and
+        # the interpreter's own start up imports
+        if name.startswith("  ") is False and name.strip() in modules:
+            total_us += int(cumulative_us)
+
+    return (total_us / 1000, imported)
+
+
+def check_entry_point(name, modules, budget_ms, forbidden, repeat):
+    best_ms = None
+    for _ in range(repeat):
+        total_ms, imported = measure_imports(modules)
+        best_ms = total_ms if best_ms is None else min(best_ms, total_ms)
+
+    forbidden_imports = [
+        library
+        for library in forbidden
+        if any(
+            module == library or module.startswith(f"{library}.") for module in imported
+        )
+    ]
+
+    is_ok = best_ms <= budget_ms and len(forbidden_imports) == 0
+    print(
+        f"{'ok' if is_ok else 'FAIL':<4} {name:<36} {best_ms:8.0f} ms"
+        f" / {budget_ms:6.0f} ms"
+        + (f"  imports {', '.join(forbidden_imports)}" if forbidden_imports else "")
+    )
+    return is_ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    results = [
+        check_entry_point(name, modules, budget_ms * args.scale, forbidden, args.repeat)
+        for name, (modules, budget_ms, forbidden) in entry_points.items()
+    ]
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,4 @@
+from Runner import Runner
+
+runner = Runner()
+runner.rebuild_power_matrix_accumulators()
@@ -0,0 +1,4 @@
+from Runner import Runner
+
+runner = Runner()
+runner.recompute_spectra_qoi()
@@ -0,0 +1,4 @@
+from Runner import Runner
+
+runner = Runner()
+runner.serve_dashboard_api()
@@ -169,7 +169,7 @@ export default function Home(props: HomeProps) {
             <Grid item xs={3}>
               <Item>
                 <DashboardImageBox
-                  imageURL="/img/viz_latest/Total_Power_kW_power_matrix_latest.svg"
+                  imageURL="/img/viz_latest/Total_Power_kW_power_matrix_latest.webp"
                   title="PTO-All Power Matrix"
                 />
               </Item>
@@ -177,7 +177,7 @@ export default function Home(props: HomeProps) {
             <Grid item xs={3}>
               <Item>
                 <DashboardImageBox
-                  imageURL="/img/viz_latest/PTO_Bow_Power_kW_power_matrix_latest.svg"
+                  imageURL="/img/viz_latest/PTO_Bow_Power_kW_power_matrix_latest.webp"
                   title="PTO-Bow Power Matrix"
                 />
               </Item>
@@ -185,7 +185,7 @@ export default function Home(props: HomeProps) {
             <Grid item xs={3}>
               <Item>
                 <DashboardImageBox
-                  imageURL="/img/viz_latest/PTO_Starboard_Power_kW_power_matrix_latest.svg"
+                  imageURL="/img/viz_latest/PTO_Starboard_Power_kW_power_matrix_latest.webp"
                   title="PTO-Starboard Power Matrix"
                 />
               </Item>
@@ -193,7 +193,7 @@ export default function Home(props: HomeProps) {
             <Grid item xs={3}>
               <Item>
                 <DashboardImageBox
-                  imageURL="/img/viz_latest/PTO_Port_Power_kW_power_matrix_latest.svg"
+                  imageURL="/img/viz_latest/PTO_Port_Power_kW_power_matrix_latest.webp"
                   title="PTO-Port Power Matrix"
                 />
               </Item>